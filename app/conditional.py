@@ -0,0 +1,108 @@
+''' Responsible for the conditional GETs of the Mayz and users. The version of
+a May or a user is read with a single query on the updated_at columns, without
+loading the relationships. It's sent as the ETag and Last-Modified headers,
+and a client that already has it gets a 304 Not Modified with no body. '''
+
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Optional
+from fastapi import Response, status
+from sqlalchemy.orm import aliased
+from sqlmodel import select, func, col, true
+from app.models import May, User, Vote
+
+
+def may_version(may_id: int):
+    ''' Returns the statement selecting what MayReadVotes depends on: the May,
+    its author, and the voters along with how many votes there are '''
+    voter = aliased(User)
+    votes = select(
+        func.count(), func.max(voter.updated_at)
+        ).select_from(Vote).join(voter, col(Vote.user_id) == voter.id).where(
+            col(Vote.may_id) == may_id
+            ).subquery()
+    return select(
+        May.updated_at, User.updated_at, *votes.c
+        ).join(User, col(May.user_id) == col(User.id)).join(
+            votes, true()
+            ).where(col(May.id) == may_id)
+
+
+def user_version(user_id: int):
+    ''' Returns the statement selecting what UserRead depends on: the user,
+    and the Mayz it wrote and voted along with how many there are '''
+    mayz = select(func.count(), func.max(May.updated_at)).where(
+        col(May.user_id) == user_id
+        ).subquery()
+    voted = select(
+        func.count(), func.max(May.updated_at)
+        ).select_from(Vote).join(May).where(
+            col(Vote.user_id) == user_id
+            ).subquery()
+    return select(User.updated_at, *mayz.c, *voted.c).select_from(User).join(
+        mayz, true()
+        ).join(voted, true()).where(col(User.id) == user_id)
+
+
+def as_utc(moment: datetime) -> datetime:
+    ''' Returns the moment in UTC, SQLite returns it without a timezone '''
+    if moment.tzinfo is None:
+        return moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(timezone.utc)
+
+
+class Validators:
+    ''' ETag and Last-Modified of a version of a May or a user '''
+
+    def __init__(self, version):
+        moments = [as_utc(value) for value in version
+                   if isinstance(value, datetime)]
+        # Every part of the version goes into the ETag, so rows removed from
+        # a relationship change it too
+        digest = hashlib.blake2b(
+            repr([
+                value.isoformat() if isinstance(value, datetime) else value
+                for value in version
+                ]).encode(),
+            digest_size=16
+            ).hexdigest()
+        self.etag = f'"{digest}"'
+        self.last_modified = max(moments)
+
+    def headers(self) -> dict[str, str]:
+        ''' Returns the ETag and Last-Modified headers '''
+        return {
+            'ETag': self.etag,
+            'Last-Modified': format_datetime(self.last_modified, usegmt=True)
+            }
+
+    def matches(
+        self,
+        if_none_match: Optional[str],
+        if_modified_since: Optional[str]
+    ) -> bool:
+        ''' Checks whether the client already has this version. If-None-Match
+        is checked first, If-Modified-Since is only used without it. '''
+        if if_none_match is not None:
+            tags = [tag.strip().removeprefix('W/')
+                    for tag in if_none_match.split(',')]
+            return '*' in tags or self.etag in tags
+        if if_modified_since is not None:
+            try:
+                since = as_utc(parsedate_to_datetime(if_modified_since))
+            except (TypeError, ValueError):
+                return False
+            # Last-Modified has a precision of seconds
+            return self.last_modified.replace(microsecond=0) <= since
+        return False
+
+    def not_modified(self) -> Response:
+        ''' Returns the 304 response of this version '''
+        return Response(
+            status_code=status.HTTP_304_NOT_MODIFIED, headers=self.headers()
+            )
+
+    def apply(self, response: Response):
+        ''' Sets the ETag and Last-Modified headers of a full response '''
+        response.headers.update(self.headers())
@@ -1,27 +1,353 @@
 ''' Responsible for setting up the database connection and providing a session
-for database operations '''
+for database operations. With read replicas, the sessions of GET requests
+read from one of them and write to the primary. '''
 
+import itertools
+import threading
+import time
+from typing import Optional
+from fastapi import Request
+from jose import jwt, JWTError
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+from sqlalchemy.sql.dml import UpdateBase
 from sqlmodel import create_engine, Session
-from app import models
-from app.config import env
+from sqlmodel.ext.asyncio.session import AsyncSession
+from app import migrations
+from app.cache import TTLCache
+from app.config import async_url, env
 
 
-# Database connection
+class PoolWaits:
+    ''' Keeps how long the requests waited to check out a connection '''
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.longest = 0.0
+        self.timeouts = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float, timed_out: bool = False):
+        ''' Records a checkout that took the given seconds '''
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            self.longest = max(self.longest, seconds)
+            self.timeouts += timed_out
+
+
+class TimedPoolMixin:
+    ''' Records the checkout wait of a connection pool '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waits = PoolWaits()
+
+    def recreate(self):
+        ''' Keeps the records when the pool is recreated, e.g. on dispose '''
+        pool = super().recreate()
+        pool.waits = self.waits
+        return pool
+
+    def connect(self):
+        ''' Checks out a connection, recording how long it took '''
+        start = time.perf_counter()
+        try:
+            connection = super().connect()
+        except PoolTimeoutError:
+            self.waits.record(time.perf_counter() - start, timed_out=True)
+            raise
+        self.waits.record(time.perf_counter() - start)
+        return connection
+
+
+class TimedQueuePool(TimedPoolMixin, QueuePool):
+    ''' Queue pool of the sync engine that records the checkout wait '''
+
+
+class TimedAsyncQueuePool(TimedPoolMixin, AsyncAdaptedQueuePool):
+    ''' Queue pool of the async engine that records the checkout wait '''
+
+
+def engine_options(url: str) -> dict:
+    ''' Returns the options of an engine from the environment settings '''
+    options = {
+        'echo': env.db_echo,
+        'pool_size': env.pool_size,
+        'max_overflow': env.max_overflow,
+        'pool_timeout': env.pool_timeout,
+        'pool_recycle': env.pool_recycle,
+        'pool_pre_ping': env.pool_pre_ping,
+        }
+    # The statement timeout is set per connection by Postgres, each driver
+    # takes it differently
+    if env.statement_timeout and url.startswith('postgresql+asyncpg'):
+        options['connect_args'] = {'server_settings': {
+            'statement_timeout': str(env.statement_timeout)
+            }}
+    elif env.statement_timeout and url.startswith('postgresql'):
+        options['connect_args'] = {
+            'options': f'-c statement_timeout={env.statement_timeout}'
+            }
+    return options
+
+
+def enforce_foreign_keys(dbapi_connection, _):
+    ''' SQLite doesn't check the foreign keys unless it's asked to, for every
+    connection '''
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA foreign_keys=ON')
+    cursor.close()
+
+
+# Database connections
 DATABASE_CONN = env.database_url()
-engine = create_engine(DATABASE_CONN, echo=True)
+ASYNC_DATABASE_CONN = env.async_database_url()
+# The engines are created on first use, not on import, see __getattr__
+_engines: dict[str, Optional[Engine | AsyncEngine]] = {}
+_engines_lock = threading.Lock()
+
+
+def make_engine(url: str) -> Engine:
+    ''' Returns a new engine of a database URL, with the pool settings '''
+    new_engine = create_engine(
+        url, poolclass=TimedQueuePool, **engine_options(url)
+        )
+    if new_engine.dialect.name == 'sqlite':
+        event.listen(new_engine, 'connect', enforce_foreign_keys)
+    return new_engine
+
+
+def make_async_engine(url: str) -> AsyncEngine:
+    ''' Returns a new async engine of a database URL, with the pool settings
+    '''
+    new_engine = create_async_engine(
+        url, poolclass=TimedAsyncQueuePool, **engine_options(url)
+        )
+    if new_engine.dialect.name == 'sqlite':
+        event.listen(new_engine.sync_engine, 'connect', enforce_foreign_keys)
+    return new_engine
+
+
+def get_engine() -> Engine:
+    ''' Returns the engine, creating it on first use '''
+    if (sync_engine := _engines.get('sync')) is None:
+        with _engines_lock:
+            if (sync_engine := _engines.get('sync')) is None:
+                sync_engine = _engines['sync'] = make_engine(DATABASE_CONN)
+    return sync_engine
+
+
+def get_async_engine() -> Optional[AsyncEngine]:
+    ''' Returns the async engine, creating it on first use. It's None unless
+    the async stack is enabled, so the async driver is not required
+    otherwise. '''
+    if not env.async_db:
+        return None
+    if (engine_async := _engines.get('async')) is None:
+        with _engines_lock:
+            if (engine_async := _engines.get('async')) is None:
+                engine_async = _engines['async'] = make_async_engine(
+                    ASYNC_DATABASE_CONN
+                    )
+    return engine_async
+
+
+class Replica:
+    ''' A read replica, with the engine of the stack serving the routes. It's
+    marked down when it fails to connect, and skipped until it's retried. '''
+
+    def __init__(self, name: str, url: str):
+        self.name = name
+        self.engine: Engine | AsyncEngine = (
+            make_async_engine(async_url(url)) if env.async_db
+            else make_engine(url)
+            )
+        self.down_until = 0.0
+        event.listen(self.bind, 'handle_error', self.failed)
+
+    @property
+    def bind(self) -> Engine:
+        ''' Returns the sync engine, the one sessions are bound to '''
+        return getattr(self.engine, 'sync_engine', self.engine)
+
+    def healthy(self) -> bool:
+        ''' Checks whether the replica is up, or due to be retried '''
+        return time.monotonic() >= self.down_until
 
+    def failed(self, context):
+        ''' Marks the replica down if it can't be connected to '''
+        if context.connection is None or context.is_disconnect:
+            self.down_until = time.monotonic() + env.replica_retry
 
-def get_session():
+
+def get_replicas() -> list[Replica]:
+    ''' Returns the read replicas, creating their engines on first use '''
+    if (replicas := _engines.get('replicas')) is None:
+        with _engines_lock:
+            if (replicas := _engines.get('replicas')) is None:
+                replicas = _engines['replicas'] = [
+                    Replica(f'replica-{index}', url)
+                    for index, url in enumerate(env.replica_urls())
+                    ]
+    return replicas
+
+
+# Users that wrote recently, who read from the primary to see their writes
+pins = TTLCache(10_000, env.replica_pin)
+# Turn of the round robin among the replicas
+_turns = itertools.count()
+
+
+def choose_replica(user: Optional[str]) -> Optional[Replica]:
+    ''' Returns the replica a user reads from, or None if it reads from the
+    primary: it's pinned, or every replica is down '''
+    if user is not None and pins.get(user):
+        return None
+    if not (healthy := [replica for replica in get_replicas()
+                        if replica.healthy()]):
+        return None
+    if env.replica_strategy == 'least_connections':
+        return min(
+            healthy, key=lambda replica: replica.engine.pool.checkedout()
+            )
+    return healthy[next(_turns) % len(healthy)]
+
+
+def request_user(request: Request) -> Optional[str]:
+    ''' Returns the username in the token of a request, if it's signed by the
+    application. It picks the database the request reads from, so a forged
+    token can't pin another user to the primary. '''
+    scheme, _, token = request.headers.get('authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not token:
+        return None
+    try:
+        return jwt.decode(
+            token, env.secret_key, algorithms=[env.algorithm]
+            ).get('username')
+    except JWTError:
+        return None
+
+
+class RoutingSession(Session):
+    ''' Session that reads from the replica chosen for its request, if any,
+    and writes to the primary it's bound to. A user that writes is pinned to
+    the primary. '''
+
+    def get_bind(self, mapper=None, *, clause=None, **kwargs):
+        ''' Returns the engine of a statement '''
+        if self._flushing or isinstance(clause, UpdateBase):
+            if (user := self.info.get('user')) is not None:
+                pins.put(user, True)
+        elif (replica := self.info.get('replica')) is not None:
+            return replica
+        return super().get_bind(mapper, clause=clause, **kwargs)
+
+
+def routing(request: Request) -> dict:
+    ''' Returns the routing of the session of a request: GET requests read
+    from a replica, the others only use the primary '''
+    user = request_user(request)
+    replica = choose_replica(user) if request.method == 'GET' else None
+    return {'user': user, 'replica': replica.bind if replica else None}
+
+
+def __getattr__(name: str):
+    ''' Creates the engines when db.engine or db.async_engine is first used
+    '''
+    if name == 'engine':
+        return get_engine()
+    if name == 'async_engine':
+        return get_async_engine()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def open_connections(count: int) -> int:
+    ''' Opens connections of the pool ahead of the requests, up to its size,
+    and returns how many are open '''
+    pool = get_engine().pool
+    connections = [get_engine().connect()
+                   for _ in range(min(count, pool.size()))]
+    for connection in connections:
+        connection.close()
+    return pool.checkedin()
+
+
+async def open_connections_async(count: int) -> int:
+    ''' Opens connections of the async pool ahead of the requests, up to its
+    size, and returns how many are open '''
+    engine_async = get_async_engine()
+    connections = [await engine_async.connect()
+                   for _ in range(min(count, engine_async.pool.size()))]
+    for connection in connections:
+        await connection.close()
+    return engine_async.pool.checkedin()
+
+
+def pool_stats() -> dict:
+    ''' Returns the live stats of the connection pools '''
+    pools = {'sync': get_engine().pool}
+    if (engine_async := get_async_engine()) is not None:
+        pools['async'] = engine_async.pool
+    for replica in get_replicas():
+        pools[replica.name] = replica.engine.pool
+    return {
+        name: {
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': pool.overflow(),
+            'checkouts': pool.waits.count,
+            'wait_seconds_total': pool.waits.total,
+            'wait_seconds_max': pool.waits.longest,
+            'timeouts': pool.waits.timeouts,
+            }
+        for name, pool in pools.items()
+        }
+
+
+def request_session(request: Request) -> Session:
+    ''' Returns a new session for a request. With replicas, it reads from one
+    of them on GET requests. '''
+    if not get_replicas():
+        return Session(get_engine())
+    return RoutingSession(get_engine(), info=routing(request))
+
+
+def request_session_async(request: Request) -> AsyncSession:
+    ''' Returns a new async session for a request. Objects are not expired
+    on commit, since reloading their attributes would need IO outside of an
+    await. '''
+    if not get_replicas():
+        return AsyncSession(get_async_engine(), expire_on_commit=False)
+    return AsyncSession(
+        get_async_engine(), sync_session_class=RoutingSession,
+        expire_on_commit=False, info=routing(request)
+        )
+
+
+def get_session(request: Request):
     ''' Dependency in FastAPI routes to provide a session for database
     operations '''
     # The session is automatically committed and closed when the request is
-    # finished.
-    with Session(engine) as session:
+    # finished
+    with request_session(request) as session:
+        yield session
+
+
+async def get_async_session(request: Request):
+    ''' Dependency in async FastAPI routes to provide an async session for
+    database operations '''
+    async with request_session_async(request) as session:
         yield session
 
 
 def create_db():
-    ''' Creates the database and tables '''
-    # It's called during application startup to ensure that the database and
-    # tables exist before the application starts serving requests.
-    models.SQLModel.metadata.create_all(engine)
+    ''' Creates the database and tables, or upgrades their schema '''
+    # It runs the migrations that the database is missing, a new database
+    # runs all of them.
+    migrations.upgrade(get_engine())
@@ -0,0 +1,394 @@
+''' Imports users, Mayz and votes in bulk from CSV or NDJSON, e.g. to seed a
+load test or to move the data of another system in. The file is streamed in
+batches, each one validated like the routes validate a request, inserted
+with a single statement and committed, so memory stays flat and an
+interrupted import keeps what it committed. The passwords are hashed in a
+pool of processes, a batch ahead of the one being inserted.
+
+The rows that can't be inserted are skipped: invalid fields, users whose
+username or email exists, Mayz or votes of missing users or Mayz, and votes
+that exist. They're counted by reason, and written along with their line to
+the --rejects file as NDJSON, without their password. The rows read, inserted
+and rejected, and the rows per second, are printed as it runs.
+
+Run `python -m app.importer {users,mayz,votes} FILE [--format csv|ndjson]
+[--batch N] [--workers N] [--hashed] [--rejects FILE]`, FILE being - for
+stdin. The columns are the fields of signing up, of posting a May and of
+voting, along with user_id for Mayz and votes, and optionally id, created_at
+and enabled. Users are imported before their Mayz, and Mayz before their
+votes. --hashed keeps passwords that are already bcrypt hashes.
+
+The imported Mayz are written to the timelines of their authors but not
+fanned out, so followers read them from the followed users, and the counters
+of the Mayz voted are recomputed. Servers running meanwhile show the new rows
+once their caches expire, and their in-memory search index on restart. '''
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from collections import Counter
+from contextlib import ExitStack
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import IO, Iterable, Iterator, Optional
+from pydantic import ValidationError
+from sqlalchemy import Table, text
+from sqlalchemy.engine import Connection
+from sqlmodel import SQLModel, col, insert, select
+from app.config import env
+from app.models import (
+    May, MayCreate, Timeline, User, UserCreate, Vote, VoteBatchItem
+    )
+from app import database as db, scores, timeline, utils
+
+
+class UserRow(UserCreate):
+    ''' Represents a user to import '''
+    id: Optional[int] = None
+    created_at: Optional[datetime] = None
+    enabled: Optional[bool] = None
+
+
+class MayRow(MayCreate):
+    ''' Represents a May to import '''
+    id: Optional[int] = None
+    created_at: Optional[datetime] = None
+    user_id: int
+
+
+class VoteRow(VoteBatchItem):
+    ''' Represents a vote to import '''
+    user_id: int
+
+
+@dataclass
+class Kind:
+    ''' What is imported: the rows, their table, the columns identifying an
+    inserted row, the columns referencing other tables and why a row that
+    wasn't inserted conflicted '''
+    row: type[SQLModel]
+    table: Table
+    keys: tuple[str, ...]
+    references: dict[str, Table]
+    conflict: str
+
+
+KINDS = {
+    'users': Kind(
+        UserRow, User.__table__, ('username',), {},
+        'username or email already exists'
+        ),
+    'mayz': Kind(
+        MayRow, May.__table__, ('id',), {'user_id': User.__table__},
+        'id already exists'
+        ),
+    'votes': Kind(
+        VoteRow, Vote.__table__, ('user_id', 'may_id'),
+        {'user_id': User.__table__, 'may_id': May.__table__},
+        'the user already voted the May'
+        ),
+    }
+
+
+@dataclass
+class Progress:
+    ''' Counts the rows of an import, and prints them every interval
+    seconds '''
+    name: str
+    interval: float = 2.0
+    read: int = 0
+    inserted: int = 0
+    rejected: Counter = field(default_factory=Counter)
+    started: float = field(default_factory=time.perf_counter)
+    last: tuple[float, int] = (0.0, 0)
+
+    def __post_init__(self):
+        self.last = (self.started, 0)
+
+    def report(self):
+        ''' Prints the counts and the rows read per second since the last
+        report, if it's time to '''
+        now = time.perf_counter()
+        since, read = self.last
+        if now - since < self.interval:
+            return
+        rate = (self.read - read) / max(now - since, 1e-9)
+        self.last = (now, self.read)
+        print(
+            f'{self.name}: {self.read:,} read, {self.inserted:,} inserted, '
+            f'{sum(self.rejected.values()):,} rejected, {rate:,.0f} rows/s',
+            flush=True
+            )
+
+    def summary(self):
+        ''' Prints the totals, the average rate and the rejects by reason '''
+        elapsed = time.perf_counter() - self.started
+        print(
+            f'{self.name}: {self.inserted:,} of {self.read:,} rows inserted '
+            f'in {elapsed:.1f} s, {self.read / max(elapsed, 1e-9):,.0f} '
+            'rows/s'
+            )
+        for reason, count in self.rejected.most_common():
+            print(f'  {count:,} rejected: {reason}')
+
+
+def read_rows(stream: IO[str], file_format: str) -> Iterator[tuple]:
+    ''' Yields the line and the fields of every row of a CSV or NDJSON
+    stream, None if it isn't JSON. Empty CSV fields are left out, so they
+    take their default. '''
+    if file_format == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, {
+                name: value for name, value in row.items() if value != ''
+                }
+        return
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            yield number, json.loads(line)
+        except ValueError:
+            yield number, None
+
+
+def batches(rows: Iterable, size: int) -> Iterator[list]:
+    ''' Yields the rows in lists of up to size '''
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def move_sequences(connection: Connection):
+    ''' Moves the id sequences of Postgres past the ids inserted explicitly,
+    so the next rows created by the application don't conflict '''
+    if connection.dialect.name != 'postgresql':
+        return
+    for table in ('user', 'may'):
+        connection.execute(text(
+            f"SELECT setval(pg_get_serial_sequence('\"{table}\"', 'id'), "
+            f"(SELECT coalesce(max(id), 0) + 1 FROM \"{table}\"), false)"
+            ))
+
+
+class Importer:
+    ''' Imports the rows of a kind, batch by batch '''
+
+    def __init__(self, kind: str, args: argparse.Namespace,
+                 executor: Optional[Executor], rejects: Optional[IO[str]]):
+        self.kind = KINDS[kind]
+        self.hash = kind == 'users' and not args.hashed
+        self.executor = executor
+        self.workers = args.workers or os.cpu_count() or 1
+        self.rejects = rejects
+        self.progress = Progress(kind)
+
+    def reject(self, line: int, row: dict, reason: str):
+        ''' Counts a row that isn't inserted, and writes it to the rejects '''
+        self.progress.rejected[reason] += 1
+        if self.rejects:
+            row = {name: value for name, value in row.items()
+                   if name != 'password'}
+            self.rejects.write(json.dumps(
+                {'line': line, 'reason': reason, 'row': row}, default=str
+                ) + '\n')
+
+    def validate(self, batch: list[tuple[int, dict]]) -> list:
+        ''' Returns the line and the validated fields of the valid rows of a
+        batch, the first row of a key, and rejects the others '''
+        valid, seen = [], set()
+        for line, row in batch:
+            self.progress.read += 1
+            if not isinstance(row, dict):
+                self.reject(line, {}, 'not a JSON object')
+                continue
+            try:
+                fields = self.kind.row.model_validate(row).model_dump(
+                    exclude_none=True
+                    )
+            except ValidationError as exc:
+                error = exc.errors()[0]
+                where = '.'.join(str(part) for part in error['loc'])
+                self.reject(line, row, f"{where}: {error['msg']}")
+                continue
+            if fields.get('vote_type') == 0:
+                self.reject(line, row, 'vote_type: a vote is 1 or -1')
+                continue
+            if not self.hash and 'password' in fields and \
+                    utils.pwd_context.identify(fields['password']) is None:
+                self.reject(line, row, 'password: not a bcrypt hash')
+                continue
+            key = tuple(fields.get(name) for name in self.kind.keys)
+            if None not in key:
+                if key in seen:
+                    self.reject(line, row, self.kind.conflict)
+                    continue
+                seen.add(key)
+            valid.append((line, fields))
+        return valid
+
+    def prepare(self, batch: list[tuple[int, dict]]):
+        ''' Validates a batch and starts hashing its passwords. It returns the
+        valid rows and an iterator of their hashes, which waits for them. '''
+        valid = self.validate(batch)
+        if not self.hash:
+            return valid, None
+        passwords = [fields['password'] for _, fields in valid]
+        if self.executor is None:
+            return valid, map(utils.get_password_hash, passwords)
+        chunk = max(1, len(passwords) // (self.workers * 4))
+        return valid, self.executor.map(
+            utils.get_password_hash, passwords, chunksize=chunk
+            )
+
+    def existing(self, connection: Connection, valid: list) -> list:
+        ''' Returns the rows whose referenced users and Mayz exist, and
+        rejects the others '''
+        for name, table in self.kind.references.items():
+            ids = {fields[name] for _, fields in valid}
+            found = set(connection.execute(
+                select(table.c.id).where(table.c.id.in_(ids))
+                ).scalars())
+            kept = []
+            for line, fields in valid:
+                if fields[name] in found:
+                    kept.append((line, fields))
+                else:
+                    self.reject(
+                        line, fields, f"{name}: {table.name} doesn't exist"
+                        )
+            valid = kept
+        return valid
+
+    def insert(self, connection: Connection, valid: list) -> set[tuple]:
+        ''' Inserts the rows, skipping the ones that conflict with a unique
+        key, and returns the keys of the inserted ones. The rows are grouped
+        by their columns, since a statement inserts the same ones. '''
+        groups: dict[tuple, list] = {}
+        for _, fields in valid:
+            groups.setdefault(tuple(sorted(fields)), []).append(fields)
+        statement = timeline.insert_for(connection.dialect.name)(
+            self.kind.table
+            ).on_conflict_do_nothing().returning(
+                *(self.kind.table.c[name] for name in self.kind.keys)
+                )
+        inserted = set()
+        for rows in groups.values():
+            inserted.update(
+                tuple(row) for row in connection.execute(statement, rows)
+                )
+        return inserted
+
+    def after(self, connection: Connection, inserted: set[tuple],
+              valid: list):
+        ''' Updates what depends on the inserted rows: the timelines of the
+        authors of the Mayz, and the counters of the Mayz voted '''
+        if self.kind.table is May.__table__ and inserted:
+            may_ids = [may_id for may_id, in inserted]
+            connection.execute(insert(Timeline).from_select(
+                ['user_id', 'may_id', 'created_at'],
+                select(May.user_id, May.id, May.created_at).where(
+                    col(May.id).in_(may_ids)
+                    )
+                ))
+            connection.execute(timeline.trim(
+                {fields['user_id'] for _, fields in valid}
+                ))
+        elif self.kind.table is Vote.__table__ and inserted:
+            connection.execute(scores.recount(
+                {may_id for _, may_id in inserted}
+                ))
+
+    def load(self, connection: Connection, valid: list, hashes):
+        ''' Inserts a prepared batch in a transaction of its own '''
+        if hashes is not None:
+            for (_, fields), hashed in zip(valid, hashes):
+                fields['password'] = hashed
+        valid = self.existing(connection, valid)
+        inserted = self.insert(connection, valid) if valid else set()
+        for line, fields in valid:
+            key = tuple(fields.get(name) for name in self.kind.keys)
+            if None in key or key in inserted:
+                self.progress.inserted += 1
+            else:
+                self.reject(line, fields, self.kind.conflict)
+        self.after(connection, inserted, valid)
+        connection.commit()
+        self.progress.report()
+
+    def run(self, rows: Iterable[tuple[int, dict]], size: int):
+        ''' Imports the rows. The next batch is validated and its passwords
+        are hashed while the current one is inserted. '''
+        with db.engine.connect() as connection:
+            pending = None
+            for batch in batches(rows, size):
+                prepared = self.prepare(batch)
+                if pending:
+                    self.load(connection, *pending)
+                pending = prepared
+            if pending:
+                self.load(connection, *pending)
+            move_sequences(connection)
+            connection.commit()
+        self.progress.summary()
+
+
+def parse_args() -> argparse.Namespace:
+    ''' Returns the arguments of the command line '''
+    parser = argparse.ArgumentParser(
+        prog='python -m app.importer', description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter
+        )
+    parser.add_argument('kind', choices=KINDS)
+    parser.add_argument('file', help='CSV or NDJSON file, - for stdin')
+    parser.add_argument('--format', choices=('csv', 'ndjson'),
+                        help='by default from the extension of the file')
+    parser.add_argument('--batch', type=int, default=1000,
+                        help='rows inserted per statement and transaction')
+    parser.add_argument(
+        '--workers', type=int, default=env.password_workers,
+        help='processes hashing the passwords, 0 hashes them inline'
+        )
+    parser.add_argument('--hashed', action='store_true',
+                        help='the passwords are bcrypt hashes already')
+    parser.add_argument('--rejects', default='',
+                        help='NDJSON file the skipped rows are written to')
+    args = parser.parse_args()
+    if args.format is None:
+        args.format = 'csv' if args.file.endswith('.csv') else 'ndjson'
+    if args.batch <= 0:
+        parser.error('--batch must be positive')
+    return args
+
+
+def main():
+    ''' Runs the import '''
+    args = parse_args()
+    hashes = args.kind == 'users' and not args.hashed and args.workers != 0
+    # The files and the processes are closed when the import ends or fails,
+    # the standard input is left open
+    with ExitStack() as stack:
+        stream = sys.stdin if args.file == '-' else stack.enter_context(
+            open(args.file, newline='', encoding='utf-8')
+            )
+        rejects = stack.enter_context(
+            open(args.rejects, 'w', encoding='utf-8')
+            ) if args.rejects else None
+        executor = stack.enter_context(
+            ProcessPoolExecutor(args.workers)
+            ) if hashes else None
+        Importer(args.kind, args, executor, rejects).run(
+            read_rows(stream, args.format), args.batch
+            )
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+''' Responsible for the in-process buffers of the newest Mayz and users, which
+serve the latest routes without querying the database. They're filled on
+startup. The routes that write record the new rows and mark the changed ones
+as stale, and a stale entry is read again, by its primary key, the next time
+it's served. Other processes may write too, so a buffer is read again from the
+database once it's older than its time to live. '''
+
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Optional
+from pydantic import BaseModel
+from sqlmodel import Session, SQLModel, select, col, desc
+from sqlmodel.ext.asyncio.session import AsyncSession
+from app.config import env
+from app.models import May, MayRead, User, UserRead
+
+
+class LatestBuffer:
+    ''' Newest rows of a table, by created_at and id, as read models. A stale
+    entry only keeps its place, until it's read again. '''
+
+    def __init__(
+        self,
+        entity: type[SQLModel],
+        model: type[BaseModel],
+        size: int,
+        ttl: float
+    ):
+        self.entity = entity
+        self.model = model
+        self.size = size
+        self.ttl = ttl
+        # Id of every row, mapped to its created_at and its read model, None
+        # if it's stale
+        self._entries: dict[int, tuple[datetime, Optional[BaseModel]]] = {}
+        # Ids of the rows, newest first
+        self._order: list[int] = []
+        # Whether there are no rows besides the buffered ones
+        self._complete = False
+        self._expires = 0.0
+        # Sync routes run in a threadpool, so the entries are guarded by a lock
+        self._lock = threading.Lock()
+
+    def rows(self, options, ids: Optional[list[int]] = None):
+        ''' Returns the statement selecting the rows with the given ids, or
+        the newest rows that fit the buffer '''
+        statement = select(self.entity).options(*options).execution_options(
+            populate_existing=True
+            )
+        if ids is not None:
+            return statement.where(col(self.entity.id).in_(ids))
+        return statement.order_by(
+            desc(self.entity.created_at), desc(self.entity.id)
+            ).limit(self.size)
+
+    def _sort(self):
+        ''' Sorts the ids newest first and drops the ones that don't fit '''
+        self._order = sorted(
+            self._entries,
+            key=lambda row_id: (self._entries[row_id][0], row_id),
+            reverse=True
+            )
+        for row_id in self._order[self.size:]:
+            del self._entries[row_id]
+            self._complete = False
+        del self._order[self.size:]
+
+    def fill(self, rows: list) -> list[BaseModel]:
+        ''' Replaces the entries with the newest rows, and returns their read
+        models '''
+        snapshots = [self.model.model_validate(row) for row in rows]
+        with self._lock:
+            self._entries = {
+                row.id: (row.created_at, snapshot)
+                for row, snapshot in zip(rows, snapshots)
+                }
+            self._complete = len(rows) < self.size
+            self._expires = time.monotonic() + self.ttl
+            self._sort()
+        return snapshots
+
+    def refresh(self, ids: list[int], rows: list):
+        ''' Replaces the stale entries with the rows read again, the ones that
+        weren't found are gone '''
+        snapshots = {row.id: self.model.model_validate(row) for row in rows}
+        with self._lock:
+            for row_id in ids:
+                if row_id not in self._entries:
+                    continue
+                if row_id in snapshots:
+                    self._entries[row_id] = (
+                        self._entries[row_id][0], snapshots[row_id]
+                        )
+                else:
+                    del self._entries[row_id]
+                    self._order.remove(row_id)
+
+    def push(self, row):
+        ''' Adds a new row, as stale since it's read with its relationships
+        when it's served '''
+        with self._lock:
+            self._entries[row.id] = (row.created_at, None)
+            self._sort()
+
+    def remove(self, *ids: int):
+        ''' Removes the rows with the given ids '''
+        with self._lock:
+            for row_id in ids:
+                if self._entries.pop(row_id, None) is not None:
+                    self._order.remove(row_id)
+
+    def invalidate(self, *ids: int):
+        ''' Marks the rows with the given ids as stale, or every row if no id
+        is given '''
+        with self._lock:
+            for row_id in ids or list(self._entries):
+                if row_id in self._entries:
+                    self._entries[row_id] = (self._entries[row_id][0], None)
+
+    def invalidate_where(self, predicate: Callable[[BaseModel], bool]):
+        ''' Marks the rows whose read models match the predicate as stale '''
+        with self._lock:
+            for row_id, (created_at, snapshot) in self._entries.items():
+                if snapshot is not None and predicate(snapshot):
+                    self._entries[row_id] = (created_at, None)
+
+    def stale(self, n: int) -> list[int]:
+        ''' Returns the ids of the stale rows among the newest n, none if the
+        buffer has expired since it's filled again anyway '''
+        with self._lock:
+            if time.monotonic() >= self._expires:
+                return []
+            return [row_id for row_id in self._order[:n]
+                    if self._entries[row_id][1] is None]
+
+    def newest(self, n: int) -> Optional[list[BaseModel]]:
+        ''' Returns the read models of the newest n rows, or None if the
+        buffer can't tell them and it has to be filled again '''
+        with self._lock:
+            if time.monotonic() >= self._expires:
+                return None
+            if n > len(self._order) and not self._complete:
+                return None
+            snapshots = [self._entries[row_id][1]
+                         for row_id in self._order[:n]]
+        if any(snapshot is None for snapshot in snapshots):
+            return None
+        return snapshots
+
+
+mayz = LatestBuffer(May, MayRead, env.latest_size, env.latest_ttl)
+users = LatestBuffer(User, UserRead, env.latest_size, env.latest_ttl)
+
+
+def newest(
+    session: Session, buffer: LatestBuffer, options, n: int
+) -> list[BaseModel]:
+    ''' Returns the newest n rows of a buffer, the stale ones are read again,
+    and the whole buffer if it can't tell them '''
+    if stale := buffer.stale(n):
+        buffer.refresh(stale, session.exec(buffer.rows(options, stale)).all())
+    if (snapshots := buffer.newest(n)) is not None:
+        return snapshots
+    return buffer.fill(session.exec(buffer.rows(options)).all())[:n]
+
+
+async def newest_async(
+    session: AsyncSession, buffer: LatestBuffer, options, n: int
+) -> list[BaseModel]:
+    ''' Returns the newest n rows of a buffer, with the async database stack
+    '''
+    if stale := buffer.stale(n):
+        buffer.refresh(
+            stale, (await session.exec(buffer.rows(options, stale))).all()
+            )
+    if (snapshots := buffer.newest(n)) is not None:
+        return snapshots
+    return buffer.fill(
+        (await session.exec(buffer.rows(options))).all()
+        )[:n]
+
+
+def fill(session: Session, may_options, user_options):
+    ''' Fills both buffers, it's called on application startup '''
+    mayz.fill(session.exec(mayz.rows(may_options)).all())
+    users.fill(session.exec(users.rows(user_options)).all())
+
+
+def refers(user: UserRead, may_id: int) -> bool:
+    ''' Checks whether a user wrote or voted a May '''
+    return any(may.id == may_id for may in user.mayz or ()) or any(
+        vote.may is not None and vote.may.id == may_id
+        for vote in user.may_votes or ()
+        )
+
+
+def may_created(may: May):
+    ''' Records a new May, which is also listed by its author '''
+    mayz.push(may)
+    users.invalidate(may.user_id)
+
+
+def may_changed(may_id: int):
+    ''' Marks a May as stale, along with the users that wrote or voted it '''
+    mayz.invalidate(may_id)
+    users.invalidate_where(lambda user: refers(user, may_id))
+
+
+def may_deleted(may_id: int):
+    ''' Removes a May, and marks the users that wrote or voted it as stale '''
+    mayz.remove(may_id)
+    users.invalidate_where(lambda user: refers(user, may_id))
+
+
+def user_created(user: User):
+    ''' Records a new user '''
+    users.push(user)
+
+
+def user_changed(user_id: int):
+    ''' Marks a user as stale, along with the Mayz it wrote '''
+    users.invalidate(user_id)
+    mayz.invalidate_where(
+        lambda may: may.user is not None and may.user.id == user_id
+        )
+
+
+def user_deleted(user_id: int):
+    ''' Removes a user. Its Mayz and votes are gone too, so every entry is
+    marked as stale, the deleted ones are dropped when they're read again. '''
+    users.remove(user_id)
+    users.invalidate()
+    mayz.invalidate()
+
+
+def followers_changed(user_id: int):
+    ''' Marks a user as stale, its followers counter changed '''
+    users.invalidate(user_id)
+
+
+def votes_changed(user_id: int, *may_ids: int):
+    ''' Marks the voted Mayz as stale, their counters changed, along with the
+    user that voted them '''
+    mayz.invalidate(*may_ids)
+    users.invalidate(user_id)
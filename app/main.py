@@ -3,13 +3,40 @@ It sets up the FastAPI instance, includes the routers,
 and defines the main route.'''
 
 # Import the async context manager
+import asyncio
 from contextlib import asynccontextmanager
 # Import the FastAPI class from the fastapi package
 from fastapi import FastAPI
-# Import the routers
-from app.routers import user, may, auth, vote
-# Import the function to create the database
-from app.database import create_db
+from fastapi.responses import ORJSONResponse, PlainTextResponse
+from sqlalchemy.engine import Engine
+from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+# Import the settings
+from app.config import env
+# Import the routers, the async ones if the async stack is enabled
+if env.async_db:
+    from app.routers.aio import user, may, auth, vote
+else:
+    from app.routers import user, may, auth, vote
+# Import the search backend of the Mayz, the latest buffers, the timelines,
+# the trending ranking, the authentication, the warmup and the vote buffer
+from app import (
+    latest, metrics, migrations, search, timeline, trending, oauth2,
+    serialization, timing, utils, votebuffer, warmup, database as db
+    )
+from app.routers.may import may_read_options
+from app.routers.user import user_read_options
+
+
+async def drain_votes():
+    ''' Writes the votes still queued on shutdown, logging a failure '''
+    if not env.vote_buffer:
+        return
+    try:
+        written = await votebuffer.buffer.stop()
+        print(f"Wrote {written} queued votes")
+    except Exception as exc:  # pylint: disable=broad-except
+        print(f"WARNING: the queued votes weren't written: {exc}")
 
 
 # Create the async context manager
@@ -19,12 +46,84 @@ async def lifespan(api: FastAPI):
     # Startup event
     print("Starting up...")
     print(api)
+    # Warn if the schema is behind the migrations. The caches and statements
+    # aren't warmed up then, the tables may not even exist yet.
+    if db.async_engine is not None:
+        async with db.async_engine.connect() as connection:
+            behind = await connection.run_sync(migrations.behind)
+    else:
+        with db.engine.connect() as connection:
+            behind = migrations.behind(connection)
+    if behind:
+        print(f"WARNING: {behind}")
+    # Open the connections of the pool ahead of the requests
+    with warmup.state.phase('connections'):
+        if db.async_engine is not None:
+            await db.open_connections_async(env.warmup_connections)
+        else:
+            db.open_connections(env.warmup_connections)
+    # Fill the search index, if it's not maintained by the database, the
+    # buffers of the newest Mayz and users, and the trending ranking. Then
+    # compile the statements of the hot routes.
+    if not behind:
+        if db.async_engine is not None:
+            async with AsyncSession(db.async_engine) as async_session:
+                with warmup.state.phase('caches'):
+                    await async_session.run_sync(search.backend.rebuild)
+                    await async_session.run_sync(
+                        latest.fill, may_read_options, user_read_options
+                        )
+                    await async_session.run_sync(trending.rebuild)
+                with warmup.state.phase('statements'):
+                    await async_session.run_sync(warmup.compile_statements)
+        else:
+            with Session(db.engine) as session:
+                with warmup.state.phase('caches'):
+                    search.backend.rebuild(session)
+                    latest.fill(session, may_read_options, user_read_options)
+                    trending.rebuild(session)
+                with warmup.state.phase('statements'):
+                    warmup.compile_statements(session)
+    # Start the processes hashing the passwords, off the event loop
+    with warmup.state.phase('passwords'):
+        await asyncio.to_thread(utils.passwords.warm)
+    # Build the adapters of the response models
+    with warmup.state.phase('validators'):
+        serialization.build_adapters(api.routes)
+    # Keep the trending ranking fresh, and the timelines trimmed, in the
+    # background
+    tasks = [
+        asyncio.create_task(trending.keep_ranked()),
+        asyncio.create_task(timeline.keep_trimmed()),
+        ]
+    # Write the queued votes in the background
+    if env.vote_buffer:
+        votebuffer.buffer.start()
+    warmup.state.finish()
     yield
     # Shutdown event
     print("Shutting down...")
+    warmup.state.ready = False
+    # Write the votes still queued, the requests have finished. The tasks
+    # and the processes are stopped even if that fails.
+    await drain_votes()
+    for task in tasks:
+        task.cancel()
+    # Stop the processes hashing the passwords
+    utils.passwords.shutdown()
 
-# Create the FastAPI instance
-app = FastAPI(lifespan=lifespan)
+# Create the FastAPI instance, the routes without a response model are encoded
+# with orjson
+app = FastAPI(
+    lifespan=lifespan, default_response_class=serialization.DefaultResponse
+    )
+# Time the SQL statements of the requests and send them in Server-Timing
+if env.server_timing:
+    timing.instrument(Engine)
+    app.add_middleware(timing.TimingMiddleware)
+# Record the latency and status of the requests by route
+if env.metrics:
+    app.add_middleware(metrics.MetricsMiddleware)
 # Include the routers
 app.include_router(user.router)
 app.include_router(may.router)
@@ -42,3 +141,36 @@ def get_hello_world():
             'SQLModel': 'Hello World!',
             'OAuth2': 'Hello World!'
             }
+
+
+# The stats and the metrics are only served when they're turned on, they
+# aren't authenticated
+if env.stats_routes:
+    @app.get("/pool/")
+    def get_pool_stats():
+        ''' Live stats of the database connection pools '''
+        return db.pool_stats()
+
+    @app.get("/cache/")
+    def get_cache_stats():
+        ''' Size and hit/miss counters of the authenticated users cache '''
+        return oauth2.user_cache.stats()
+
+
+if env.metrics:
+    @app.get("/metrics", include_in_schema=False)
+    def get_metrics():
+        ''' Metrics of the requests, the connection pools, bcrypt and the
+        tokens, in the Prometheus text format '''
+        return PlainTextResponse(
+            metrics.render(), media_type=metrics.CONTENT_TYPE
+            )
+
+
+@app.get("/ready/")
+def get_readiness():
+    ''' Readiness of the application, it's 503 until the startup and its
+    warmup have finished, and once it's shutting down '''
+    return ORJSONResponse(
+        warmup.state.stats(), status_code=200 if warmup.state.ready else 503
+        )
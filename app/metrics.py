@@ -0,0 +1,282 @@
+''' Responsible for the metrics of the application, served at /metrics in the
+Prometheus text format: the latency and the in-flight requests of every route,
+by its template, the usage of the connection pools, how long bcrypt takes and
+how many tokens fail to decode.
+
+Recording a value takes no lock. Every thread records into its own shard of
+each metric, the event loop being one thread and every worker of the
+threadpool another, and the shards are only added up when the metrics are
+scraped. '''
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+from starlette.routing import Match
+from app import database as db
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Buckets of the latency histograms, in seconds
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+    )
+
+
+class Shards:
+    ''' Values of a metric per thread, each one a dict by label values. A
+    thread only takes the lock the first time it records a value. '''
+
+    def __init__(self):
+        self._local = threading.local()
+        self._shards: list[dict] = []
+        self._lock = threading.Lock()
+
+    def mine(self) -> dict:
+        ''' Returns the shard of the current thread '''
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def snapshots(self) -> list[dict]:
+        ''' Returns a copy of every shard. Copying a dict holds the GIL, so
+        it's consistent even if its thread is recording. '''
+        with self._lock:
+            shards = list(self._shards)
+        return [shard.copy() for shard in shards]
+
+
+def escape(value: str) -> str:
+    ''' Escapes a label value of the text format '''
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def labels_text(names: tuple[str, ...], values: tuple, extra: str = '') -> str:
+    ''' Returns the labels of a sample, e.g. {route="/may/",method="GET"} '''
+    pairs = [f'{name}="{escape(str(value))}"'
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    ''' Base of the metrics, with their name, help text and label names '''
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._shards = Shards()
+
+    def header(self) -> list[str]:
+        ''' Returns the HELP and TYPE lines of the metric '''
+        return [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.kind}',
+            ]
+
+    def totals(self) -> dict:
+        ''' Returns the values of every thread added up, by label values '''
+        totals: dict = {}
+        for shard in self._shards.snapshots():
+            for key, value in shard.items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def render(self) -> list[str]:
+        ''' Returns the lines of the metric in the text format '''
+        return self.header() + [
+            f'{self.name}{labels_text(self.labels, key)} {value}'
+            for key, value in sorted(self.totals().items())
+            ]
+
+
+class Counter(Metric):
+    ''' A value that only goes up '''
+    kind = 'counter'
+
+    def inc(self, *values, amount: float = 1):
+        ''' Adds to the counter with the given label values '''
+        shard = self._shards.mine()
+        shard[values] = shard.get(values, 0) + amount
+
+
+class Gauge(Counter):
+    ''' A value that goes up and down '''
+    kind = 'gauge'
+
+    def dec(self, *values, amount: float = 1):
+        ''' Subtracts from the gauge with the given label values '''
+        self.inc(*values, amount=-amount)
+
+
+class Histogram(Metric):
+    ''' Observed values counted into buckets, along with their sum '''
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels=(),
+                 buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *values):
+        ''' Records a value with the given label values. The counts aren't
+        cumulative until they're rendered, so it's a single increment. '''
+        shard = self._shards.mine()
+        if (counts := shard.get(values)) is None:
+            # One count per bucket, one for +Inf, and the sum
+            counts = shard[values] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def totals(self) -> dict:
+        ''' Returns the counts of every thread added up, by label values '''
+        totals: dict = {}
+        for shard in self._shards.snapshots():
+            for key, counts in shard.items():
+                total = totals.setdefault(key, [0] * len(counts))
+                for index, count in enumerate(list(counts)):
+                    total[index] += count
+        return totals
+
+    def render(self) -> list[str]:
+        ''' Returns the cumulative buckets, the sum and the count '''
+        lines = self.header()
+        for key, counts in sorted(self.totals().items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                labels = labels_text(self.labels, key, f'le="{bound}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = labels_text(self.labels, key)
+            lines.append(f'{self.name}_sum{labels} {counts[-1]}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+request_latency = Histogram(
+    'http_request_duration_seconds',
+    'Latency of the requests, until the response is sent, by route template',
+    ('method', 'route')
+    )
+requests_total = Counter(
+    'http_requests_total', 'Requests served, by route template and status',
+    ('method', 'route', 'status')
+    )
+requests_in_flight = Gauge(
+    'http_requests_in_flight', 'Requests being served, by route template',
+    ('method', 'route')
+    )
+password_seconds = Histogram(
+    'password_hash_seconds',
+    'Time spent hashing or verifying a password with bcrypt',
+    ('operation',), buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+    )
+jwt_failures = Counter(
+    'jwt_decode_failures_total', 'Tokens that failed to decode, by reason',
+    ('reason',)
+    )
+rate_limited = Counter(
+    'rate_limited_total',
+    'Requests rejected by the rate limiter, by route and by the key whose '
+    'bucket was empty',
+    ('route', 'key')
+    )
+METRICS = (
+    request_latency, requests_total, requests_in_flight, password_seconds,
+    jwt_failures, rate_limited
+    )
+
+# Stats of app.database.pool_stats() exported, with their type and help
+POOL_STATS = {
+    'size': ('gauge', 'Connections the pool keeps open'),
+    'checked_out': ('gauge', 'Connections in use'),
+    'overflow': ('gauge', 'Connections open beyond the size of the pool'),
+    'checkouts': ('counter', 'Connections checked out'),
+    'wait_seconds_total': (
+        'counter', 'Time spent waiting to check out a connection'
+        ),
+    'timeouts': ('counter', 'Checkouts that timed out'),
+    }
+
+
+def pool_lines() -> list[str]:
+    ''' Returns the usage of the connection pools, read when scraped '''
+    stats = db.pool_stats()
+    lines = []
+    for stat, (kind, documentation) in POOL_STATS.items():
+        name = f'db_pool_{stat}'
+        if kind == 'counter' and not name.endswith('_total'):
+            name += '_total'
+        lines += [f'# HELP {name} {documentation}', f'# TYPE {name} {kind}']
+        lines += [f'{name}{{pool="{pool}"}} {values[stat]}'
+                  for pool, values in stats.items()]
+    return lines
+
+
+def render() -> str:
+    ''' Returns every metric in the text format '''
+    lines = [line for metric in METRICS for line in metric.render()]
+    return '\n'.join(lines + pool_lines()) + '\n'
+
+
+def route_of(scope) -> str:
+    ''' Returns the template of the route a request goes to, so the labels
+    don't grow with the ids in the paths '''
+    partial: Optional[str] = None
+    for route in scope['app'].router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+        if match == Match.PARTIAL and partial is None:
+            partial = route.path
+    return partial or 'unmatched'
+
+
+class MetricsMiddleware:
+    ''' ASGI middleware that records the latency, status and in-flight count
+    of the requests '''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        method, route = scope['method'], route_of(scope)
+        start = time.perf_counter()
+        status = 500
+        requests_in_flight.inc(method, route)
+
+        async def send_recorded(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_recorded)
+        finally:
+            requests_in_flight.dec(method, route)
+            request_latency.observe(time.perf_counter() - start, method, route)
+            requests_total.inc(method, route, status)
+
+
+@contextmanager
+def timed(metric: Histogram, *values):
+    ''' Records the time spent in the block into a histogram, with the given
+    label values '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metric.observe(time.perf_counter() - start, *values)
@@ -0,0 +1,118 @@
+''' Responsible for the versioned migrations of the schema. Each version is a
+module with an upgrade and a downgrade, applied in order, and the version of
+the database is kept in the schema_version table. The application warns on
+startup when the schema is behind. Run `python -m app.migrations` to see the
+version, and `upgrade` or `downgrade` to migrate it. '''
+
+from contextlib import contextmanager
+from typing import Optional
+from sqlalchemy import Column, Integer, MetaData, Table, delete, insert, select
+from sqlalchemy.engine import Connection, Engine
+from app.migrations import (
+    operations as op, v0001_initial, v0002_may_pagination, v0003_may_search,
+    v0004_vote_counters, v0005_updated_at, v0006_follows,
+    v0007_hot_query_indexes
+    )
+
+
+# The migrations in order, the version of each one is its position
+MIGRATIONS = (
+    v0001_initial, v0002_may_pagination, v0003_may_search,
+    v0004_vote_counters, v0005_updated_at, v0006_follows,
+    v0007_hot_query_indexes,
+    )
+HEAD = len(MIGRATIONS)
+
+version_table = Table(
+    'schema_version', MetaData(),
+    Column('version', Integer, nullable=False)
+    )
+
+
+def describe(version: int) -> str:
+    ''' Returns the first sentence of the description of a version '''
+    description = ' '.join((MIGRATIONS[version - 1].__doc__ or '').split())
+    return description.split('. ', maxsplit=1)[0].rstrip('.')
+
+
+def current(connection: Connection) -> int:
+    ''' Returns the version of the database, 0 if it was never migrated '''
+    if not op.has_table(connection, version_table.name):
+        return 0
+    return connection.execute(select(version_table.c.version)).scalar() or 0
+
+
+def set_version(connection: Connection, version: int):
+    ''' Records the version of the database '''
+    version_table.create(connection, checkfirst=True)
+    connection.execute(delete(version_table))
+    connection.execute(insert(version_table).values(version=version))
+
+
+@contextmanager
+def migrating(engine: Engine):
+    ''' Returns the connection the migrations run on. SQLite's foreign keys
+    are off meanwhile, or rebuilding a table would delete the rows
+    referencing it. '''
+    with engine.connect() as connection:
+        sqlite = connection.dialect.name == 'sqlite'
+        if sqlite:
+            connection.exec_driver_sql('PRAGMA foreign_keys=OFF')
+            connection.commit()
+        try:
+            yield connection
+        finally:
+            if sqlite:
+                connection.rollback()
+                connection.exec_driver_sql('PRAGMA foreign_keys=ON')
+
+
+def check_target(target: int):
+    ''' Raises ValueError if there's no such version '''
+    if not 0 <= target <= HEAD:
+        raise ValueError(f'No version {target}, the last one is {HEAD}')
+
+
+def upgrade(engine: Engine, target: int = HEAD) -> list[int]:
+    ''' Upgrades the database to a version, each one in a transaction of its
+    own. It returns the versions applied. '''
+    check_target(target)
+    applied = []
+    with migrating(engine) as connection:
+        for version in range(current(connection) + 1, target + 1):
+            MIGRATIONS[version - 1].upgrade(connection)
+            set_version(connection, version)
+            connection.commit()
+            applied.append(version)
+    return applied
+
+
+def downgrade(engine: Engine, target: int) -> list[int]:
+    ''' Downgrades the database to a version, each one in a transaction of
+    its own. It returns the versions reverted. '''
+    check_target(target)
+    reverted = []
+    with migrating(engine) as connection:
+        for version in range(current(connection), target, -1):
+            MIGRATIONS[version - 1].downgrade(connection)
+            set_version(connection, version - 1)
+            connection.commit()
+            reverted.append(version)
+    return reverted
+
+
+def stamp(engine: Engine, version: int = HEAD):
+    ''' Records the version of a database without migrating it '''
+    check_target(version)
+    with engine.begin() as connection:
+        set_version(connection, version)
+
+
+def behind(connection: Connection) -> Optional[str]:
+    ''' Returns a warning if the database is behind the migrations '''
+    if (version := current(connection)) >= HEAD:
+        return None
+    return (
+        f"The schema is at version {version} of {HEAD}, run "
+        "`python -m app.migrations upgrade` to migrate it"
+        )
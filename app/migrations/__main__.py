@@ -0,0 +1,61 @@
+''' Migrates the schema of the database of the environment settings.
+Run `python -m app.migrations [status | upgrade [VERSION] |
+downgrade VERSION | stamp [VERSION]]`. Upgrading goes to the last version
+by default. Stamping records a version without migrating, e.g. for a
+database whose schema was created or migrated by hand. '''
+
+import argparse
+from app import database as db
+from app.migrations import (
+    HEAD, MIGRATIONS, current, describe, downgrade, stamp, upgrade
+    )
+
+
+def parse_args() -> argparse.Namespace:
+    ''' Returns the arguments of the command line '''
+    parser = argparse.ArgumentParser(
+        prog='python -m app.migrations', description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter
+        )
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('status', help='show the versions')
+    for name, help_text in (
+        ('upgrade', 'upgrade to a version, the last one by default'),
+        ('stamp', 'record a version, the last one by default'),
+    ):
+        command = commands.add_parser(name, help=help_text)
+        command.add_argument('version', type=int, nargs='?', default=HEAD)
+    command = commands.add_parser('downgrade', help='downgrade to a version')
+    command.add_argument('version', type=int)
+    return parser.parse_args()
+
+
+def status():
+    ''' Prints every version, marking the one of the database '''
+    with db.engine.connect() as connection:
+        version = current(connection)
+    for number in range(1, len(MIGRATIONS) + 1):
+        marker = '*' if number == version else ' '
+        print(f'{marker} {number:04d} {describe(number)}')
+    print(f'The database is at version {version} of {HEAD}')
+
+
+def main():
+    ''' Runs the command '''
+    args = parse_args()
+    try:
+        if args.command == 'upgrade':
+            for version in upgrade(db.engine, args.version):
+                print(f'Upgraded to {version:04d} {describe(version)}')
+        elif args.command == 'downgrade':
+            for version in downgrade(db.engine, args.version):
+                print(f'Reverted {version:04d} {describe(version)}')
+        elif args.command == 'stamp':
+            stamp(db.engine, args.version)
+    except ValueError as exc:
+        raise SystemExit(str(exc)) from exc
+    status()
+
+
+if __name__ == '__main__':
+    main()
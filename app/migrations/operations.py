@@ -0,0 +1,125 @@
+''' Operations the migrations change the schema with. They check the schema
+first and do nothing if it already has the change, so a database created
+before the migrations existed, at any point of its history, is upgraded
+from the start. '''
+
+from sqlalchemy import (
+    Column, DefaultClause, Index, MetaData, Table, inspect, text
+    )
+from sqlalchemy.engine import Connection
+from sqlalchemy.schema import CreateColumn, CreateIndex
+from sqlalchemy.sql.expression import FunctionElement, TextClause
+
+
+def has_table(connection: Connection, table_name: str) -> bool:
+    ''' Checks whether a table exists '''
+    return inspect(connection).has_table(table_name)
+
+
+def has_column(connection: Connection, table_name: str, name: str) -> bool:
+    ''' Checks whether a table has a column '''
+    return any(column['name'] == name
+               for column in inspect(connection).get_columns(table_name))
+
+
+def has_index(connection: Connection, table_name: str, name: str) -> bool:
+    ''' Checks whether a table has an index '''
+    return any(index['name'] == name
+               for index in inspect(connection).get_indexes(table_name))
+
+
+def quote(connection: Connection, name: str) -> str:
+    ''' Returns a name quoted for the database, e.g. "user" on Postgres '''
+    return connection.dialect.identifier_preparer.quote(name)
+
+
+def create_table(connection: Connection, table: Table):
+    ''' Creates a table along with its indexes '''
+    table.create(connection, checkfirst=True)
+
+
+def drop_table(connection: Connection, table_name: str):
+    ''' Drops a table along with its indexes '''
+    if has_table(connection, table_name):
+        connection.execute(text(f'DROP TABLE {quote(connection, table_name)}'))
+
+
+def create_index(connection: Connection, name: str, table_name: str,
+                 *columns: str, **kwargs):
+    ''' Creates an index on the columns of a table '''
+    if has_index(connection, table_name, name):
+        return
+    table = Table(table_name, MetaData(), *(Column(column)
+                                            for column in columns))
+    connection.execute(CreateIndex(Index(name, *table.c, **kwargs)))
+
+
+def drop_index(connection: Connection, table_name: str, name: str):
+    ''' Drops an index of a table '''
+    if has_index(connection, table_name, name):
+        connection.execute(text(f'DROP INDEX {quote(connection, name)}'))
+
+
+def add_column(connection: Connection, table_name: str, column: Column):
+    ''' Adds a column to a table. SQLite can't add a column whose default is
+    a function, so the table is rebuilt with it instead. '''
+    if has_column(connection, table_name, column.name):
+        return
+    default = getattr(column.server_default, 'arg', None)
+    if connection.dialect.name == 'sqlite' and isinstance(
+        default, FunctionElement
+    ):
+        rebuild_sqlite(connection, table_name, column)
+        return
+    # The column is compiled as a column of the table
+    Table(table_name, MetaData(), column)
+    definition = CreateColumn(column).compile(dialect=connection.dialect)
+    connection.execute(text(
+        f'ALTER TABLE {quote(connection, table_name)} ADD COLUMN {definition}'
+        ))
+
+
+def drop_column(connection: Connection, table_name: str, name: str):
+    ''' Drops a column of a table, its indexes have to be dropped first '''
+    if has_column(connection, table_name, name):
+        connection.execute(text(
+            f'ALTER TABLE {quote(connection, table_name)} '
+            f'DROP COLUMN {quote(connection, name)}'
+            ))
+
+
+def rebuild_sqlite(connection: Connection, table_name: str, column: Column):
+    ''' Rebuilds a SQLite table with a new column, which mustn't belong to a
+    table yet: the rows are copied to a new table, which replaces the old
+    one, and its indexes are created again.
+    The foreign keys are off while the migrations run, so the rows
+    referencing the table are kept. '''
+    metadata = MetaData()
+    metadata.reflect(connection)
+    old = metadata.tables[table_name]
+    new = old.to_metadata(metadata, name=f'_new_{table_name}')
+    new.indexes.clear()
+    # The reflected defaults that call a function lost their parentheses,
+    # which SQLite requires
+    for copied in new.columns:
+        default = getattr(copied.server_default, 'arg', None)
+        if isinstance(default, TextClause) and '(' in default.text \
+                and not default.text.startswith('('):
+            copied.server_default = DefaultClause(text(f'({default.text})'))
+    new.append_column(column)
+    new.create(connection)
+    columns = ', '.join(quote(connection, name) for name in old.c.keys())
+    connection.execute(text(
+        f'INSERT INTO {quote(connection, new.name)} ({columns}) '
+        f'SELECT {columns} FROM {quote(connection, table_name)}'
+        ))
+    drop_table(connection, table_name)
+    connection.execute(text(
+        f'ALTER TABLE {quote(connection, new.name)} '
+        f'RENAME TO {quote(connection, table_name)}'
+        ))
+    for index in old.indexes:
+        create_index(
+            connection, index.name, table_name,
+            *(indexed.name for indexed in index.columns), unique=index.unique
+            )
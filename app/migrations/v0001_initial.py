@@ -0,0 +1,58 @@
+''' Creates the users, their Mayz and their votes, as they were before the
+migrations '''
+
+from sqlalchemy import (
+    Boolean, Column, ForeignKey, Index, Integer, MetaData, String, Table,
+    TIMESTAMP, UniqueConstraint, true
+    )
+from sqlalchemy.engine import Connection
+from app.migrations import operations as op
+from app.models import CurrentTimestamp
+
+
+def upgrade(connection: Connection):
+    ''' Creates the tables '''
+    metadata = MetaData()
+    user = Table(
+        'user', metadata,
+        Column('nickname', String, nullable=False),
+        Column('username', String, nullable=False),
+        Column('email', String, nullable=False),
+        Column('password', String, nullable=False),
+        Column('id', Integer, primary_key=True),
+        Column(
+            'created_at', TIMESTAMP(timezone=True), nullable=False,
+            server_default=CurrentTimestamp()
+            ),
+        Column(
+            'enabled', Boolean(create_constraint=True), nullable=False,
+            server_default=true()
+            ),
+        UniqueConstraint('email'),
+        Index('ix_user_username', 'username', unique=True),
+        )
+    may = Table(
+        'may', metadata,
+        Column('title', String, nullable=False),
+        Column('content', String, nullable=False),
+        Column('id', Integer, primary_key=True),
+        Column(
+            'created_at', TIMESTAMP(timezone=True), nullable=False,
+            server_default=CurrentTimestamp()
+            ),
+        Column('user_id', Integer, ForeignKey('user.id'), nullable=False),
+        )
+    vote = Table(
+        'vote', metadata,
+        Column('vote_type', Integer, nullable=False),
+        Column('user_id', Integer, ForeignKey('user.id'), primary_key=True),
+        Column('may_id', Integer, ForeignKey('may.id'), primary_key=True),
+        )
+    for table in (user, may, vote):
+        op.create_table(connection, table)
+
+
+def downgrade(connection: Connection):
+    ''' Drops the tables, and every row with them '''
+    for table_name in ('vote', 'may', 'user'):
+        op.drop_table(connection, table_name)
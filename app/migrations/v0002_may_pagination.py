@@ -0,0 +1,17 @@
+''' Indexes the Mayz newest first, which the keyset pagination of /may/all/
+and the latest Mayz walk '''
+
+from sqlalchemy.engine import Connection
+from app.migrations import operations as op
+
+
+def upgrade(connection: Connection):
+    ''' Creates the index '''
+    op.create_index(
+        connection, 'ix_may_created_at_id', 'may', 'created_at', 'id'
+        )
+
+
+def downgrade(connection: Connection):
+    ''' Drops the index '''
+    op.drop_index(connection, 'may', 'ix_may_created_at_id')
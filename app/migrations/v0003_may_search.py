@@ -0,0 +1,21 @@
+''' Indexes the text of the Mayz for /may/search/, on Postgres only. The other
+databases are searched by the in-memory index. '''
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+from app.migrations import operations as op
+
+
+def upgrade(connection: Connection):
+    ''' Creates the GIN index of the search document '''
+    if connection.dialect.name != 'postgresql':
+        return
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_may_search ON may USING gin "
+        "(to_tsvector('simple', title || ' ' || content))"
+        ))
+
+
+def downgrade(connection: Connection):
+    ''' Drops the index '''
+    op.drop_index(connection, 'may', 'ix_may_search')
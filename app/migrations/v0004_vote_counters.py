@@ -0,0 +1,30 @@
+''' Adds the denormalized vote counters of the Mayz, counted from the votes
+'''
+
+from sqlalchemy import Column, Integer, text
+from sqlalchemy.engine import Connection
+from app.migrations import operations as op
+
+COUNTERS = ('upvotes', 'downvotes', 'score')
+
+
+def upgrade(connection: Connection):
+    ''' Adds the counters and counts the votes '''
+    for name in COUNTERS:
+        op.add_column(connection, 'may', Column(
+            name, Integer, nullable=False, server_default='0'
+            ))
+    connection.execute(text(
+        'UPDATE may SET '
+        'upvotes = (SELECT count(*) FROM vote '
+        'WHERE vote.may_id = may.id AND vote.vote_type = 1), '
+        'downvotes = (SELECT count(*) FROM vote '
+        'WHERE vote.may_id = may.id AND vote.vote_type = -1)'
+        ))
+    connection.execute(text('UPDATE may SET score = upvotes - downvotes'))
+
+
+def downgrade(connection: Connection):
+    ''' Drops the counters '''
+    for name in COUNTERS:
+        op.drop_column(connection, 'may', name)
@@ -0,0 +1,26 @@
+''' Adds the version of the users and the Mayz, which validates their cached
+copies. It starts at their creation. '''
+
+from sqlalchemy import Column, TIMESTAMP, text
+from sqlalchemy.engine import Connection
+from app.migrations import operations as op
+from app.models import CurrentTimestamp
+
+
+def upgrade(connection: Connection):
+    ''' Adds updated_at '''
+    for table_name in ('user', 'may'):
+        op.add_column(connection, table_name, Column(
+            'updated_at', TIMESTAMP(timezone=True), nullable=False,
+            server_default=CurrentTimestamp()
+            ))
+        connection.execute(text(
+            f'UPDATE {op.quote(connection, table_name)} '
+            'SET updated_at = created_at'
+            ))
+
+
+def downgrade(connection: Connection):
+    ''' Drops updated_at '''
+    for table_name in ('user', 'may'):
+        op.drop_column(connection, table_name, 'updated_at')
@@ -0,0 +1,100 @@
+''' Adds the follows and the home timelines: the followers counter of the
+users, whether a May was fanned out, and the index of the Mayz of a user.
+The existing Mayz aren't fanned out, so they're read from the users their
+readers follow, and the newest ones of each user are written to its own
+timeline. '''
+
+from sqlalchemy import (
+    Boolean, Column, ForeignKey, Index, Integer, MetaData, Table, TIMESTAMP,
+    false, func, insert, select
+    )
+from sqlalchemy.engine import Connection
+from app.config import env
+from app.migrations import operations as op
+from app.models import CurrentTimestamp
+
+
+def own_mayz(may: Table, timeline: Table):
+    ''' Returns the statement writing the newest Mayz of each user to its
+    timeline, as posting them would have '''
+    ranked = select(
+        may.c.user_id, may.c.id, may.c.created_at,
+        func.row_number().over(
+            partition_by=may.c.user_id,
+            order_by=(may.c.created_at.desc(), may.c.id.desc())
+            ).label('rank')
+        ).where(may.c.user_id.is_not(None)).subquery()
+    return insert(timeline).from_select(
+        ['user_id', 'may_id', 'created_at'],
+        select(ranked.c.user_id, ranked.c.id, ranked.c.created_at).where(
+            ranked.c.rank <= env.timeline_size
+            )
+        )
+
+
+def upgrade(connection: Connection):
+    ''' Adds the columns, the index and the tables '''
+    op.add_column(connection, 'user', Column(
+        'followers', Integer, nullable=False, server_default='0'
+        ))
+    op.add_column(connection, 'may', Column(
+        'fanned_out', Boolean, nullable=False, server_default=false()
+        ))
+    op.create_index(
+        connection, 'ix_may_user_id_created_at_id', 'may',
+        'user_id', 'created_at', 'id'
+        )
+    metadata = MetaData()
+    # The referenced tables, so the foreign keys can be declared
+    Table('user', metadata, Column('id', Integer, primary_key=True))
+    may = Table(
+        'may', metadata, Column('id', Integer, primary_key=True),
+        Column('user_id', Integer),
+        Column('created_at', TIMESTAMP(timezone=True))
+        )
+    follow = Table(
+        'follow', metadata,
+        Column(
+            'follower_id', Integer,
+            ForeignKey('user.id', ondelete='CASCADE'), primary_key=True
+            ),
+        Column(
+            'followee_id', Integer,
+            ForeignKey('user.id', ondelete='CASCADE'), primary_key=True
+            ),
+        Column(
+            'created_at', TIMESTAMP(timezone=True), nullable=False,
+            server_default=CurrentTimestamp()
+            ),
+        Index('ix_follow_followee_id', 'followee_id'),
+        )
+    timeline = Table(
+        'timeline', metadata,
+        Column(
+            'user_id', Integer,
+            ForeignKey('user.id', ondelete='CASCADE'), primary_key=True
+            ),
+        Column(
+            'may_id', Integer,
+            ForeignKey('may.id', ondelete='CASCADE'), primary_key=True
+            ),
+        Column('created_at', TIMESTAMP(timezone=True), nullable=False),
+        Index(
+            'ix_timeline_user_id_created_at_may_id',
+            'user_id', 'created_at', 'may_id'
+            ),
+        )
+    backfill = not op.has_table(connection, 'timeline')
+    for table in (follow, timeline):
+        op.create_table(connection, table)
+    if backfill:
+        connection.execute(own_mayz(may, timeline))
+
+
+def downgrade(connection: Connection):
+    ''' Drops the tables, the index and the columns '''
+    for table_name in ('timeline', 'follow'):
+        op.drop_table(connection, table_name)
+    op.drop_index(connection, 'may', 'ix_may_user_id_created_at_id')
+    op.drop_column(connection, 'may', 'fanned_out')
+    op.drop_column(connection, 'user', 'followers')
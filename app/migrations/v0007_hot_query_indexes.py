@@ -0,0 +1,20 @@
+''' Indexes the users newest first, for the latest users, and the votes by
+May, for the votes of a May. The Mayz of a user and the newest Mayz are
+already read from ix_may_user_id_created_at_id and ix_may_created_at_id. '''
+
+from sqlalchemy.engine import Connection
+from app.migrations import operations as op
+
+
+def upgrade(connection: Connection):
+    ''' Creates the indexes '''
+    op.create_index(
+        connection, 'ix_user_created_at_id', 'user', 'created_at', 'id'
+        )
+    op.create_index(connection, 'ix_vote_may_id', 'vote', 'may_id')
+
+
+def downgrade(connection: Connection):
+    ''' Drops the indexes '''
+    op.drop_index(connection, 'vote', 'ix_vote_may_id')
+    op.drop_index(connection, 'user', 'ix_user_created_at_id')
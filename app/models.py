@@ -3,12 +3,34 @@
 from datetime import datetime
 from typing import List, Optional
 from pydantic import EmailStr
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
 from sqlmodel import (
-    Field, SQLModel, Column, Boolean, TIMESTAMP, text, Relationship,
-    AutoString
+    Field, SQLModel, Column, Boolean, TIMESTAMP, Relationship, AutoString,
+    Index, Integer, ForeignKey, true, false
     )
 
 
+class CurrentTimestamp(FunctionElement):
+    ''' Server side timestamp of the moment a row is inserted or updated '''
+    type = TIMESTAMP(timezone=True)
+    inherit_cache = True
+
+
+@compiles(CurrentTimestamp)
+def _compile_current_timestamp(*_, **__):
+    ''' Postgres and most databases provide NOW() '''
+    return 'NOW()'
+
+
+@compiles(CurrentTimestamp, 'sqlite')
+def _compile_current_timestamp_sqlite(*_, **__):
+    ''' SQLite has no NOW(), and its CURRENT_TIMESTAMP drops the fractional
+    seconds. It's stored in the same format SQLAlchemy binds datetimes with,
+    so cursors can be compared against it. '''
+    return "strftime('%Y-%m-%d %H:%M:%f000', 'now')"
+
+
 class VoteCreate(SQLModel):
     ''' Represents the data needed to create a new vote '''
     vote_type: int = Field(
@@ -16,8 +38,24 @@ class VoteCreate(SQLModel):
         )
 
 
+class VoteBatchItem(VoteCreate):
+    ''' Represents a vote of a batch, on the May with may_id '''
+    may_id: int
+
+
+class VoteBatchResult(SQLModel):
+    ''' Represents the outcome of a vote of a batch: created, updated,
+    unchanged or not found '''
+    may_id: int
+    vote_type: int
+    status: str
+
+
 class Vote(VoteCreate, table=True):
     ''' Represents a like, composed by a user and a May'''
+    # The votes of a user are read from the primary key, the votes of a May
+    # from this index
+    __table_args__ = (Index('ix_vote_may_id', 'may_id'),)
     user_id: Optional[int] = Field(
         foreign_key="user.id", primary_key=True, nullable=False, default=None
     )
@@ -59,23 +97,41 @@ class UserCreate(SQLModel):
 
 class User(UserCreate, table=True):
     ''' Extends UserCreate and represents a user in the database '''
+    # The latest users are read from this index, newest first
+    __table_args__ = (Index('ix_user_created_at_id', 'created_at', 'id'),)
     id: Optional[int] = Field(primary_key=True, default=None)
     created_at: Optional[datetime] = Field(
         sa_column=Column(
             TIMESTAMP(timezone=True),
             nullable=False,
-            server_default=text('NOW()')
+            server_default=CurrentTimestamp()
+            ),
+        default=None
+        )
+    # Version of the row, bumped on every update. It validates the cached
+    # copies of the user with the ETag and Last-Modified headers.
+    updated_at: Optional[datetime] = Field(
+        sa_column=Column(
+            TIMESTAMP(timezone=True),
+            nullable=False,
+            server_default=CurrentTimestamp(),
+            onupdate=CurrentTimestamp()
             ),
         default=None
         )
     enabled: Optional[bool] = Field(
         sa_column=Column(
             Boolean(create_constraint=True),
-            server_default='TRUE',
+            server_default=true(),
             nullable=False
         ),
         default=None
     )
+    # Denormalized counter of the followers, kept up to date by the follow
+    # routes. It tells whether the Mayz of the user are fanned out.
+    followers: int = Field(
+        default=0, sa_column_kwargs={'server_default': '0'}
+        )
     mayz: List['May'] = Relationship(
         back_populates="user",
         sa_relationship_kwargs={"cascade": "all,delete,delete-orphan"}
@@ -104,6 +160,7 @@ class UserRead(UserRel):
     ''' Extends UserRel and represents the data returned when reading a
     user '''
     created_at: Optional[datetime]
+    followers: Optional[int]
     mayz: Optional[List['MayRel']]
     may_votes: Optional[List['VoteReadMayz']]
 
@@ -116,12 +173,30 @@ class MayCreate(SQLModel):
 
 class May(MayCreate, table=True):
     ''' Extends MayCreate and represents a May in the database '''
+    # Keyset pagination of the Mayz walks this index newest first, and the
+    # Mayz of a user are read from the second one
+    __table_args__ = (
+        Index('ix_may_created_at_id', 'created_at', 'id'),
+        Index('ix_may_user_id_created_at_id', 'user_id', 'created_at', 'id'),
+        )
     id: Optional[int] = Field(primary_key=True, default=None)
     created_at: Optional[datetime] = Field(
         sa_column=Column(
             TIMESTAMP(timezone=True),
             nullable=False,
-            server_default=text('NOW()')
+            server_default=CurrentTimestamp()
+            ),
+        default=None
+        )
+    # Version of the row, bumped on every update, including the updates of
+    # the vote counters. It validates the cached copies of the May with the
+    # ETag and Last-Modified headers.
+    updated_at: Optional[datetime] = Field(
+        sa_column=Column(
+            TIMESTAMP(timezone=True),
+            nullable=False,
+            server_default=CurrentTimestamp(),
+            onupdate=CurrentTimestamp()
             ),
         default=None
         )
@@ -130,6 +205,22 @@ class May(MayCreate, table=True):
         default=None,
         nullable=False
         )
+    # Denormalized vote counters, kept up to date by the vote routes
+    upvotes: int = Field(default=0, sa_column_kwargs={'server_default': '0'})
+    downvotes: int = Field(
+        default=0, sa_column_kwargs={'server_default': '0'}
+        )
+    score: int = Field(default=0, sa_column_kwargs={'server_default': '0'})
+    # Whether the May was written to the timelines of the followers of its
+    # author, if not it's read from the followed users instead
+    fanned_out: Optional[bool] = Field(
+        sa_column=Column(
+            Boolean(create_constraint=True),
+            server_default=false(),
+            nullable=False
+        ),
+        default=None
+    )
     user: User = Relationship(back_populates="mayz")
     user_votes: List['Vote'] = Relationship(back_populates="may")
 
@@ -150,10 +241,78 @@ class MayUpdate(SQLModel):
 class MayRead(MayRel):
     ''' Extends MayRel and represents the data returned when reading a May '''
     created_at: Optional[datetime]
+    upvotes: Optional[int]
+    downvotes: Optional[int]
+    score: Optional[int]
     user: Optional[UserRel]
+
+
+class MayReadVotes(MayRead):
+    ''' Extends MayRead with the votes of the May '''
     user_votes: Optional[List['VoteReadUsers']]
 
 
+class Follow(SQLModel, table=True):
+    ''' Represents a user following another one. The rows go away along with
+    either user. '''
+    # The followers of a user are read from this index when a May is fanned
+    # out, the followed users from the primary key
+    __table_args__ = (Index('ix_follow_followee_id', 'followee_id'),)
+    follower_id: Optional[int] = Field(
+        sa_column=Column(
+            Integer, ForeignKey('user.id', ondelete='CASCADE'),
+            primary_key=True
+            ),
+        default=None
+        )
+    followee_id: Optional[int] = Field(
+        sa_column=Column(
+            Integer, ForeignKey('user.id', ondelete='CASCADE'),
+            primary_key=True
+            ),
+        default=None
+        )
+    created_at: Optional[datetime] = Field(
+        sa_column=Column(
+            TIMESTAMP(timezone=True),
+            nullable=False,
+            server_default=CurrentTimestamp()
+            ),
+        default=None
+        )
+
+
+class Timeline(SQLModel, table=True):
+    ''' Represents a May in the home timeline of a user, written when the May
+    is posted. The rows go away along with the user or the May. '''
+    # A home timeline is read as a single range of this index, newest first
+    __table_args__ = (
+        Index(
+            'ix_timeline_user_id_created_at_may_id',
+            'user_id', 'created_at', 'may_id'
+            ),
+        )
+    user_id: Optional[int] = Field(
+        sa_column=Column(
+            Integer, ForeignKey('user.id', ondelete='CASCADE'),
+            primary_key=True
+            ),
+        default=None
+        )
+    may_id: Optional[int] = Field(
+        sa_column=Column(
+            Integer, ForeignKey('may.id', ondelete='CASCADE'),
+            primary_key=True
+            ),
+        default=None
+        )
+    # Copied from the May, so the timeline is ordered without joining it
+    created_at: Optional[datetime] = Field(
+        sa_column=Column(TIMESTAMP(timezone=True), nullable=False),
+        default=None
+        )
+
+
 class Token(SQLModel):
     ''' Represents a token '''
     access_token: str
@@ -170,4 +329,5 @@ class TokenData(SQLModel):
 # references between the User and May classes.
 UserRead.model_rebuild()
 MayRead.model_rebuild()
+MayReadVotes.model_rebuild()
 VoteRead.model_rebuild()
@@ -7,8 +7,10 @@ from datetime import timezone
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from sqlmodel import Session, select
-from jose import jwt, JWTError
-from app import utils, database as db
+from sqlmodel.ext.asyncio.session import AsyncSession
+from jose import jwt, JWTError, ExpiredSignatureError
+from app import metrics, timing, utils, database as db
+from app.cache import TTLCache
 from app.models import User, TokenData
 from app.config import env
 
@@ -19,29 +21,79 @@ credentials_exception = HTTPException(
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+# Authenticated users by username, so most requests don't query the user
+user_cache = TTLCache(env.user_cache_size, env.user_cache_ttl)
 
 
-def get_current_user(
-    token: Annotated[str, Depends(oauth2_scheme)],
-    session: Annotated[Session, Depends(db.get_session)]
-):
-    ''' Get current user from token and validates credentials '''
+def cache_user(user_in_db: User) -> User:
+    ''' Caches a copy of the user that is not bound to the session it was
+    loaded with, so it can be shared between requests, and returns it. The
+    hash of its password is left out, the routes don't read it from the
+    authenticated user. '''
+    user = User.model_validate({**user_in_db.model_dump(), 'password': ''})
+    user_cache.put(user_in_db.username, user)
+    return user
+
+
+def invalidate_user(*usernames: Optional[str]):
+    ''' Removes the users from the cache, it's called when they're updated or
+    deleted '''
+    user_cache.invalidate(*usernames)
+
+
+def decode_token(token: str) -> TokenData:
+    ''' Decodes the token and returns its data '''
     try:
         # It decodes the token to get the username and email. If the username
         # or email is not found in the token, it raises an exception.
         payload = jwt.decode(token, env.secret_key, algorithms=[env.algorithm])
         username = payload.get("username")
         email = payload.get("email")
-        token_data = TokenData(username=username, email=email)
+        return TokenData(username=username, email=email)
     except JWTError as exc:
+        metrics.jwt_failures.inc(
+            'expired' if isinstance(exc, ExpiredSignatureError) else 'invalid'
+            )
         raise credentials_exception from exc
-    # If the user is not found, it raises an exception. If the user is found,
-    # it returns the user.
-    if user_in_db := session.exec(
-            select(User).where(User.username == token_data.username)
-    ).first():
-        return user_in_db
-    raise credentials_exception
+
+
+def get_current_user(
+    token: Annotated[str, Depends(oauth2_scheme)],
+    session: Annotated[Session, Depends(db.get_session)]
+):
+    ''' Get current user from token and validates credentials '''
+    with timing.measure('auth'):
+        token_data = decode_token(token)
+        if cached_user := user_cache.get(token_data.username):
+            return cached_user
+        # If the user is not found, it raises an exception. If the user is
+        # found, it caches the user and returns the cached copy, like on a
+        # hit.
+        if user_in_db := session.exec(
+                select(User).where(User.username == token_data.username)
+        ).first():
+            return cache_user(user_in_db)
+        raise credentials_exception
+
+
+async def get_current_user_async(
+    token: Annotated[str, Depends(oauth2_scheme)],
+    session: Annotated[AsyncSession, Depends(db.get_async_session)]
+):
+    ''' Get current user from token and validates credentials, with the
+    async database stack '''
+    with timing.measure('auth'):
+        token_data = decode_token(token)
+        if cached_user := user_cache.get(token_data.username):
+            return cached_user
+        # If the user is not found, it raises an exception. If the user is
+        # found, it caches the user and returns the cached copy, like on a
+        # hit.
+        if user_in_db := (await session.exec(
+                select(User).where(User.username == token_data.username)
+        )).first():
+            return cache_user(user_in_db)
+        raise credentials_exception
 
 
 def get_current_active_user(
@@ -54,6 +106,16 @@ def get_current_active_user(
     return current_user
 
 
+async def get_current_active_user_async(
+    current_user: Annotated[User, Depends(get_current_user_async)]
+):
+    ''' Get current user if active, with the async database stack '''
+    # It checks if the user is active.
+    if not current_user.enabled:
+        raise HTTPException(status_code=400, detail="Inactive user")
+    return current_user
+
+
 def create_access_token(data: dict, expire_delta: timedelta | None = None):
     ''' Create access token with expiration time '''
     # It creates a JWT token with the given data and expiration time.
@@ -79,7 +141,22 @@ def authenticate_user(
     # matches the password of the user.
     if not user_in_db:
         return False
-    pwd_match = utils.verify_password(
+    pwd_match = utils.passwords.verify(
+        credentials.password, user_in_db.password)
+    # If the user exists and the passwords match, it returns the user.
+    return user_in_db if pwd_match else False
+
+
+async def authenticate_user_async(
+    user_in_db: Optional[User],
+    credentials: OAuth2PasswordRequestForm
+) -> bool | User:
+    ''' User authentication, from async routes '''
+    # It checks if the user exists and if the password from the credentials
+    # matches the password of the user.
+    if not user_in_db:
+        return False
+    pwd_match = await utils.passwords.verify_async(
         credentials.password, user_in_db.password)
     # If the user exists and the passwords match, it returns the user.
     return user_in_db if pwd_match else False
@@ -0,0 +1,56 @@
+''' Responsible for the keyset (cursor) pagination of list routes.
+A cursor is an opaque token that encodes the (created_at, id) pair of the last
+row of a page, so the next page starts right after it without scanning and
+throwing away the rows of the previous pages. '''
+
+import base64
+import json
+from datetime import datetime
+from fastapi import HTTPException, status
+from sqlmodel import desc, tuple_
+
+
+# Header used to return the cursor of the next page
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+
+invalid_cursor_exception = HTTPException(
+    status_code=status.HTTP_400_BAD_REQUEST,
+    detail="Invalid cursor",
+    )
+
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    ''' Encodes the (created_at, id) pair of a row into an opaque cursor '''
+    payload = json.dumps([created_at.isoformat(), row_id]).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    ''' Decodes an opaque cursor into the (created_at, id) pair of a row '''
+    # The padding is stripped when encoding, so it's restored before decoding
+    padded = cursor + '=' * (-len(cursor) % 4)
+    try:
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(padded))
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (ValueError, TypeError) as exc:
+        raise invalid_cursor_exception from exc
+
+
+def paginate(statement, created_at, row_id, cursor: str, limit: int):
+    ''' Orders the statement newest first and, if a cursor is given, starts
+    it right after the row the cursor points to. One extra row is fetched so
+    the caller can tell whether there is a next page. '''
+    if cursor:
+        last_created_at, last_id = decode_cursor(cursor)
+        statement = statement.where(
+            tuple_(created_at, row_id) < tuple_(last_created_at, last_id)
+        )
+    return statement.order_by(desc(created_at), desc(row_id)).limit(limit + 1)
+
+
+def next_cursor(rows: list, limit: int) -> str | None:
+    ''' Returns the cursor of the next page, or None if it's the last one '''
+    if len(rows) <= limit:
+        return None
+    last = rows[limit - 1]
+    return encode_cursor(last.created_at, last.id)
@@ -0,0 +1,158 @@
+''' Responsible for rate limiting the routes that hash or verify a password,
+so a client can't use up the CPU with bcrypt without being authenticated.
+Every client IP and every username has a token bucket per route, which holds
+up to a number of requests and refills evenly over a period. A request takes
+a token from both of its buckets, and it's rejected with 429 Too Many
+Requests, before any database or bcrypt work, if either is empty.
+
+The buckets live in a store. The default one is in process, so each process
+has its own buckets. A shared one, e.g. on Redis, is set with
+RATE_LIMIT_STORE=package.module:Class, a subclass of BucketStore whose take
+is atomic. Behind a proxy the client IP is the one it forwards, so uvicorn is
+run with --proxy-headers. '''
+
+import importlib
+import math
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Optional
+from fastapi import HTTPException, Request, status
+from app.config import env
+from app import metrics
+
+
+class BucketStore(ABC):
+    ''' Interface of the stores of the token buckets '''
+
+    @abstractmethod
+    def take(self, key: str, capacity: int, period: float) -> float:
+        ''' Takes a token from the bucket of a key, which holds up to
+        capacity tokens and refills them over period seconds. It returns 0 if
+        a token was taken, or else the seconds until there's one. '''
+
+    async def take_async(self, key: str, capacity: int,
+                         period: float) -> float:
+        ''' Takes a token from the bucket of a key, from async routes. A store
+        with a network client overrides it to not block the event loop. '''
+        return self.take(key, capacity, period)
+
+    @abstractmethod
+    def clear(self):
+        ''' Removes every bucket '''
+
+
+class MemoryStore(BucketStore):
+    ''' Token buckets kept in the memory of the process. There are up to
+    max_keys of them, and the least recently used is dropped to make room for
+    a new one, it's most likely refilled and the same as a missing one. '''
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        # Key of every bucket, mapped to its tokens and when it was updated,
+        # the least recently used first
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+        # Sync routes run in a threadpool, so the buckets are guarded by a lock
+        self._lock = threading.Lock()
+
+    def take(self, key: str, capacity: int, period: float) -> float:
+        now = time.monotonic()
+        rate = capacity / period
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+def parse_limit(limit: str) -> Optional[tuple[int, float]]:
+    ''' Parses a limit like 10/60, 10 requests every 60 seconds. An empty
+    limit is no limit. '''
+    if not limit:
+        return None
+    try:
+        capacity, period = limit.split('/')
+        parsed = int(capacity), float(period)
+    except ValueError as exc:
+        raise ValueError(
+            f'Invalid rate limit {limit!r}, expected requests/seconds'
+            ) from exc
+    if parsed[0] <= 0 or parsed[1] <= 0:
+        raise ValueError(f'Invalid rate limit {limit!r}, it must be positive')
+    return parsed
+
+
+# Limits of each route, by the client IP and by the username
+LIMITS = {
+    'login': {
+        'ip': parse_limit(env.rate_limit_login_ip),
+        'username': parse_limit(env.rate_limit_login_username),
+        },
+    'signup': {
+        'ip': parse_limit(env.rate_limit_signup_ip),
+        'username': parse_limit(env.rate_limit_signup_username),
+        },
+    }
+
+
+def get_store() -> BucketStore:
+    ''' Returns the store set in the environment, or the in-process one '''
+    if not env.rate_limit_store or env.rate_limit_store == 'memory':
+        return MemoryStore()
+    module, _, name = env.rate_limit_store.partition(':')
+    return getattr(importlib.import_module(module), name)()
+
+
+# Store of the buckets used by the application, a stand-in can replace it
+store = get_store()
+
+
+def buckets(route: str, request: Request, username: Optional[str]) -> list:
+    ''' Returns the (kind, key, capacity, period) of the buckets a request
+    takes a token from '''
+    identities = {
+        'ip': request.client.host if request.client else 'unknown',
+        'username': (username or '').lower(),
+        }
+    return [
+        (kind, f'{route}:{kind}:{identities[kind]}', *limit)
+        for kind, limit in LIMITS[route].items()
+        if env.rate_limit and limit and identities[kind]
+        ]
+
+
+def too_many_requests(route: str, kind: str, wait: float) -> HTTPException:
+    ''' Returns the exception of a rejected request, and counts it '''
+    metrics.rate_limited.inc(route, kind)
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail="Too many requests, try again later",
+        headers={"Retry-After": str(math.ceil(wait))},
+        )
+
+
+def check(route: str, request: Request, username: Optional[str] = None):
+    ''' Takes a token from the buckets of a request, or raises 429 '''
+    for kind, key, capacity, period in buckets(route, request, username):
+        if wait := store.take(key, capacity, period):
+            raise too_many_requests(route, kind, wait)
+
+
+async def check_async(
+    route: str, request: Request, username: Optional[str] = None
+):
+    ''' Takes a token from the buckets of a request, or raises 429, from
+    async routes '''
+    for kind, key, capacity, period in buckets(route, request, username):
+        if wait := await store.take_async(key, capacity, period):
+            raise too_many_requests(route, kind, wait)
@@ -0,0 +1,89 @@
+""" Responsible for handling the async authentication routes of application.
+They mirror app.routers.auth on the async database stack. """
+
+from typing import Annotated
+
+from fastapi import APIRouter, Depends, HTTPException, Request, status
+from fastapi.security import OAuth2PasswordRequestForm
+from sqlmodel import col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app import database as db
+from app import oauth2, ratelimit, serialization, utils, votebuffer
+from app.models import Token, User, UserRead
+from app.routers.user import user_read_options
+
+# API router
+router = APIRouter(
+    prefix="/login",
+    tags=["Authentication"],
+    route_class=serialization.ModelRoute,
+)
+
+
+# Login
+@router.post("/", status_code=status.HTTP_202_ACCEPTED, response_model=Token)
+async def login_for_access_token(
+    request: Request,
+    form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
+    session: AsyncSession = Depends(db.get_async_session)
+):
+    """Login route"""
+    # Rejects the client if it's over its rate limit, before bcrypt runs
+    await ratelimit.check_async('login', request, form_data.username)
+    # It checks if the username and password from form_data are not None,
+    # gets the user from the database, authenticates the user,
+    # and creates an access token.
+    if form_data.username is None or form_data.password is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid username or password",
+        )
+    # Get user
+    user = (await session.exec(
+        select(User).where(col(User.username) == form_data.username)
+    )).first()
+    # Authenticate user
+    user_auth = await oauth2.authenticate_user_async(user, form_data)
+    if not user_auth or not isinstance(user_auth, User):
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid email or password"
+        )
+    # Rehash the password if it was hashed with another cost
+    if utils.password_needs_update(user_auth.password):
+        user_auth.password = await utils.passwords.hash_async(
+            form_data.password
+        )
+        session.add(user_auth)
+        await session.commit()
+        oauth2.invalidate_user(user_auth.username)
+    # Create access token
+    access_token = oauth2.create_access_token(
+        data={
+            "username": user_auth.username if isinstance(
+                user_auth, User) else '',
+            "email": getattr(user_auth, 'email', '')}
+    )
+    # It returns a dictionary with the access token and the token type.
+    return {"access_token": access_token, "token_type": "bearer"}
+
+
+# Get current user, its queued votes are written first so it reads them
+# back
+@router.get(
+    "/me/", response_model=UserRead,
+    dependencies=[Depends(votebuffer.settle_async)]
+    )
+async def read_users_me(
+    current_user: Annotated[
+        User, Depends(oauth2.get_current_active_user_async)
+    ],
+    session: AsyncSession = Depends(db.get_async_session)
+):
+    """Get current user"""
+    # Returns data of the current user, loaded with the plan of UserRead
+    return await session.get(
+        User, current_user.id, options=user_read_options,
+        populate_existing=True
+    )
@@ -0,0 +1,325 @@
+''' Defines the async routes for user-related operations in the application.
+They mirror app.routers.user on the async database stack. '''
+
+from typing import Annotated, Optional, Union
+from fastapi import (
+    APIRouter, status, HTTPException, Depends, Header, Query, Request,
+    Response
+    )
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
+from sqlmodel import select, or_, col
+from sqlmodel.ext.asyncio.session import AsyncSession
+from app.config import env
+from app.models import May, User, UserCreate, UserRead, UserUpdate
+from app.routers.user import (
+    unauth_exception, forb_exception, self_follow_exception,
+    user_read_options
+    )
+from app import (
+    conditional, latest, utils, oauth2, ratelimit, serialization,
+    streaming, timeline, trending, votebuffer, database as db
+    )
+
+
+router = APIRouter(
+    prefix="/user",
+    tags=["Users"],
+    route_class=serialization.ModelRoute,
+    # The queued votes of the user are written before the routes run, so
+    # it reads them back
+    dependencies=[Depends(votebuffer.settle_async)]
+)
+
+
+@router.post("/", status_code=status.HTTP_201_CREATED, response_model=UserRead)
+async def post_user(
+    *,
+    request: Request,
+    new_user: UserCreate,
+    session: AsyncSession = Depends(db.get_async_session)
+):
+    ''' Route used to create a new user '''
+    # Rejects the client if it's over its rate limit, before bcrypt runs
+    await ratelimit.check_async('signup', request, new_user.username)
+    # Checks if a user with the same username or email already exists in the
+    # database
+    if (await session.exec(
+            select(User).where(or_(
+                    col(User.username) == new_user.username,
+                    col(User.email) == new_user.email
+            ))
+    )).first():
+        # If exists, it raises an exception
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Username/email already exists"
+        )
+    # Hashes the password, creates a new user, and adds it to the database.
+    pwd_hash = await utils.passwords.hash_async(new_user.password)
+    new_user.password = pwd_hash
+    created_user = User.model_validate(
+        new_user, from_attributes=True
+        )
+    session.add(created_user)
+    await session.commit()
+    created_user = await session.get(
+        User, created_user.id, options=user_read_options,
+        populate_existing=True
+        )
+    latest.user_created(created_user)
+    return created_user
+
+
+@router.get("/", response_model=list[UserRead])
+async def get_all_users(
+    *,
+    request: Request,
+    current_user: Annotated[
+        User, Depends(oauth2.get_current_active_user_async)
+        ],
+    session: AsyncSession = Depends(db.get_async_session),
+    stream: streaming.StreamFormat = None
+):
+    ''' Route used to get all users. With stream=ndjson or stream=json, they
+    are streamed as they're read instead. '''
+    # It requires the current user to be authenticated
+    if not current_user:
+        raise unauth_exception
+    # The users are streamed from a server-side cursor, so they aren't all
+    # loaded at once
+    if stream:
+        return streaming.stream_rows_async(
+            request,
+            select(User).options(*user_read_options).order_by(col(User.id)),
+            UserRead, stream
+            )
+    # It fetches all users from the database and returns them
+    if all_users := (await session.exec(
+        select(User).options(*user_read_options)
+    )).all():
+        return all_users
+    # If there are no users, it raises an exception
+    raise HTTPException(
+        status_code=status.HTTP_204_NO_CONTENT,
+        detail="No Users yet")
+
+
+@router.get("/latest/", response_model=Union[UserRead, list[UserRead]])
+async def get_latest_user(
+    current_user: Annotated[
+        User, Depends(oauth2.get_current_active_user_async)
+        ],
+    session: AsyncSession = Depends(db.get_async_session),
+    n: Annotated[Optional[int], Query(gt=0, le=env.latest_size)] = None
+):
+    ''' Route used to get the latest user, or the latest n users with n.
+    They're served from memory. '''
+    # It requires the current user to be authenticated
+    if not current_user:
+        raise unauth_exception
+    # It fetches the latest users and returns them
+    if latest_users := await latest.newest_async(
+        session, latest.users, user_read_options, n or 1
+    ):
+        return latest_users if n else latest_users[0]
+    raise HTTPException(
+        status_code=status.HTTP_204_NO_CONTENT,
+        detail="No Users yet"
+    )
+
+
+@router.get("/{user_id}/", response_model=UserRead)
+async def get_user(
+    user_id: int,
+    current_user: Annotated[
+        User, Depends(oauth2.get_current_active_user_async)
+        ],
+    response: Response,
+    session: AsyncSession = Depends(db.get_async_session),
+    if_none_match: Annotated[Optional[str], Header()] = None,
+    if_modified_since: Annotated[Optional[str], Header()] = None
+):
+    ''' Route is used to get a specific user by their ID. It answers 304 Not
+    Modified if the client already has their current version, from the ETag
+    or Last-Modified headers. '''
+    # It requires the current user to be authenticated
+    if not current_user:
+        raise unauth_exception
+    # It reads the version of the user first, it's cheap and enough to tell
+    # whether the client already has it
+    if version := (await session.exec(
+        conditional.user_version(user_id)
+    )).first():
+        validators = conditional.Validators(version)
+        if validators.matches(if_none_match, if_modified_since):
+            return validators.not_modified()
+        # It fetches the user with the given ID from the database and returns
+        # it
+        if one_user := await session.get(
+            User, user_id, options=user_read_options, populate_existing=True
+        ):
+            validators.apply(response)
+            return one_user
+    # If there is no user with the given ID, it raises an exception
+    raise HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail=f"No User with ID {user_id} found"
+    )
+
+
+@router.put(
+    "/{user_id}/", status_code=status.HTTP_202_ACCEPTED,
+    response_model=UserRead
+)
+async def put_user(
+    user_id: int,
+    user_update: UserUpdate,
+    current_user: Annotated[
+        User, Depends(oauth2.get_current_active_user_async)
+        ],
+    session: AsyncSession = Depends(db.get_async_session)
+):
+    ''' Route used to update a specific user by their ID '''
+    # It requires the current user to be authenticated and to be the same as
+    # the user being updated
+    if current_user.id != user_id:
+        raise forb_exception
+    # Checks if a user with the same username or email already exists in the
+    # database
+    if user_update.username and (await session.exec(
+                select(User).where(col(User.username) == user_update.username)
+    )).first():
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Username already exists"
+            )
+    if user_update.email and (await session.exec(
+            select(User).where(col(User.email) == user_update.email)
+    )).first():
+        # If exists, it raises an exception
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Email already exists"
+            )
+    # If not, it hashes the new password (if provided), updates the user's
+    # details, and saves the changes to the database
+    if user_update.password:
+        pwd_hash = await utils.passwords.hash_async(user_update.password)
+        user_update.password = pwd_hash
+    edited_user = await session.get(User, user_id)
+    old_username = edited_user.username
+    new_user = user_update.model_dump(exclude_unset=True)
+    for key, value in new_user.items():
+        setattr(edited_user, key, value)
+    session.add(edited_user)
+    await session.commit()
+    # The cached user is stale now, even its username may have changed
+    oauth2.invalidate_user(old_username, edited_user.username)
+    latest.user_changed(user_id)
+    return await session.get(
+        User, user_id, options=user_read_options, populate_existing=True
+        )
+
+
+@router.delete("/{user_id}/", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_user(
+    user_id: int,
+    current_user: Annotated[
+        User, Depends(oauth2.get_current_active_user_async)
+        ],
+    session: AsyncSession = Depends(db.get_async_session)
+):
+    ''' Route used to delete a specific user by their ID '''
+    # It requires the current user to be authenticated and to be the same as
+    # the user being deleted
+    if current_user.id != user_id:
+        raise forb_exception
+    # It deletes the user with the given ID from the database. The Mayz and
+    # votes are loaded along with the user, since the ORM updates them too.
+    deleted_user = await session.get(
+        User, user_id, options=(
+            selectinload(User.mayz).selectinload(May.user_votes),
+            selectinload(User.may_votes),
+            ), populate_existing=True
+        )
+    # If there is no user with the given ID, it raises an exception
+    if not deleted_user:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No User with this id {user_id}"
+            )
+    username = deleted_user.username
+    # The users it follows lose a follower, its follows and timeline go away
+    # along with it
+    await session.exec(timeline.forget(user_id))
+    await session.delete(deleted_user)
+    await session.commit()
+    oauth2.invalidate_user(username)
+    latest.user_deleted(user_id)
+    trending.user_deleted()
+
+
+@router.post("/{user_id}/follow/", status_code=status.HTTP_204_NO_CONTENT)
+async def follow_user(
+    user_id: int,
+    current_user: Annotated[
+        User, Depends(oauth2.get_current_active_user_async)
+        ],
+    session: AsyncSession = Depends(db.get_async_session)
+):
+    ''' Route used to follow a specific user by their ID. Their Mayz are
+    added to the home timeline of the current user. '''
+    # It requires the current user to be authenticated and to be another user
+    if not current_user:
+        raise unauth_exception
+    if current_user.id == user_id:
+        raise self_follow_exception
+    # It writes the follow, the followers counter and the newest Mayz of the
+    # user to the timeline
+    try:
+        followed = await timeline.follow_async(
+            session, current_user.id, user_id
+            )
+    # If there is no user with the given ID, the foreign key fails and it
+    # raises an exception
+    except IntegrityError as exc:
+        await session.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No User with ID {user_id} found"
+            ) from exc
+    # If the current user already follows the user, it raises an exception
+    if not followed:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Already following"
+            )
+    await session.commit()
+    latest.followers_changed(user_id)
+
+
+@router.delete("/{user_id}/follow/", status_code=status.HTTP_204_NO_CONTENT)
+async def unfollow_user(
+    user_id: int,
+    current_user: Annotated[
+        User, Depends(oauth2.get_current_active_user_async)
+        ],
+    session: AsyncSession = Depends(db.get_async_session)
+):
+    ''' Route used to stop following a specific user by their ID. Their Mayz
+    are removed from the home timeline of the current user. '''
+    # It requires the current user to be authenticated
+    if not current_user:
+        raise unauth_exception
+    # It deletes the follow, and the Mayz of the user from the timeline
+    if not await timeline.stop_following_async(
+        session, current_user.id, user_id
+    ):
+        # If the current user doesn't follow the user, it raises an exception
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Not following the User with ID {user_id}"
+            )
+    await session.commit()
+    latest.followers_changed(user_id)
@@ -0,0 +1,195 @@
+''' Define the async router for vote-related operations in the application.
+It mirrors app.routers.vote on the async database stack. '''
+
+from typing import Annotated
+from fastapi import (
+    APIRouter, Body, HTTPException, status, Depends, Request
+    )
+from sqlalchemy.exc import IntegrityError, NoResultFound
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from app.config import env
+from app.models import (
+    User, Vote, VoteCreate, VoteRead, VoteBatchItem, VoteBatchResult
+    )
+from app.routers.vote import (
+    unauth_exception, duplicate_exception, batch_conflict_exception,
+    vote_read_options
+    )
+from app import (
+    latest, oauth2, serialization, streaming, trending, votebuffer, votes,
+    database as db
+    )
+
+
+router = APIRouter(
+    prefix="/vote",
+    tags=["Votes"],
+    route_class=serialization.ModelRoute
+)
+
+
+# The queued votes of the user are written first, the batch is written as is
+@router.post(
+    "/batch", response_model=list[VoteBatchResult],
+    dependencies=[Depends(votebuffer.settle_async)]
+    )
+async def post_votes(
+    items: Annotated[
+        list[VoteBatchItem],
+        Body(min_length=1, max_length=env.vote_batch_size)
+        ],
+    current_user: Annotated[
+        User, Depends(oauth2.get_current_active_user_async)
+        ],
+    session: AsyncSession = Depends(db.get_async_session)
+):
+    ''' Route to create or update many Votes at once. It returns whether each
+    vote was created, updated, unchanged or its May was not found. '''
+    # Validate user
+    if not current_user:
+        raise unauth_exception
+    # Every vote of the batch must be on a different May
+    if len({item.may_id for item in items}) < len(items):
+        raise duplicate_exception
+    # It writes the votes and the counters of their Mayz in one transaction
+    try:
+        results = await votes.apply_batch_async(
+            session, current_user.id, items
+            )
+    # If a May is deleted while voting, the foreign key fails and no vote of
+    # the batch is written
+    except IntegrityError as exc:
+        await session.rollback()
+        raise batch_conflict_exception from exc
+    await session.commit()
+    may_ids = [item.may_id for item in items]
+    latest.votes_changed(current_user.id, *may_ids)
+    trending.votes_changed(*may_ids)
+    return results
+
+
+@router.post(
+    "/{may_id}", status_code=status.HTTP_201_CREATED, response_model=VoteRead
+    )
+async def post_vote(
+    may_id: int,
+    create_vote: VoteCreate,
+    current_user: Annotated[
+        User, Depends(oauth2.get_current_active_user_async)
+        ],
+    session: AsyncSession = Depends(db.get_async_session)
+):
+    ''' Route to create a Vote, if already exist, it tries to update.
+    Upvote, downvote, or neutral vote. '''
+    # Validate user
+    if not current_user:
+        raise unauth_exception
+    # It creates the vote, or updates it if the user already voted the May,
+    # along with the counters of the May. With the vote buffer, the vote is
+    # queued and written later instead.
+    try:
+        if env.vote_buffer:
+            upserted = await votebuffer.queue_async(
+                session, current_user, may_id, create_vote.vote_type
+                )
+        else:
+            upserted = await votes.upsert_vote_async(
+                session, current_user.id, may_id, create_vote.vote_type
+                )
+    # If there is no May with that id, the foreign key fails, or it isn't
+    # found for the buffer, and it raises an exception
+    except (IntegrityError, NoResultFound) as exc:
+        await session.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No May with ID {may_id} found"
+            ) from exc
+    # If the user tries to put the same vote, it raises an exception
+    if upserted is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Vote already exists"
+        )
+    await session.commit()
+    # The caches are marked once the queued votes are written
+    if not env.vote_buffer:
+        latest.votes_changed(current_user.id, may_id)
+        trending.votes_changed(may_id)
+    may, _ = upserted
+    return {
+        'user': current_user, 'may': may, 'vote_type': create_vote.vote_type
+        }
+
+
+# The queued votes of the user are written first, so it reads them back
+@router.get(
+    "/all", response_model=list[VoteRead],
+    dependencies=[Depends(votebuffer.settle_async)]
+    )
+async def get_all_votes(
+    *,
+    request: Request,
+    current_user: Annotated[
+        User, Depends(oauth2.get_current_active_user_async)
+        ],
+    session: AsyncSession = Depends(db.get_async_session),
+    stream: streaming.StreamFormat = None
+):
+    ''' Route to get all Votes. With stream=ndjson or stream=json, they are
+    streamed as they're read instead. '''
+    # Validate user
+    if not current_user:
+        raise unauth_exception
+    # The Votes are streamed from a server-side cursor, so they aren't all
+    # loaded at once
+    if stream:
+        return streaming.stream_rows_async(
+            request,
+            select(Vote).options(*vote_read_options),
+            VoteRead, stream
+            )
+    # It gets all Votes
+    if all_votes := (await session.exec(
+        select(Vote).options(*vote_read_options)
+    )).all():
+        return all_votes
+    # If there are no Votes, it raises an exception
+    raise HTTPException(
+        status_code=status.HTTP_204_NO_CONTENT,
+        detail="No Votes yet"
+        )
+
+
+@router.delete("/{may_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_vote(
+    may_id: int,
+    current_user: Annotated[
+        User, Depends(oauth2.get_current_active_user_async)
+        ],
+    session: AsyncSession = Depends(db.get_async_session)
+):
+    ''' Route to delete a specific Vote '''
+    # Validate user
+    if not current_user:
+        raise unauth_exception
+    # With the vote buffer, the removal of the vote is queued, if the user
+    # voted the May
+    if env.vote_buffer:
+        if not await votebuffer.unqueue_async(session, current_user, may_id):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"No vote with this user_id or may_id {may_id}"
+            )
+        return
+    # It deletes the Vote with the may id and current user id, and updates
+    # the counters of the May, once the May is locked
+    if not await votes.remove_vote_async(session, current_user.id, may_id):
+        # If there is no Vote with that may_id/user_id, it raises an exception
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No vote with this user_id or may_id {may_id}"
+        )
+    await session.commit()
+    latest.votes_changed(current_user.id, may_id)
+    trending.votes_changed(may_id)
@@ -2,25 +2,33 @@
 
 from typing import Annotated
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlmodel import Session, col, select
 
 from app import database as db
-from app import oauth2
+from app import oauth2, ratelimit, serialization, utils, votebuffer
 from app.models import Token, User, UserRead
+from app.routers.user import user_read_options
 
 # API router
-router = APIRouter(prefix="/login", tags=["Authentication"])
+router = APIRouter(
+    prefix="/login",
+    tags=["Authentication"],
+    route_class=serialization.ModelRoute,
+)
 
 
 # Login
 @router.post("/", status_code=status.HTTP_202_ACCEPTED, response_model=Token)
 def login_for_access_token(
+    request: Request,
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
     session: Session = Depends(db.get_session)
 ):
     """Login route"""
+    # Rejects the client if it's over its rate limit, before bcrypt runs
+    ratelimit.check('login', request, form_data.username)
     # It checks if the username and password from form_data are not None,
     # gets the user from the database, authenticates the user,
     # and creates an access token.
@@ -40,6 +48,12 @@ def login_for_access_token(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid email or password"
         )
+    # Rehash the password if it was hashed with another cost
+    if utils.password_needs_update(user_auth.password):
+        user_auth.password = utils.passwords.hash(form_data.password)
+        session.add(user_auth)
+        session.commit()
+        oauth2.invalidate_user(user_auth.username)
     # Create access token
     access_token = oauth2.create_access_token(
         data={
@@ -51,11 +65,19 @@ def login_for_access_token(
     return {"access_token": access_token, "token_type": "bearer"}
 
 
-# Get current user
-@router.get("/me/", response_model=UserRead)
+# Get current user, its queued votes are written first so it reads them
+# back
+@router.get(
+    "/me/", response_model=UserRead,
+    dependencies=[Depends(votebuffer.settle)]
+    )
 def read_users_me(
-    current_user: Annotated[User, Depends(oauth2.get_current_active_user)]
+    current_user: Annotated[User, Depends(oauth2.get_current_active_user)],
+    session: Session = Depends(db.get_session)
 ):
     """Get current user"""
-    # Returns data of the current user
-    return current_user
+    # Returns data of the current user, loaded with the plan of UserRead
+    return session.get(
+        User, current_user.id, options=user_read_options,
+        populate_existing=True
+        )
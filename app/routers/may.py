@@ -1,10 +1,20 @@
 ''' Defines the routes for May-related operations in the application. '''
 
-from typing import Annotated
-from fastapi import APIRouter, status, HTTPException, Depends
-from sqlmodel import Session, select, column, col, desc
-from app.models import May, MayCreate, MayRead, MayUpdate, User
-from app import oauth2, database as db
+from typing import Annotated, Optional, Union
+from fastapi import (
+    APIRouter, status, HTTPException, Depends, Header, Query, Request,
+    Response
+    )
+from sqlalchemy.orm import joinedload, selectinload
+from sqlmodel import Session, select, col, desc
+from app.config import env
+from app.models import (
+    May, MayCreate, MayRead, MayReadVotes, MayUpdate, User, Vote
+    )
+from app import (
+    conditional, latest, oauth2, pagination, serialization, streaming,
+    timeline, trending, votebuffer, search as fts, database as db
+    )
 
 
 unauth_exception = HTTPException(
@@ -21,7 +31,22 @@ forb_exception = HTTPException(
 
 router = APIRouter(
     prefix="/may",
-    tags=["Mayz"]
+    tags=["Mayz"],
+    route_class=serialization.ModelRoute,
+    # The queued votes of the user are written before the routes run, so
+    # it reads them back
+    dependencies=[Depends(votebuffer.settle)]
+    )
+
+# Loading plans of MayRead and MayReadVotes, so their relationships are
+# loaded along with the Mayz in a fixed number of queries instead of one query
+# per relationship
+may_read_options = (
+    joinedload(May.user),
+    )
+may_read_votes_options = (
+    *may_read_options,
+    selectinload(May.user_votes).joinedload(Vote.user),
     )
 
 
@@ -40,33 +65,58 @@ def post_may(
     # current_user
     new_may = May.model_validate(create_may, from_attributes=True)
     new_may.user_id = current_user.id
-    session.add(new_may)
+    # It's written to the timelines of the followers along with the May
+    timeline.post(session, new_may)
     session.commit()
     session.refresh(new_may)
+    fts.backend.add(new_may)
+    latest.may_created(new_may)
+    trending.may_created(new_may)
     return new_may
 
 
 @router.get("/all/", response_model=list[MayRead])
 def get_all_mayz(
     *,
+    request: Request,
     current_user: Annotated[User, Depends(oauth2.get_current_active_user)],
     session: Session = Depends(db.get_session),
-    limit: int = 100,
-    skip: int = 0,
-    search: str = ''
+    response: Response,
+    limit: Annotated[int, Query(gt=0)] = 100,
+    cursor: str = '',
+    skip: Annotated[int, Query(ge=0, deprecated=True)] = 0,
+    search: str = '',
+    stream: streaming.StreamFormat = None
 ):
-    ''' Route to get all Mays '''
+    ''' Route to get all Mays, newest first. The cursor of the next page is
+    returned in the X-Next-Cursor header. With stream=ndjson or stream=json,
+    every May is streamed as it's read instead of a page. '''
     # Validate user
     if not current_user:
         raise unauth_exception
-    # It gets all Mays that match the search string, skips the first skip Mays,
-    # limits the result to limit Mays, and returns them.
-    if all_mayz := session.exec(
-        select(May).where(
-            column('title').regexp_match(search, 'i')
-        ).offset(skip).limit(limit)
-    ).all():
-        return all_mayz
+    # It gets all Mays that match the search string
+    statement = select(May).options(*may_read_options)
+    if search:
+        statement = statement.where(fts.backend.where(search))
+    # The Mayz are streamed from a server-side cursor, without pages
+    if stream:
+        return streaming.stream_rows(
+            request,
+            statement.order_by(desc(May.created_at), desc(May.id)),
+            MayRead, stream
+            )
+    # Skip is deprecated and only used when no cursor is given, since deep
+    # offsets make the database scan every previous row
+    if skip and not cursor:
+        statement = statement.offset(skip)
+    # It starts right after the cursor, limits the result to limit Mays, and
+    # returns them along with the cursor of the next page.
+    if all_mayz := session.exec(pagination.paginate(
+        statement, col(May.created_at), col(May.id), cursor, limit
+    )).all():
+        if next_cursor := pagination.next_cursor(all_mayz, limit):
+            response.headers[pagination.NEXT_CURSOR_HEADER] = next_cursor
+        return all_mayz[:limit]
     # If there are no Mays, it raises an exception
     raise HTTPException(
         status_code=status.HTTP_204_NO_CONTENT,
@@ -88,6 +138,7 @@ def get_my_mayz(
     # them.
     if all_mayz := session.exec(
         select(May).where(col(May.user_id) == current_user.id)
+        .options(*may_read_options)
     ).all():
         return all_mayz
     raise HTTPException(
@@ -96,21 +147,105 @@ def get_my_mayz(
         )
 
 
-@router.get("/latest/", response_model=MayRead)
+@router.get("/search/", response_model=list[MayRead])
+def search_mayz(
+    *,
+    current_user: Annotated[User, Depends(oauth2.get_current_active_user)],
+    session: Session = Depends(db.get_session),
+    q: Annotated[str, Query(min_length=1)],
+    limit: Annotated[int, Query(gt=0)] = 100
+):
+    ''' Route to search the Mays by title and content, best ranked first '''
+    # Validate user
+    if not current_user:
+        raise unauth_exception
+    # It gets the Mays that contain every word of q, ranked by relevance.
+    if found_mayz := session.exec(
+        fts.backend.search(q, limit).options(*may_read_options)
+    ).all():
+        return found_mayz
+    # If there are no matching Mays, it raises an exception
+    raise HTTPException(
+        status_code=status.HTTP_204_NO_CONTENT,
+        detail="No Mayz found"
+        )
+
+
+@router.get("/timeline/", response_model=list[MayRead])
+def get_timeline(
+    *,
+    current_user: Annotated[User, Depends(oauth2.get_current_active_user)],
+    session: Session = Depends(db.get_session),
+    response: Response,
+    limit: Annotated[int, Query(gt=0)] = 100,
+    cursor: str = ''
+):
+    ''' Route to get the home timeline of the current user: their Mayz and
+    the Mayz of the users they follow, newest first. The cursor of the next
+    page is returned in the X-Next-Cursor header. '''
+    # Validate user
+    if not current_user:
+        raise unauth_exception
+    # It reads the page from the timeline of the user, along with the Mayz of
+    # the followed users that have too many followers to be fanned out
+    if home_mayz := session.exec(
+        timeline.home(current_user.id, cursor, limit).options(
+            *may_read_options
+            )
+    ).all():
+        if next_cursor := pagination.next_cursor(home_mayz, limit):
+            response.headers[pagination.NEXT_CURSOR_HEADER] = next_cursor
+        return home_mayz[:limit]
+    # If the timeline is empty, it raises an exception
+    raise HTTPException(
+        status_code=status.HTTP_204_NO_CONTENT,
+        detail="No Mayz yet"
+        )
+
+
+@router.get("/trending/", response_model=list[MayRead])
+def get_trending_mayz(
+    *,
+    current_user: Annotated[User, Depends(oauth2.get_current_active_user)],
+    session: Session = Depends(db.get_session),
+    limit: Annotated[int, Query(gt=0, le=env.trending_size)] = 10
+):
+    ''' Route to get the trending Mays, hottest first: the ones with the
+    best score for their age. The ranking is kept in memory and refreshed in
+    the background. '''
+    # Validate user
+    if not current_user:
+        raise unauth_exception
+    # It gets the hottest Mayz from the ranking, and reads them by their ids
+    may_ids = trending.board.top(limit)
+    if may_ids and (trending_mayz := session.exec(
+        trending.mayz(may_ids, may_read_options)
+    ).all()):
+        return trending.ranked(may_ids, trending_mayz)
+    # If there are no recent Mays, it raises an exception
+    raise HTTPException(
+        status_code=status.HTTP_204_NO_CONTENT,
+        detail="No trending Mayz yet"
+        )
+
+
+@router.get("/latest/", response_model=Union[MayRead, list[MayRead]])
 def get_latest_may(
     *,
     current_user: Annotated[User, Depends(oauth2.get_current_active_user)],
-    session: Session = Depends(db.get_session)
+    session: Session = Depends(db.get_session),
+    n: Annotated[Optional[int], Query(gt=0, le=env.latest_size)] = None
 ):
-    ''' Route to get the latest May '''
+    ''' Route to get the latest May, or the latest n Mayz with n. They're
+    served from memory. '''
     # Validate user
     if not current_user:
         raise unauth_exception
-    # It gets the latest May by created_at and returns it.
-    if latest_may := session.exec(
-        select(May).order_by(desc(May.created_at))
-    ).first():
-        return latest_may
+    # It gets the latest Mayz by created_at and returns them.
+    if latest_mayz := latest.newest(
+        session, latest.mayz, may_read_options, n or 1
+    ):
+        return latest_mayz if n else latest_mayz[0]
     # If there are no Mays, it raises an exception
     raise HTTPException(
         status_code=status.HTTP_204_NO_CONTENT,
@@ -118,19 +253,33 @@ def get_latest_may(
         )
 
 
-@router.get("/{may_id}/", response_model=MayRead)
+@router.get("/{may_id}/", response_model=MayReadVotes)
 def get_may(
     may_id: int,
     current_user: Annotated[User, Depends(oauth2.get_current_active_user)],
-    session: Session = Depends(db.get_session)
+    response: Response,
+    session: Session = Depends(db.get_session),
+    if_none_match: Annotated[Optional[str], Header()] = None,
+    if_modified_since: Annotated[Optional[str], Header()] = None
 ):
-    ''' Route to get a specific May '''
+    ''' Route to get a specific May. It answers 304 Not Modified if the
+    client already has its current version, from the ETag or Last-Modified
+    headers. '''
     # Validate user
     if not current_user:
         raise unauth_exception
-    # It gets the May with the id may_id and returns it.
-    if one_may := session.get(May, may_id):
-        return one_may
+    # It reads the version of the May first, it's cheap and enough to tell
+    # whether the client already has it
+    if version := session.exec(conditional.may_version(may_id)).first():
+        validators = conditional.Validators(version)
+        if validators.matches(if_none_match, if_modified_since):
+            return validators.not_modified()
+        # It gets the May with the id may_id and returns it.
+        if one_may := session.get(
+            May, may_id, options=may_read_votes_options
+        ):
+            validators.apply(response)
+            return one_may
     # If there is no May with that id, it raises an exception
     raise HTTPException(
         status_code=status.HTTP_404_NOT_FOUND,
@@ -168,7 +317,11 @@ def put_may(
         setattr(edited_may, key, value)
     session.add(edited_may)
     session.commit()
-    session.refresh(edited_may)
+    edited_may = session.get(
+        May, may_id, options=may_read_options, populate_existing=True
+        )
+    fts.backend.add(edited_may)
+    latest.may_changed(may_id)
     return edited_may
 
 
@@ -196,3 +349,6 @@ def delete_may(
     # It deletes the May and returns nothing.
     session.delete(deleted_may)
     session.commit()
+    fts.backend.remove(may_id)
+    latest.may_deleted(may_id)
+    trending.may_deleted(may_id)
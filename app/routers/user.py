@@ -1,11 +1,20 @@
 # pylint: disable=E1101
 ''' Defines the routes for user-related operations in the application. '''
 
-from typing import Annotated
-from fastapi import APIRouter, status, HTTPException, Depends
-from sqlmodel import Session, select, or_, col, desc
-from app.models import User, UserCreate, UserRead, UserUpdate
-from app import utils, oauth2, database as db
+from typing import Annotated, Optional, Union
+from fastapi import (
+    APIRouter, status, HTTPException, Depends, Header, Query, Request,
+    Response
+    )
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
+from sqlmodel import Session, select, or_, col
+from app.config import env
+from app.models import User, UserCreate, UserRead, UserUpdate, Vote
+from app import (
+    conditional, latest, utils, oauth2, ratelimit, serialization,
+    streaming, timeline, trending, votebuffer, database as db
+    )
 
 
 unauth_exception = HTTPException(
@@ -20,19 +29,38 @@ forb_exception = HTTPException(
     headers={"WWW-Authenticate": "Bearer"},
     )
 
+self_follow_exception = HTTPException(
+    status_code=status.HTTP_400_BAD_REQUEST,
+    detail="Users can't follow themselves",
+    )
+
 router = APIRouter(
     prefix="/user",
-    tags=["Users"]
+    tags=["Users"],
+    route_class=serialization.ModelRoute,
+    # The queued votes of the user are written before the routes run, so
+    # it reads them back
+    dependencies=[Depends(votebuffer.settle)]
 )
 
+# Loading plan of UserRead, so its relationships are loaded along with the
+# users in a fixed number of queries instead of one query per relationship
+user_read_options = (
+    selectinload(User.mayz),
+    selectinload(User.may_votes).joinedload(Vote.may),
+    )
+
 
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=UserRead)
 def post_user(
     *,
+    request: Request,
     new_user: UserCreate,
     session: Session = Depends(db.get_session)
 ):
     ''' Route used to create a new user '''
+    # Rejects the client if it's over its rate limit, before bcrypt runs
+    ratelimit.check('signup', request, new_user.username)
     # Checks if a user with the same username or email already exists in the
     # database
     if session.exec(
@@ -47,7 +75,7 @@ def post_user(
             detail="Username/email already exists"
         )
     # Hashes the password, creates a new user, and adds it to the database.
-    pwd_hash = utils.get_password_hash(new_user.password)
+    pwd_hash = utils.passwords.hash(new_user.password)
     new_user.password = pwd_hash
     created_user = User.model_validate(
         new_user, from_attributes=True
@@ -55,21 +83,35 @@ def post_user(
     session.add(created_user)
     session.commit()
     session.refresh(created_user)
+    latest.user_created(created_user)
     return created_user
 
 
 @router.get("/", response_model=list[UserRead])
 def get_all_users(
     *,
+    request: Request,
     current_user: Annotated[User, Depends(oauth2.get_current_active_user)],
-    session: Session = Depends(db.get_session)
+    session: Session = Depends(db.get_session),
+    stream: streaming.StreamFormat = None
 ):
-    ''' Route used to get all users '''
+    ''' Route used to get all users. With stream=ndjson or stream=json, they
+    are streamed as they're read instead. '''
     # It requires the current user to be authenticated
     if not current_user:
         raise unauth_exception
+    # The users are streamed from a server-side cursor, so they aren't all
+    # loaded at once
+    if stream:
+        return streaming.stream_rows(
+            request,
+            select(User).options(*user_read_options).order_by(col(User.id)),
+            UserRead, stream
+            )
     # It fetches all users from the database and returns them
-    if all_users := session.exec(select(User)).all():
+    if all_users := session.exec(
+        select(User).options(*user_read_options)
+    ).all():
         return all_users
     # If there are no users, it raises an exception
     raise HTTPException(
@@ -77,20 +119,22 @@ def get_all_users(
         detail="No Users yet")
 
 
-@router.get("/latest/", response_model=UserRead)
+@router.get("/latest/", response_model=Union[UserRead, list[UserRead]])
 def get_latest_user(
     current_user: Annotated[User, Depends(oauth2.get_current_active_user)],
-    session: Session = Depends(db.get_session)
+    session: Session = Depends(db.get_session),
+    n: Annotated[Optional[int], Query(gt=0, le=env.latest_size)] = None
 ):
-    ''' Route used to get the latest user '''
+    ''' Route used to get the latest user, or the latest n users with n.
+    They're served from memory. '''
     # It requires the current user to be authenticated
     if not current_user:
         raise unauth_exception
-    # It fetches the latest user from the database and returns it
-    if latest_user := session.exec(
-        select(User).order_by(desc(User.created_at))
-    ).first():
-        return latest_user
+    # It fetches the latest users and returns them
+    if latest_users := latest.newest(
+        session, latest.users, user_read_options, n or 1
+    ):
+        return latest_users if n else latest_users[0]
     raise HTTPException(
         status_code=status.HTTP_204_NO_CONTENT,
         detail="No Users yet"
@@ -101,15 +145,30 @@ def get_latest_user(
 def get_user(
     user_id: int,
     current_user: Annotated[User, Depends(oauth2.get_current_active_user)],
-    session: Session = Depends(db.get_session)
+    response: Response,
+    session: Session = Depends(db.get_session),
+    if_none_match: Annotated[Optional[str], Header()] = None,
+    if_modified_since: Annotated[Optional[str], Header()] = None
 ):
-    ''' Route is used to get a specific user by their ID '''
+    ''' Route is used to get a specific user by their ID. It answers 304 Not
+    Modified if the client already has their current version, from the ETag
+    or Last-Modified headers. '''
     # It requires the current user to be authenticated
     if not current_user:
         raise unauth_exception
-    # It fetches the user with the given ID from the database and returns it
-    if one_user := session.get(User, user_id):
-        return one_user
+    # It reads the version of the user first, it's cheap and enough to tell
+    # whether the client already has it
+    if version := session.exec(conditional.user_version(user_id)).first():
+        validators = conditional.Validators(version)
+        if validators.matches(if_none_match, if_modified_since):
+            return validators.not_modified()
+        # It fetches the user with the given ID from the database and returns
+        # it
+        if one_user := session.get(
+            User, user_id, options=user_read_options, populate_existing=True
+        ):
+            validators.apply(response)
+            return one_user
     # If there is no user with the given ID, it raises an exception
     raise HTTPException(
         status_code=status.HTTP_404_NOT_FOUND,
@@ -152,16 +211,21 @@ def put_user(
     # If not, it hashes the new password (if provided), updates the user's
     # details, and saves the changes to the database
     if user_update.password:
-        pwd_hash = utils.get_password_hash(user_update.password)
+        pwd_hash = utils.passwords.hash(user_update.password)
         user_update.password = pwd_hash
     edited_user = session.get(User, user_id)
+    old_username = edited_user.username
     new_user = user_update.model_dump(exclude_unset=True)
     for key, value in new_user.items():
         setattr(edited_user, key, value)
     session.add(edited_user)
     session.commit()
-    session.refresh(edited_user)
-    return edited_user
+    # The cached user is stale now, even its username may have changed
+    oauth2.invalidate_user(old_username, edited_user.username)
+    latest.user_changed(user_id)
+    return session.get(
+        User, user_id, options=user_read_options, populate_existing=True
+        )
 
 
 @router.delete("/{user_id}/", status_code=status.HTTP_204_NO_CONTENT)
@@ -183,5 +247,69 @@ def delete_user(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"No User with this id {user_id}"
             )
+    username = deleted_user.username
+    # The users it follows lose a follower, its follows and timeline go away
+    # along with it
+    session.exec(timeline.forget(user_id))
     session.delete(deleted_user)
     session.commit()
+    oauth2.invalidate_user(username)
+    latest.user_deleted(user_id)
+    trending.user_deleted()
+
+
+@router.post("/{user_id}/follow/", status_code=status.HTTP_204_NO_CONTENT)
+def follow_user(
+    user_id: int,
+    current_user: Annotated[User, Depends(oauth2.get_current_active_user)],
+    session: Session = Depends(db.get_session)
+):
+    ''' Route used to follow a specific user by their ID. Their Mayz are
+    added to the home timeline of the current user. '''
+    # It requires the current user to be authenticated and to be another user
+    if not current_user:
+        raise unauth_exception
+    if current_user.id == user_id:
+        raise self_follow_exception
+    # It writes the follow, the followers counter and the newest Mayz of the
+    # user to the timeline
+    try:
+        followed = timeline.follow(session, current_user.id, user_id)
+    # If there is no user with the given ID, the foreign key fails and it
+    # raises an exception
+    except IntegrityError as exc:
+        session.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No User with ID {user_id} found"
+            ) from exc
+    # If the current user already follows the user, it raises an exception
+    if not followed:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Already following"
+            )
+    session.commit()
+    latest.followers_changed(user_id)
+
+
+@router.delete("/{user_id}/follow/", status_code=status.HTTP_204_NO_CONTENT)
+def unfollow_user(
+    user_id: int,
+    current_user: Annotated[User, Depends(oauth2.get_current_active_user)],
+    session: Session = Depends(db.get_session)
+):
+    ''' Route used to stop following a specific user by their ID. Their Mayz
+    are removed from the home timeline of the current user. '''
+    # It requires the current user to be authenticated
+    if not current_user:
+        raise unauth_exception
+    # It deletes the follow, and the Mayz of the user from the timeline
+    if not timeline.stop_following(session, current_user.id, user_id):
+        # If the current user doesn't follow the user, it raises an exception
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Not following the User with ID {user_id}"
+            )
+    session.commit()
+    latest.followers_changed(user_id)
@@ -1,10 +1,20 @@
 ''' Define the router for vote-related operations in the application. '''
 
-from typing import Annotated, Optional
-from fastapi import APIRouter, HTTPException, status, Depends
-from sqlmodel import Session, select, col
-from app.models import User, Vote, VoteCreate, VoteRead, May
-from app import oauth2, database as db
+from typing import Annotated
+from fastapi import (
+    APIRouter, Body, HTTPException, status, Depends, Request
+    )
+from sqlalchemy.exc import IntegrityError, NoResultFound
+from sqlalchemy.orm import joinedload
+from sqlmodel import Session, select
+from app.config import env
+from app.models import (
+    User, Vote, VoteCreate, VoteRead, VoteBatchItem, VoteBatchResult
+    )
+from app import (
+    latest, oauth2, serialization, streaming, trending, votebuffer, votes,
+    database as db
+    )
 
 
 unauth_exception = HTTPException(
@@ -19,11 +29,65 @@ forb_exception = HTTPException(
     headers={"WWW-Authenticate": "Bearer"},
     )
 
+duplicate_exception = HTTPException(
+    status_code=status.HTTP_400_BAD_REQUEST,
+    detail="A May can only be voted once per batch",
+    )
+
+batch_conflict_exception = HTTPException(
+    status_code=status.HTTP_409_CONFLICT,
+    detail="The Mayz changed while voting, try again",
+    )
+
 router = APIRouter(
     prefix="/vote",
-    tags=["Votes"]
+    tags=["Votes"],
+    route_class=serialization.ModelRoute
 )
 
+# Loading plan of VoteRead, so the user and May of every vote are joined in
+# the same query instead of two queries per vote
+vote_read_options = (
+    joinedload(Vote.user),
+    joinedload(Vote.may),
+    )
+
+
+# The queued votes of the user are written first, the batch is written as is
+@router.post(
+    "/batch", response_model=list[VoteBatchResult],
+    dependencies=[Depends(votebuffer.settle)]
+    )
+def post_votes(
+    items: Annotated[
+        list[VoteBatchItem],
+        Body(min_length=1, max_length=env.vote_batch_size)
+        ],
+    current_user: Annotated[User, Depends(oauth2.get_current_active_user)],
+    session: Session = Depends(db.get_session)
+):
+    ''' Route to create or update many Votes at once. It returns whether each
+    vote was created, updated, unchanged or its May was not found. '''
+    # Validate user
+    if not current_user:
+        raise unauth_exception
+    # Every vote of the batch must be on a different May
+    if len({item.may_id for item in items}) < len(items):
+        raise duplicate_exception
+    # It writes the votes and the counters of their Mayz in one transaction
+    try:
+        results = votes.apply_batch(session, current_user.id, items)
+    # If a May is deleted while voting, the foreign key fails and no vote of
+    # the batch is written
+    except IntegrityError as exc:
+        session.rollback()
+        raise batch_conflict_exception from exc
+    session.commit()
+    may_ids = [item.may_id for item in items]
+    latest.votes_changed(current_user.id, *may_ids)
+    trending.votes_changed(*may_ids)
+    return results
+
 
 @router.post(
     "/{may_id}", status_code=status.HTTP_201_CREATED, response_model=VoteRead
@@ -39,57 +103,72 @@ def post_vote(
     # Validate user
     if not current_user:
         raise unauth_exception
-    # It gets the May with the id may_id
-    edited_may: Optional[May] = session.get(May, may_id)
-    # If there is no May with that id, it raises an exception
-    if not edited_may:
+    # It creates the vote, or updates it if the user already voted the May,
+    # along with the counters of the May. With the vote buffer, the vote is
+    # queued and written later instead.
+    try:
+        if env.vote_buffer:
+            upserted = votebuffer.queue(
+                session, current_user, may_id, create_vote.vote_type
+                )
+        else:
+            upserted = votes.upsert_vote(
+                session, current_user.id, may_id, create_vote.vote_type
+                )
+    # If there is no May with that id, the foreign key fails, or it isn't
+    # found for the buffer, and it raises an exception
+    except (IntegrityError, NoResultFound) as exc:
+        session.rollback()
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"No May with ID {may_id} found"
-            )
-    # Checks if a vote with the same username and may already exists in the
-    # database
-    if vote_in_db := session.exec(
-            select(Vote).where(
-                col(Vote.user_id) == current_user.id,
-                col(Vote.may_id) == may_id
-            )
-    ).first():
-        # If exists and user tries to put the same vote, it raises an exception
-        if vote_in_db.vote_type == create_vote.vote_type:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Vote already exists"
-            )
-        # If vote exists but user tries to change the vote, it updates the vote
-        vote_in_db.vote_type = create_vote.vote_type
-        session.add(vote_in_db)
-        session.commit()
-        session.refresh(vote_in_db)
-        return vote_in_db
-    # If vote doesn't exists, it creates a new Vote with the data from may_id
-    # and the user_id of current_user
-    new_vote = Vote.model_validate(create_vote, from_attributes=True)
-    new_vote.user_id = current_user.id
-    new_vote.may_id = may_id
-    session.add(new_vote)
+            ) from exc
+    # If the user tries to put the same vote, it raises an exception
+    if upserted is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Vote already exists"
+        )
     session.commit()
-    session.refresh(new_vote)
-    return new_vote
+    # The caches are marked once the queued votes are written
+    if not env.vote_buffer:
+        latest.votes_changed(current_user.id, may_id)
+        trending.votes_changed(may_id)
+    may, _ = upserted
+    return {
+        'user': current_user, 'may': may, 'vote_type': create_vote.vote_type
+        }
 
 
-@router.get("/all", response_model=list[VoteRead])
+# The queued votes of the user are written first, so it reads them back
+@router.get(
+    "/all", response_model=list[VoteRead],
+    dependencies=[Depends(votebuffer.settle)]
+    )
 def get_all_votes(
     *,
+    request: Request,
     current_user: Annotated[User, Depends(oauth2.get_current_active_user)],
-    session: Session = Depends(db.get_session)
+    session: Session = Depends(db.get_session),
+    stream: streaming.StreamFormat = None
 ):
-    ''' Route to get all Votes '''
+    ''' Route to get all Votes. With stream=ndjson or stream=json, they are
+    streamed as they're read instead. '''
     # Validate user
     if not current_user:
         raise unauth_exception
+    # The Votes are streamed from a server-side cursor, so they aren't all
+    # loaded at once
+    if stream:
+        return streaming.stream_rows(
+            request,
+            select(Vote).options(*vote_read_options),
+            VoteRead, stream
+            )
     # It gets all Votes
-    if all_votes := session.exec(select(Vote)).all():
+    if all_votes := session.exec(
+        select(Vote).options(*vote_read_options)
+    ).all():
         return all_votes
     # If there are no Votes, it raises an exception
     raise HTTPException(
@@ -108,19 +187,23 @@ def delete_vote(
     # Validate user
     if not current_user:
         raise unauth_exception
-    # It gets the Vote with the may id and current user id
-    deleted_vote: Optional[Vote] = session.exec(
-        select(Vote).where(
-            col(Vote.user_id) == current_user.id,
-            col(Vote.may_id) == may_id
+    # With the vote buffer, the removal of the vote is queued, if the user
+    # voted the May
+    if env.vote_buffer:
+        if not votebuffer.unqueue(session, current_user, may_id):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"No vote with this user_id or may_id {may_id}"
             )
-        ).first()
-    # If there is no Vote with that may_id/user_id, it raises an exception
-    if not deleted_vote:
+        return
+    # It deletes the Vote with the may id and current user id, and updates
+    # the counters of the May, once the May is locked
+    if not votes.remove_vote(session, current_user.id, may_id):
+        # If there is no Vote with that may_id/user_id, it raises an exception
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"No vote with this user_id or may_id {may_id}"
         )
-    # It deletes the Vote and returns nothing.
-    session.delete(deleted_vote)
     session.commit()
+    latest.votes_changed(current_user.id, may_id)
+    trending.votes_changed(may_id)
@@ -0,0 +1,110 @@
+''' Responsible for the denormalized vote counters of the Mayz. They're kept
+up to date on every vote, so the popularity of a May is read without loading
+its votes. Run `python -m app.scores` to rebuild them from the votes. '''
+
+from typing import Iterable, Optional
+from sqlmodel import Session, select, update, func, col, case
+from app.models import May, Vote
+
+
+def vote_delta(
+    old_type: Optional[int], new_type: Optional[int]
+) -> tuple[int, int]:
+    ''' Returns how much the upvotes and downvotes of a May change when a vote
+    goes from old_type to new_type, None meaning there is no vote '''
+    upvotes = int(new_type == 1) - int(old_type == 1)
+    downvotes = int(new_type == -1) - int(old_type == -1)
+    return upvotes, downvotes
+
+
+def vote_deltas(
+    changes: Iterable[tuple[int, Optional[int], Optional[int]]]
+) -> dict[int, tuple[int, int]]:
+    ''' Returns how much the upvotes and downvotes of each May change, from
+    the (may_id, old_type, new_type) changes of its votes '''
+    deltas = {}
+    for may_id, old_type, new_type in changes:
+        upvotes, downvotes = vote_delta(old_type, new_type)
+        total = deltas.get(may_id, (0, 0))
+        deltas[may_id] = (total[0] + upvotes, total[1] + downvotes)
+    return deltas
+
+
+def vote_update(
+    may_id: int, old_type: Optional[int], new_type: Optional[int]
+):
+    ''' Returns the statement updating the counters of a May when a vote goes
+    from old_type to new_type, or None if the vote doesn't change. The
+    increments are done by the database, so concurrent votes on the same May
+    don't overwrite each other. It runs even if the counters stay the same,
+    e.g. for a neutral vote, since it bumps the version of the May. '''
+    if old_type == new_type:
+        return None
+    upvotes, downvotes = vote_delta(old_type, new_type)
+    return update(May).where(col(May.id) == may_id).values(
+        upvotes=col(May.upvotes) + upvotes,
+        downvotes=col(May.downvotes) + downvotes,
+        score=col(May.score) + upvotes - downvotes
+        )
+
+
+def votes_update(deltas: dict[int, tuple[int, int]]):
+    ''' Returns the statement updating the counters, and bumping the version,
+    of many Mayz at once, from the (upvotes, downvotes) change of each May, or
+    None if there is no May '''
+    if not deltas:
+        return None
+    upvotes = case(
+        {may_id: up for may_id, (up, _) in deltas.items()},
+        value=col(May.id), else_=0
+        )
+    downvotes = case(
+        {may_id: down for may_id, (_, down) in deltas.items()},
+        value=col(May.id), else_=0
+        )
+    return update(May).where(col(May.id).in_(deltas)).values(
+        upvotes=col(May.upvotes) + upvotes,
+        downvotes=col(May.downvotes) + downvotes,
+        score=col(May.score) + upvotes - downvotes
+        )
+
+
+def apply_vote(
+    session: Session,
+    may_id: int,
+    old_type: Optional[int],
+    new_type: Optional[int]
+):
+    ''' Updates the counters of a May within the transaction of the session '''
+    statement = vote_update(may_id, old_type, new_type)
+    if statement is not None:
+        session.exec(statement)
+
+
+def recount(may_ids=None):
+    ''' Returns the statement recomputing the counters from the votes, of the
+    Mayz with the ids, by a list or a subquery, or of every May '''
+    # Correlated subqueries counting the votes of each updated May
+    votes = select(func.count()).select_from(Vote).where(
+        col(Vote.may_id) == col(May.id)
+        )
+    upvotes = votes.where(col(Vote.vote_type) == 1).scalar_subquery()
+    downvotes = votes.where(col(Vote.vote_type) == -1).scalar_subquery()
+    statement = update(May).values(
+        upvotes=upvotes, downvotes=downvotes, score=upvotes - downvotes
+        )
+    if may_ids is not None:
+        statement = statement.where(col(May.id).in_(may_ids))
+    return statement.execution_options(synchronize_session=False)
+
+
+def rebuild(session: Session, may_id: Optional[int] = None):
+    ''' Recomputes the counters from the votes, of a May or of every May '''
+    session.exec(recount(None if may_id is None else [may_id]))
+    session.commit()
+
+
+if __name__ == '__main__':
+    from app import database as db
+    with Session(db.get_engine()) as db_session:
+        rebuild(db_session)
@@ -0,0 +1,171 @@
+''' Responsible for the full-text search of Mayz over their title and content.
+Postgres searches a GIN indexed tsvector, other databases (e.g. SQLite test
+setups) use an in-process inverted index that is filled at startup and kept
+up to date by the May routes. '''
+
+import heapq
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+from sqlalchemy.engine import make_url
+from sqlmodel import (
+    Session, select, col, func, desc, case, Index, literal_column
+    )
+from app.models import May
+from app.config import env
+
+
+# Text search configuration, 'simple' lowercases the words without stemming
+# them, so it works the same for any language. It's rendered inline because
+# the index expression can't hold bound parameters.
+SEARCH_CONFIG = literal_column("'simple'")
+
+# Document searched by Postgres, the index is only created on Postgres. Both
+# columns are NOT NULL, and || is used since concat_ws isn't immutable.
+search_vector = func.to_tsvector(
+    SEARCH_CONFIG, col(May.title) + literal_column("' '") + col(May.content)
+    )
+May.__table__.append_constraint(Index(
+    'ix_may_search', search_vector, postgresql_using='gin'
+    ).ddl_if(dialect='postgresql'))
+
+
+def tokenize(text: str) -> list[str]:
+    ''' Splits a text into lowercase words '''
+    return re.findall(r'\w+', text.lower())
+
+
+class PostgresSearch:
+    ''' Searches the Mayz with the Postgres full-text search '''
+
+    def __init__(self):
+        self.name = 'postgresql'
+
+    def where(self, query: str):
+        ''' Returns the condition matching the Mayz that contain every word of
+        the query '''
+        return search_vector.op('@@')(
+            func.plainto_tsquery(SEARCH_CONFIG, query)
+            )
+
+    def search(self, query: str, limit: int):
+        ''' Returns the statement selecting the Mayz matching the query, best
+        ranked first '''
+        rank = func.ts_rank(
+            search_vector, func.plainto_tsquery(SEARCH_CONFIG, query)
+            )
+        return select(May).where(self.where(query)).order_by(
+            desc(rank), desc(May.id)
+            ).limit(limit)
+
+    def add(self, may: May):
+        ''' The index is maintained by Postgres '''
+
+    def remove(self, may_id: int):
+        ''' The index is maintained by Postgres '''
+
+    def rebuild(self, session: Session):
+        ''' The index is maintained by Postgres '''
+
+
+class MemorySearch:
+    ''' Searches the Mayz with an in-process inverted index '''
+
+    def __init__(self):
+        self.name = 'memory'
+        # Word -> {May ID: occurrences of the word in the May}
+        self._postings: dict[str, dict[int, int]] = defaultdict(dict)
+        # May ID -> words of the May, used to remove it from the postings
+        self._documents: dict[int, Counter] = {}
+        # Routes run in a threadpool, so the index is guarded by a lock
+        self._lock = threading.Lock()
+
+    def _matches(self, words: set[str]) -> set[int]:
+        ''' Returns the IDs of the Mayz that contain every word '''
+        # Intersecting from the shortest posting keeps the sets small
+        postings = sorted(
+            (self._postings.get(word, {}) for word in words), key=len
+            )
+        if not postings:
+            return set()
+        matches = set(postings[0])
+        for posting in postings[1:]:
+            matches.intersection_update(posting)
+        return matches
+
+    def where(self, query: str):
+        ''' Returns the condition matching the Mayz that contain every word of
+        the query '''
+        with self._lock:
+            matches = self._matches(set(tokenize(query)))
+        return col(May.id).in_(list(matches))
+
+    def search(self, query: str, limit: int):
+        ''' Returns the statement selecting the Mayz matching the query, best
+        ranked first '''
+        words = set(tokenize(query))
+        with self._lock:
+            total = len(self._documents) or 1
+            # Each May is scored by TF-IDF, so rare words weigh more
+            scores = {
+                may_id: sum(
+                    self._postings[word][may_id]
+                    * math.log(1 + total / len(self._postings[word]))
+                    for word in words
+                    )
+                for may_id in self._matches(words)
+                }
+        ranked = heapq.nlargest(
+            limit, scores, key=lambda may_id: (scores[may_id], may_id)
+            )
+        # The Mayz are read from the database, so deleted ones are left out,
+        # and they're sorted by their position in the ranking
+        statement = select(May).where(col(May.id).in_(ranked))
+        if not ranked:
+            return statement
+        return statement.order_by(case(
+            {may_id: position for position, may_id in enumerate(ranked)},
+            value=col(May.id)
+            ))
+
+    def add(self, may: May):
+        ''' Adds a May to the index, or updates it if already indexed '''
+        words = Counter(tokenize(f'{may.title} {may.content}'))
+        with self._lock:
+            self._remove(may.id)
+            self._documents[may.id] = words
+            for word, count in words.items():
+                self._postings[word][may.id] = count
+
+    def _remove(self, may_id: int):
+        ''' Removes a May from the index, the lock must be held '''
+        for word in self._documents.pop(may_id, ()):
+            self._postings[word].pop(may_id, None)
+            if not self._postings[word]:
+                del self._postings[word]
+
+    def remove(self, may_id: int):
+        ''' Removes a May from the index '''
+        with self._lock:
+            self._remove(may_id)
+
+    def rebuild(self, session: Session):
+        ''' Fills the index with every May in the database '''
+        with self._lock:
+            self._postings.clear()
+            self._documents.clear()
+        for may in session.exec(select(May)).all():
+            self.add(may)
+
+
+def get_backend() -> PostgresSearch | MemorySearch:
+    ''' Returns the search backend set in the environment, or the best one
+    for the database '''
+    dialect = make_url(env.database_url()).get_backend_name()
+    name = env.search_backend or dialect
+    return PostgresSearch() if name == 'postgresql' else MemorySearch()
+
+
+# Search backend used by the application
+backend = get_backend()
@@ -0,0 +1,98 @@
+''' Responsible for turning the results of the routes into JSON. FastAPI
+validates what a route returns against its response model, dumps it to Python
+objects and encodes them with the json module. Here, a route validates its
+result once with a precompiled adapter of its response model, which encodes it
+straight to JSON bytes. '''
+
+import asyncio
+import functools
+from typing import Any, Callable
+from fastapi.exceptions import ResponseValidationError
+from fastapi.responses import ORJSONResponse, Response
+from fastapi.routing import APIRoute
+from pydantic import TypeAdapter, ValidationError
+from app import timing
+
+# Responses that don't have a response model, e.g. plain dicts, are encoded
+# with orjson
+DefaultResponse = ORJSONResponse
+
+
+@functools.cache
+def adapter(model: Any) -> TypeAdapter:
+    ''' Returns the adapter of a response model, it's built once per model '''
+    return TypeAdapter(model)
+
+
+def dump(model: Any, content: Any) -> bytes:
+    ''' Returns the JSON of the content, validated with the model. The content
+    may be ORM objects or dicts. '''
+    model_adapter = adapter(model)
+    try:
+        value = model_adapter.validate_python(content, from_attributes=True)
+    except ValidationError as exc:
+        raise ResponseValidationError(errors=exc.errors(), body=content) \
+            from exc
+    return model_adapter.dump_json(value)
+
+
+class ModelRoute(APIRoute):
+    ''' Route that encodes the result of its endpoint with the adapter of its
+    response model, instead of FastAPI validating and encoding it again '''
+
+    def get_route_handler(self):
+        ''' Returns the handler of the route, calling the endpoint wrapped so
+        it encodes its result '''
+        # Routes without a response model are left as they are
+        call = self.dependant.call
+        if self.response_field is not None and not hasattr(call, 'encodes'):
+            self.dependant.call = self.encoded(call)
+        return super().get_route_handler()
+
+    def encoded(self, call: Callable) -> Callable:
+        ''' Returns the endpoint wrapped so it returns the response of its
+        result '''
+        if asyncio.iscoroutinefunction(call):
+            @functools.wraps(call)
+            async def endpoint(**values):
+                return self.respond(await call(**values), values)
+        else:
+            # Sync endpoints are encoded in the thread they run in
+            @functools.wraps(call)
+            def endpoint(**values):
+                return self.respond(call(**values), values)
+        endpoint.encodes = True
+        return endpoint
+
+    def respond(self, content: Any, values: dict) -> Any:
+        ''' Returns the response of the result of the endpoint, with the
+        status code and headers set on its Response parameter, if any '''
+        # Routes may still return responses themselves, e.g. streams
+        if isinstance(content, Response):
+            return content
+        with timing.measure('serialize'):
+            body = dump(self.response_model, content)
+        response = Response(
+            body, status_code=self.status_code or 200,
+            media_type='application/json'
+            )
+        for value in values.values():
+            if isinstance(value, Response):
+                response.status_code = (
+                    value.status_code or response.status_code
+                    )
+                response.raw_headers.extend(
+                    header for header in value.raw_headers
+                    if header[0] != b'content-length'
+                    )
+        return response
+
+
+def build_adapters(routes) -> int:
+    ''' Builds the adapters of the response models of the routes, so they're
+    built on startup and not on first request. It returns how many there are.
+    '''
+    for route in routes:
+        if isinstance(route, ModelRoute) and route.response_model is not None:
+            adapter(route.response_model)
+    return adapter.cache_info().currsize
@@ -0,0 +1,78 @@
+''' Responsible for streaming unbounded lists, e.g. every user, as NDJSON or as
+a JSON array. The rows are read from a server-side cursor in batches, and each
+batch is serialized at once with the adapter of its read model. The identity
+map of the session only keeps weak references to unchanged rows, so the ones
+already sent are dropped and the memory taken doesn't grow with the table. '''
+
+from typing import Literal, Optional
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+from app.config import env
+from app import serialization, timing, database as db
+
+# Formats of a streamed list: one JSON document per line, or a JSON array
+StreamFormat = Optional[Literal['ndjson', 'json']]
+MEDIA_TYPES = {'ndjson': 'application/x-ndjson', 'json': 'application/json'}
+# What's sent before and after the rows in each format
+ENCLOSURES = {'ndjson': (b'', b''), 'json': (b'[', b']')}
+
+
+def encode_batch(
+    rows, model: type[BaseModel], first: bool, fmt: str
+) -> bytes:
+    ''' Returns the chunk of a batch of rows, validated at once with the
+    adapter of the list of their read model '''
+    with timing.measure('serialize'):
+        if fmt == 'json':
+            # The array of the batch, without its brackets
+            array = serialization.dump(list[model], rows)[1:-1]
+            return array if first else b',' + array
+        values = serialization.adapter(list[model]).validate_python(
+            rows, from_attributes=True
+            )
+        model_adapter = serialization.adapter(model)
+        return b''.join(
+            model_adapter.dump_json(value) + b'\n' for value in values
+            )
+
+
+def stream_rows(
+    request: Request, statement, model: type[BaseModel], fmt: str
+) -> StreamingResponse:
+    ''' Returns a response streaming the rows selected by the statement '''
+    def chunks():
+        # The session of the request is closed before the response is sent,
+        # so the stream opens its own, routed like the one of the request
+        with db.request_session(request) as session:
+            result = session.exec(
+                statement.execution_options(yield_per=env.stream_batch_size)
+                )
+            opening, closing = ENCLOSURES[fmt]
+            yield opening
+            for index, rows in enumerate(result.partitions()):
+                yield encode_batch(rows, model, not index, fmt)
+            yield closing
+    return StreamingResponse(chunks(), media_type=MEDIA_TYPES[fmt])
+
+
+def stream_rows_async(
+    request: Request, statement, model: type[BaseModel], fmt: str
+) -> StreamingResponse:
+    ''' Returns a response streaming the rows selected by the statement, with
+    the async database stack '''
+    async def chunks():
+        # The session of the request is closed before the response is sent,
+        # so the stream opens its own, routed like the one of the request
+        async with db.request_session_async(request) as session:
+            result = await session.stream_scalars(
+                statement.execution_options(yield_per=env.stream_batch_size)
+                )
+            opening, closing = ENCLOSURES[fmt]
+            yield opening
+            first = True
+            async for rows in result.partitions():
+                yield encode_batch(rows, model, first, fmt)
+                first = False
+            yield closing
+    return StreamingResponse(chunks(), media_type=MEDIA_TYPES[fmt])
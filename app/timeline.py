@@ -0,0 +1,307 @@
+''' Responsible for the follows and the home timelines. A May is written to the
+timeline of its author and of every follower when it's posted (fan-out on
+write), so a home timeline is read as a single range of an index. The Mayz of
+users with more followers than the fan-out limit aren't written to the
+timelines of their followers, which read them from the followed users instead
+(fan-out on read). A timeline keeps its newest TIMELINE_SIZE Mayz: posting
+and following don't trim the timelines they write to, each process records
+them and a task trims them every TIMELINE_TRIM_INTERVAL seconds instead. The
+timelines written to before a restart are trimmed on their next write. '''
+
+import asyncio
+import threading
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlmodel import (
+    Session, select, insert, update, delete, col, desc, func, literal, tuple_,
+    union_all, not_
+    )
+from sqlmodel.ext.asyncio.session import AsyncSession
+from app.config import env
+from app.models import Follow, May, Timeline, User
+from app import pagination, database as db
+
+# Timelines trimmed per statement
+TRIM_BATCH = 500
+
+
+class Written:
+    ''' The users whose timelines were written to since the last trim '''
+
+    def __init__(self):
+        self._user_ids: set[int] = set()
+        self._lock = threading.Lock()
+
+    def add(self, user_ids):
+        ''' Records the users whose timelines were written to '''
+        with self._lock:
+            self._user_ids.update(user_ids)
+
+    def take(self) -> list[int]:
+        ''' Returns the users recorded, and forgets them '''
+        with self._lock:
+            user_ids, self._user_ids = self._user_ids, set()
+        return sorted(user_ids)
+
+
+written = Written()
+
+
+def insert_for(dialect: str):
+    ''' Returns the insert of the dialect, which can skip conflicting rows '''
+    return postgresql.insert if dialect == 'postgresql' else sqlite.insert
+
+
+def followers(user_id: int):
+    ''' Returns the statement selecting the followers counter of a user '''
+    return select(User.followers).where(col(User.id) == user_id)
+
+
+def followers_update(user_ids, change: int):
+    ''' Returns the statement changing the followers counter of the users,
+    by an id or a subquery of ids '''
+    if isinstance(user_ids, int):
+        user_ids = [user_ids]
+    return update(User).where(col(User.id).in_(user_ids)).values(
+        followers=col(User.followers) + change
+        )
+
+
+def followed(user_id: int):
+    ''' Returns the statement selecting the ids of the users a user follows '''
+    return select(Follow.followee_id).where(col(Follow.follower_id) == user_id)
+
+
+def trim(user_ids):
+    ''' Returns the statement deleting the oldest entries of the timelines of
+    the users, by a list or a subquery of ids, beyond the timeline size '''
+    ranked = select(
+        Timeline.user_id, Timeline.may_id,
+        func.row_number().over(
+            partition_by=col(Timeline.user_id),
+            order_by=(desc(Timeline.created_at), desc(Timeline.may_id))
+            ).label('rank')
+        ).where(col(Timeline.user_id).in_(user_ids)).subquery()
+    return delete(Timeline).where(
+        tuple_(col(Timeline.user_id), col(Timeline.may_id)).in_(
+            select(ranked.c.user_id, ranked.c.may_id).where(
+                ranked.c.rank > env.timeline_size
+                )
+            )
+        )
+
+
+def fan_out(may_id: int, fans_out: bool):
+    ''' Returns the statement writing a May to the timeline of its author,
+    and of its followers if it fans out, which returns the users written to.
+    The timelines are trimmed later. '''
+    entries = select(May.user_id, May.id, May.created_at).where(
+        col(May.id) == may_id
+        )
+    if fans_out:
+        entries = union_all(entries, select(
+            Follow.follower_id, May.id, May.created_at
+            ).join(May, col(May.user_id) == col(Follow.followee_id)).where(
+                col(May.id) == may_id
+                ))
+    return insert(Timeline).from_select(
+        ['user_id', 'may_id', 'created_at'], entries
+        ).returning(col(Timeline.user_id))
+
+
+def follow_insert(dialect: str, follower_id: int, followee_id: int):
+    ''' Returns the statement inserting a follow. It returns no row if the
+    user already follows, and a missing user is caught by the foreign key. '''
+    return insert_for(dialect)(Follow).values(
+        follower_id=follower_id, followee_id=followee_id
+        ).on_conflict_do_nothing().returning(col(Follow.followee_id))
+
+
+def backfill(dialect: str, follower_id: int, followee_id: int):
+    ''' Returns the statement writing the newest fanned out Mayz of a
+    followed user to the timeline of the follower. It's trimmed later. '''
+    entries = select(
+        literal(follower_id), May.id, May.created_at
+        ).where(
+            col(May.user_id) == followee_id, col(May.fanned_out)
+            ).order_by(desc(May.created_at), desc(May.id)).limit(
+                env.timeline_size
+                )
+    return insert_for(dialect)(Timeline).from_select(
+        ['user_id', 'may_id', 'created_at'], entries
+        ).on_conflict_do_nothing()
+
+
+def follow_delete(follower_id: int, followee_id: int):
+    ''' Returns the statement deleting a follow. It returns no row if the
+    user doesn't follow. '''
+    return delete(Follow).where(
+        col(Follow.follower_id) == follower_id,
+        col(Follow.followee_id) == followee_id
+        ).returning(col(Follow.followee_id))
+
+
+def unfollow(follower_id: int, followee_id: int) -> list:
+    ''' Returns the statements removing a user that's no longer followed:
+    its counter and its Mayz in the timeline of the follower '''
+    return [
+        followers_update(followee_id, -1),
+        delete(Timeline).where(
+            col(Timeline.user_id) == follower_id,
+            col(Timeline.may_id).in_(
+                select(May.id).where(col(May.user_id) == followee_id)
+                )
+            ),
+        ]
+
+
+def forget(user_id: int):
+    ''' Returns the statement decrementing the counters of the users followed
+    by a user about to be deleted. Its follows and timeline go away along with
+    it. '''
+    return followers_update(followed(user_id), -1)
+
+
+def home(user_id: int, cursor: str, limit: int):
+    ''' Returns the statement selecting a page of the home timeline of a user,
+    newest first: its timeline along with the Mayz that weren't fanned out of
+    the users it follows '''
+    entries = pagination.paginate(
+        select(Timeline.may_id.label('id'), Timeline.created_at).where(
+            col(Timeline.user_id) == user_id
+            ),
+        col(Timeline.created_at), col(Timeline.may_id), cursor, limit
+        )
+    pulled = pagination.paginate(
+        select(May.id, May.created_at).where(
+            col(May.user_id).in_(followed(user_id)), not_(col(May.fanned_out))
+            ),
+        col(May.created_at), col(May.id), cursor, limit
+        )
+    feed = union_all(
+        entries.subquery().select(), pulled.subquery().select()
+        ).subquery()
+    return pagination.paginate(
+        select(May).join(feed, col(May.id) == feed.c.id),
+        col(May.created_at), col(May.id), '', limit
+        )
+
+
+def post(session: Session, may: May):
+    ''' Adds a new May and writes it to the timelines, within the transaction
+    of the session '''
+    count = session.exec(followers(may.user_id)).one()
+    may.fanned_out = count <= env.timeline_fanout_limit
+    session.add(may)
+    session.flush()
+    written.add(session.exec(fan_out(may.id, may.fanned_out)).scalars())
+
+
+async def post_async(session: AsyncSession, may: May):
+    ''' Adds a new May and writes it to the timelines, with the async
+    database stack '''
+    count = (await session.exec(followers(may.user_id))).one()
+    may.fanned_out = count <= env.timeline_fanout_limit
+    session.add(may)
+    await session.flush()
+    entries = await session.exec(fan_out(may.id, may.fanned_out))
+    written.add(entries.scalars())
+
+
+def follow(session: Session, follower_id: int, followee_id: int) -> bool:
+    ''' Makes a user follow another one, within the transaction of the
+    session. It returns False if the user already follows. '''
+    dialect = session.get_bind().dialect.name
+    if session.exec(
+        follow_insert(dialect, follower_id, followee_id)
+    ).first() is None:
+        return False
+    for statement in (
+        followers_update(followee_id, 1),
+        backfill(dialect, follower_id, followee_id)
+    ):
+        session.exec(statement)
+    written.add([follower_id])
+    return True
+
+
+async def follow_async(
+    session: AsyncSession, follower_id: int, followee_id: int
+) -> bool:
+    ''' Makes a user follow another one, with the async database stack. It
+    returns False if the user already follows. '''
+    dialect = session.get_bind().dialect.name
+    if (await session.exec(
+        follow_insert(dialect, follower_id, followee_id)
+    )).first() is None:
+        return False
+    for statement in (
+        followers_update(followee_id, 1),
+        backfill(dialect, follower_id, followee_id)
+    ):
+        await session.exec(statement)
+    written.add([follower_id])
+    return True
+
+
+def stop_following(
+    session: Session, follower_id: int, followee_id: int
+) -> bool:
+    ''' Makes a user stop following another one, within the transaction of
+    the session. It returns False if the user doesn't follow. '''
+    if session.exec(
+        follow_delete(follower_id, followee_id)
+    ).first() is None:
+        return False
+    for statement in unfollow(follower_id, followee_id):
+        session.exec(statement)
+    return True
+
+
+async def stop_following_async(
+    session: AsyncSession, follower_id: int, followee_id: int
+) -> bool:
+    ''' Makes a user stop following another one, with the async database
+    stack. It returns False if the user doesn't follow. '''
+    if (await session.exec(
+        follow_delete(follower_id, followee_id)
+    )).first() is None:
+        return False
+    for statement in unfollow(follower_id, followee_id):
+        await session.exec(statement)
+    return True
+
+
+def trim_written(session: Session):
+    ''' Trims the timelines written to since the last trim. If it fails,
+    they're trimmed on the next one. '''
+    user_ids = written.take()
+    try:
+        for start in range(0, len(user_ids), TRIM_BATCH):
+            session.exec(trim(user_ids[start:start + TRIM_BATCH]))
+        session.commit()
+    except Exception:
+        written.add(user_ids)
+        raise
+
+
+def trim_sync():
+    ''' Trims the timelines written to with a session of its own '''
+    with Session(db.engine) as session:
+        trim_written(session)
+
+
+async def keep_trimmed():
+    ''' Trims the timelines written to every TIMELINE_TRIM_INTERVAL seconds,
+    off the event loop, until it's cancelled on application shutdown '''
+    while True:
+        await asyncio.sleep(env.timeline_trim_interval)
+        # A failed trim is retried on the next one, the timelines are only
+        # longer meanwhile
+        try:
+            if db.async_engine is not None:
+                async with AsyncSession(db.async_engine) as session:
+                    await session.run_sync(trim_written)
+            else:
+                await asyncio.to_thread(trim_sync)
+        except Exception as exc:  # pylint: disable=broad-except
+            print(f"Trimming the timelines failed: {exc!r}")
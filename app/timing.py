@@ -0,0 +1,150 @@
+''' Responsible for timing the requests: how many SQL statements they ran and
+how long those took, along with the time spent authenticating the user,
+hashing passwords with bcrypt and serializing the response. They're sent in
+the Server-Timing header, so they show up in the network panel of the browser,
+and logged as a JSON line per request if TIMING_LOG is set. Statements slower
+than SLOW_QUERY_MS are logged along with the route that ran them.
+
+The times overlap: the authentication runs statements, and so does the
+serialization if a relationship is loaded lazily, so a high query count in a
+fast route with a slow serialization points to N+1 lazy loads. '''
+
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+import orjson
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app.config import env
+
+
+logger = logging.getLogger(__name__)
+if not logger.handlers:
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+
+class RequestTimings:
+    ''' What a request spent its time on, the durations are in seconds '''
+
+    def __init__(self, method: str, path: str):
+        self.method = method
+        self.path = path
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db = 0.0
+        # Spans timed with measure(), e.g. auth and serialize
+        self.spans: dict[str, float] = {}
+
+    def server_timing(self) -> str:
+        ''' Returns the Server-Timing header, the durations are in ms '''
+        metrics = [
+            f'db;dur={self.db * 1e3:.2f};desc="{self.queries} queries"',
+            *(f'{name};dur={seconds * 1e3:.2f}'
+              for name, seconds in self.spans.items()),
+            f'app;dur={(time.perf_counter() - self.start) * 1e3:.2f}',
+            ]
+        return ', '.join(metrics)
+
+    def record(self, status: Optional[int]) -> dict:
+        ''' Returns the structured log record of the request '''
+        return {
+            'method': self.method,
+            'path': self.path,
+            'status': status,
+            'queries': self.queries,
+            'db_ms': round(self.db * 1e3, 3),
+            **{f'{name}_ms': round(seconds * 1e3, 3)
+               for name, seconds in self.spans.items()},
+            'total_ms': round((time.perf_counter() - self.start) * 1e3, 3),
+            }
+
+
+# Timings of the request being served. Sync routes run in a threadpool with a
+# copy of the context, so they share the same timings.
+current: ContextVar[Optional[RequestTimings]] = ContextVar(
+    'request_timings', default=None
+    )
+
+
+@contextmanager
+def measure(name: str):
+    ''' Adds the time spent in the block to the span of the current request
+    with the given name '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if (timings := current.get()) is not None:
+            timings.spans[name] = timings.spans.get(name, 0.0) + (
+                time.perf_counter() - start
+                )
+
+
+def before_cursor_execute(conn, *_):
+    ''' Records when a statement starts '''
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, _, statement, *__):
+    ''' Adds a statement to the current request, and logs it if it's slow.
+    Its parameters aren't logged, they may be passwords or hashes. '''
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    timings = current.get()
+    if timings is not None:
+        timings.queries += 1
+        timings.db += elapsed
+    if env.slow_query_ms and elapsed * 1e3 >= env.slow_query_ms:
+        logger.warning(orjson.dumps({
+            'slow_query_ms': round(elapsed * 1e3, 3),
+            'method': timings and timings.method,
+            'path': timings and timings.path,
+            'statement': statement,
+            }).decode())
+
+
+def instrument(engine: Engine | type[Engine]):
+    ''' Times the statements of an engine, the sync engine of an async one
+    included, or of every engine if it's given the Engine class '''
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+
+
+class TimingMiddleware:
+    ''' ASGI middleware that times each request, and adds its Server-Timing
+    header to the response '''
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        timings = RequestTimings(scope['method'], scope['path'])
+        token = current.set(timings)
+        status = None
+
+        async def send_timed(message):
+            nonlocal status
+            # The headers are sent before the body, which may still be
+            # streamed, so the header has the timings so far
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                message['headers'] = [
+                    *message.get('headers', ()),
+                    (b'server-timing', timings.server_timing().encode()),
+                    ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            current.reset(token)
+            if env.timing_log:
+                logger.info(orjson.dumps(timings.record(status)).decode())
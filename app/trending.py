@@ -0,0 +1,230 @@
+''' Responsible for the trending Mayz, ranked by their score decayed by their
+age like Hacker News does: score / (age in hours + offset) ^ gravity. The
+recent Mayz and their scores are kept in memory and the vote routes mark the
+ones whose score changed. A background task reads just those scores again and
+ranks the Mayz every TRENDING_REFRESH seconds, so the route never ranks them
+itself, and it rebuilds them from the database every TRENDING_REBUILD
+seconds, to see the writes of other processes. Run `python -m app.trending`
+to print the ranking built from the database. '''
+
+import asyncio
+import heapq
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from sqlmodel import Session, select, col
+from sqlmodel.ext.asyncio.session import AsyncSession
+from app.conditional import as_utc
+from app.config import env
+from app.models import May
+from app import database as db
+
+
+def hotness(score: int, created_at: datetime, now: datetime) -> float:
+    ''' Returns the score of a May decayed by its age '''
+    hours = max((now - as_utc(created_at)).total_seconds(), 0) / 3600
+    return score / (hours + env.trending_offset) ** env.trending_gravity
+
+
+class TrendingBoard:
+    ''' Recent Mayz, with their scores, and the top of their ranking '''
+
+    def __init__(self, size: int, window: float, rebuild_every: float):
+        self.size = size
+        self.window = window
+        self.rebuild_every = rebuild_every
+        # Id of every recent May, mapped to its score and created_at
+        self._mayz: dict[int, tuple[int, datetime]] = {}
+        # Ids of the Mayz whose score changed since it was last read
+        self._dirty: set[int] = set()
+        # Ids of the top Mayz, hottest first
+        self._top: list[int] = []
+        self._rebuilt = None
+        # Sync routes run in a threadpool, so the Mayz are guarded by a lock
+        self._lock = threading.Lock()
+
+    def since(self) -> datetime:
+        ''' Returns the moment after which a May is recent '''
+        return datetime.now(timezone.utc) - timedelta(hours=self.window)
+
+    def rebuild_due(self) -> bool:
+        ''' Checks whether the Mayz should be read again from the database '''
+        return self._rebuilt is None or (
+            time.monotonic() - self._rebuilt >= self.rebuild_every
+            )
+
+    def rebuild(self, rows: list):
+        ''' Replaces the Mayz with the (id, score, created_at) rows '''
+        with self._lock:
+            self._mayz = {
+                may_id: (score, created_at)
+                for may_id, score, created_at in rows
+                }
+            self._dirty.clear()
+            self._rebuilt = time.monotonic()
+
+    def take_dirty(self) -> list[int]:
+        ''' Returns the ids of the Mayz whose score changed, and forgets them
+        '''
+        with self._lock:
+            dirty, self._dirty = list(self._dirty), set()
+        return dirty
+
+    def update(self, rows: list):
+        ''' Sets the scores of the (id, score, created_at) rows read again '''
+        with self._lock:
+            for may_id, score, created_at in rows:
+                if may_id in self._mayz:
+                    self._mayz[may_id] = (score, created_at)
+
+    def add(self, may: May):
+        ''' Adds a new May, with no votes yet '''
+        with self._lock:
+            self._mayz[may.id] = (may.score or 0, may.created_at)
+
+    def remove(self, may_id: int):
+        ''' Removes a May '''
+        with self._lock:
+            self._mayz.pop(may_id, None)
+            self._dirty.discard(may_id)
+
+    def mark(self, *may_ids: int):
+        ''' Marks the Mayz whose score changed, the ones that aren't recent
+        are ignored '''
+        with self._lock:
+            self._dirty.update(
+                may_id for may_id in may_ids if may_id in self._mayz
+                )
+
+    def expire(self):
+        ''' Makes the next refresh rebuild the Mayz from the database '''
+        self._rebuilt = None
+
+    def rank(self):
+        ''' Ranks the recent Mayz and keeps the top ones, the old ones are
+        dropped '''
+        now = datetime.now(timezone.utc)
+        since = self.since()
+        with self._lock:
+            for may_id in [may_id for may_id, (_, created_at)
+                           in self._mayz.items()
+                           if as_utc(created_at) < since]:
+                del self._mayz[may_id]
+            entries = list(self._mayz.items())
+        top = heapq.nlargest(
+            self.size, entries,
+            key=lambda item: (hotness(*item[1], now), item[0])
+            )
+        self._top = [may_id for may_id, _ in top]
+
+    def top(self, n: int) -> list[int]:
+        ''' Returns the ids of the n hottest Mayz '''
+        return self._top[:n]
+
+
+board = TrendingBoard(
+    env.trending_size, env.trending_window, env.trending_rebuild
+    )
+
+
+def recent(since: datetime):
+    ''' Returns the statement selecting the score of the Mayz created after
+    the given moment '''
+    return select(May.id, May.score, May.created_at).where(
+        col(May.created_at) >= since
+        )
+
+
+def scores_of(may_ids: list[int]):
+    ''' Returns the statement selecting the score of the given Mayz '''
+    return select(May.id, May.score, May.created_at).where(
+        col(May.id).in_(may_ids)
+        )
+
+
+def mayz(may_ids: list[int], options):
+    ''' Returns the statement selecting the given Mayz '''
+    return select(May).where(col(May.id).in_(may_ids)).options(*options)
+
+
+def ranked(may_ids: list[int], rows: list) -> list:
+    ''' Sorts the Mayz read from the database like the ranking '''
+    ranks = {may_id: rank for rank, may_id in enumerate(may_ids)}
+    return sorted(rows, key=lambda may: ranks[may.id])
+
+
+def load(session: Session):
+    ''' Rebuilds the Mayz from the database if it's due, or else reads again
+    the scores that changed '''
+    if board.rebuild_due():
+        board.rebuild(session.exec(recent(board.since())).all())
+    elif dirty := board.take_dirty():
+        board.update(session.exec(scores_of(dirty)).all())
+
+
+def rebuild(session: Session):
+    ''' Rebuilds the ranking from the database, it's called on application
+    startup '''
+    board.expire()
+    load(session)
+    board.rank()
+
+
+def load_sync():
+    ''' Loads the scores with a session of its own '''
+    with Session(db.engine) as session:
+        load(session)
+
+
+async def refresh():
+    ''' Loads the scores and ranks the Mayz, off the event loop '''
+    if db.async_engine is not None:
+        async with AsyncSession(db.async_engine) as session:
+            await session.run_sync(load)
+    else:
+        await asyncio.to_thread(load_sync)
+    await asyncio.to_thread(board.rank)
+
+
+async def keep_ranked():
+    ''' Refreshes the ranking every TRENDING_REFRESH seconds, until it's
+    cancelled on application shutdown '''
+    while True:
+        await asyncio.sleep(env.trending_refresh)
+        # A failed refresh, e.g. the database is down, is retried on the next
+        # one, the previous ranking is served meanwhile
+        try:
+            await refresh()
+        except Exception as exc:  # pylint: disable=broad-except
+            print(f"Refreshing the trending Mayz failed: {exc!r}")
+
+
+def may_created(may: May):
+    ''' Records a new May '''
+    board.add(may)
+
+
+def may_deleted(may_id: int):
+    ''' Removes a May '''
+    board.remove(may_id)
+
+
+def user_deleted():
+    ''' The Mayz of a deleted user are gone too, so they're rebuilt on the
+    next refresh '''
+    board.expire()
+
+
+def votes_changed(*may_ids: int):
+    ''' Marks the voted Mayz, their scores changed '''
+    board.mark(*may_ids)
+
+
+if __name__ == '__main__':
+    with Session(db.engine) as db_session:
+        rebuild(db_session)
+        for position, row in enumerate(ranked(
+            board.top(board.size),
+            db_session.exec(mayz(board.top(board.size), ())).all()
+        ), start=1):
+            print(f'{position}. {row.title} ({row.score})')
@@ -1,9 +1,19 @@
 ''' Utility functions that are used across the application '''
 
+import asyncio
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor
 # Import the passlib library and initiate the CryptContext class
 from passlib.context import CryptContext
+from app.config import env
+from app import metrics, timing
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# The cost of bcrypt is set in the environment. Hashes made with a different
+# cost need to be updated, and they're rehashed on the next login.
+pwd_context = CryptContext(
+    schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=env.bcrypt_rounds
+    )
 
 
 # Function to hash a plain text password
@@ -19,3 +29,101 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     ''' Verifies whether the plain text password matches the hashed
     password '''
     return pwd_context.verify(plain_password, hashed_password)
+
+
+# Function to check whether the hashed password was made with another cost
+def password_needs_update(hashed_password: str) -> bool:
+    ''' Checks whether the hashed password should be hashed again with the
+    current settings '''
+    return pwd_context.needs_update(hashed_password)
+
+
+# Function to load bcrypt, which passlib does on first use
+def load_backend() -> str:
+    ''' Loads the bcrypt backend of passlib and returns its name '''
+    return pwd_context.handler().get_backend()
+
+
+class PasswordService:
+    ''' Hashes and verifies passwords in a bounded process pool, so bcrypt
+    doesn't take up the threads or the event loop serving requests. With no
+    workers, it runs them in a thread, or inline from the sync routes, which
+    already run in one. '''
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._executor: Executor | None = None
+        self._lock = threading.Lock()
+
+    def executor(self) -> Executor | None:
+        ''' Returns the process pool, it's started on first use '''
+        if self.workers == 0:
+            return None
+        with self._lock:
+            if self._executor is None:
+                # Every process loads bcrypt as it starts
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, initializer=load_backend
+                    )
+            return self._executor
+
+    def warm(self) -> int:
+        ''' Starts the processes of the pool, which load bcrypt as they start,
+        it's called on application startup. It returns how many there are. '''
+        load_backend()
+        if (executor := self.executor()) is None:
+            return 0
+        jobs = [executor.submit(os.getpid) for _ in range(self.workers)]
+        return len({future.result() for future in jobs})
+
+    def _run(self, operation: str, function, *args):
+        ''' Runs a function in the process pool and waits for its result '''
+        with timing.measure('bcrypt'), metrics.timed(
+            metrics.password_seconds, operation
+        ):
+            if (executor := self.executor()) is None:
+                return function(*args)
+            return executor.submit(function, *args).result()
+
+    async def _run_async(self, operation: str, function, *args):
+        ''' Runs a function in the process pool and awaits its result '''
+        with timing.measure('bcrypt'), metrics.timed(
+            metrics.password_seconds, operation
+        ):
+            if (executor := self.executor()) is None:
+                return await asyncio.to_thread(function, *args)
+            return await asyncio.get_running_loop().run_in_executor(
+                executor, function, *args
+                )
+
+    def hash(self, password: str) -> str:
+        ''' Returns the hash of a password '''
+        return self._run('hash', get_password_hash, password)
+
+    def verify(self, plain_password: str, hashed_password: str) -> bool:
+        ''' Verifies a password against its hash '''
+        return self._run(
+            'verify', verify_password, plain_password, hashed_password
+            )
+
+    async def hash_async(self, password: str) -> str:
+        ''' Returns the hash of a password, from async routes '''
+        return await self._run_async('hash', get_password_hash, password)
+
+    async def verify_async(
+        self, plain_password: str, hashed_password: str
+    ) -> bool:
+        ''' Verifies a password against its hash, from async routes '''
+        return await self._run_async(
+            'verify', verify_password, plain_password, hashed_password
+            )
+
+    def shutdown(self):
+        ''' Stops the process pool, it's called on application shutdown '''
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+passwords = PasswordService(env.password_workers)
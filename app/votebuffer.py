@@ -0,0 +1,319 @@
+''' Responsible for the write-behind buffer of the votes, enabled with
+VOTE_BUFFER. When a May goes viral, thousands of users vote on it at once,
+and every vote would be a commit updating the counters of the same row.
+Instead, the vote routes check the vote against the database and queue it in
+memory, the last vote of a user on a May replacing the previous one, and a
+task started on startup writes the queue in batches: one upsert of the
+votes, one delete of the removed ones and one update of the counters of
+every May voted, when VOTE_BUFFER_SIZE votes are queued or every
+VOTE_BUFFER_INTERVAL seconds. The queue is written once more on shutdown.
+It holds up to VOTE_BUFFER_LIMIT votes, e.g. while the database is down, and
+the votes past it are rejected with 503 until it's written.
+
+The vote routes read the queued votes of the user back, and the other routes
+write the queued votes of their user before they run, so a user sees its own
+votes right away. Other users see them once they're written. The queue is
+per process, and the votes still queued are lost if the process dies
+without shutting down. '''
+
+import asyncio
+import math
+import threading
+from typing import Optional
+from fastapi import HTTPException, Request, status
+from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+from app.config import env
+from app.models import User
+from app import latest, trending, votes, database as db
+
+# Placeholder of a vote that isn't queued, since None is a removed vote
+MISSING = object()
+
+
+def full_exception(interval: float) -> HTTPException:
+    ''' Returns the exception of a vote rejected by a full queue '''
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Too many votes queued, try again later",
+        headers={"Retry-After": str(max(1, math.ceil(interval)))},
+        )
+
+
+class VoteBuffer:
+    ''' Votes queued in memory, by user and May, until they're written '''
+
+    def __init__(self, size: int, interval: float, limit: int):
+        self.size = size
+        self.interval = interval
+        self.limit = limit
+        # Queued type of the vote of every user on every May, None if it's
+        # removed, and the usernames of the users
+        self._queued: dict[int, dict[int, Optional[int]]] = {}
+        self._users: dict[str, int] = {}
+        self._count = 0
+        # Votes being written, still read back until they're committed
+        self._writing: dict[tuple[int, int], Optional[int]] = {}
+        # Sync routes run in a threadpool, so the queue is guarded by a lock,
+        # and the writes are serialized so the last vote is written last
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._write_lock_async = asyncio.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    def queued(self, user_id: int, may_id: int):
+        ''' Returns the type of the queued vote of a user on a May, None if
+        it's removed, or MISSING if there's none '''
+        with self._lock:
+            vote_type = self._queued.get(user_id, {}).get(may_id, MISSING)
+            if vote_type is MISSING:
+                vote_type = self._writing.get((user_id, may_id), MISSING)
+            return vote_type
+
+    def put(self, user: User, may_id: int, vote_type: Optional[int]):
+        ''' Queues the vote of a user on a May, None removing it. The votes
+        are written early once a batch is queued, and a new vote past the
+        limit of the queue raises 503. '''
+        with self._lock:
+            mayz = self._queued.get(user.id, {})
+            if may_id not in mayz and self._count >= self.limit:
+                raise full_exception(self.interval)
+            self._queued[user.id] = mayz
+            self._count += may_id not in mayz
+            mayz[may_id] = vote_type
+            self._users[user.username] = user.id
+            full = self._count >= self.size
+        if full and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    def has_queued(self, username: str) -> bool:
+        ''' Checks whether a user has queued votes '''
+        return username in self._users
+
+    def _take(self, username: Optional[str] = None) -> tuple[dict, dict]:
+        ''' Moves the votes of a user, or a batch of votes, from the queue to
+        the votes being written. It returns them by (user_id, may_id), along
+        with the usernames of their users. '''
+        taken = {}
+        with self._lock:
+            if username is not None:
+                user_ids = [self._users[username]] \
+                    if username in self._users else []
+            else:
+                user_ids = list(self._queued)
+            for user_id in user_ids:
+                if len(taken) >= self.size:
+                    break
+                for may_id, vote_type in self._queued.pop(user_id).items():
+                    taken[(user_id, may_id)] = vote_type
+            self._count -= len(taken)
+            users = {name: user_id for name, user_id in self._users.items()
+                     if user_id not in self._queued}
+            for name in users:
+                del self._users[name]
+            self._writing = taken
+        return taken, users
+
+    def _done(self, taken: dict, users: dict, written: bool):
+        ''' Drops the votes written, or queues them again if they failed and
+        weren't replaced meanwhile '''
+        with self._lock:
+            self._writing = {}
+            if written:
+                return
+            self._users.update(users)
+            for (user_id, may_id), vote_type in taken.items():
+                mayz = self._queued.setdefault(user_id, {})
+                if may_id not in mayz:
+                    mayz[may_id] = vote_type
+                    self._count += 1
+
+    @staticmethod
+    def _changed(taken: dict, users: dict, may_ids: set[int]):
+        ''' Marks the cached users and Mayz the written votes changed, and
+        pins their users to the primary, so they read them back '''
+        by_user: dict[int, list[int]] = {}
+        for user_id, may_id in taken:
+            by_user.setdefault(user_id, []).append(may_id)
+        for user_id, user_may_ids in by_user.items():
+            latest.votes_changed(user_id, *user_may_ids)
+        trending.votes_changed(*may_ids)
+        if db.get_replicas():
+            for username in users:
+                db.pins.put(username, True)
+
+    def write(self, username: Optional[str] = None) -> int:
+        ''' Writes the queued votes, of a user or of everyone, in batches of
+        a transaction each. It returns how many were written. '''
+        written = 0
+        with self._write_lock:
+            while True:
+                taken, users = self._take(username)
+                if not taken:
+                    return written
+                try:
+                    with Session(db.engine) as session:
+                        may_ids = votes.apply_queued(session, taken)
+                        session.commit()
+                except Exception:
+                    self._done(taken, users, written=False)
+                    raise
+                self._done(taken, users, written=True)
+                self._changed(taken, users, may_ids)
+                written += len(taken)
+
+    async def write_async(self, username: Optional[str] = None) -> int:
+        ''' Writes the queued votes, of a user or of everyone, with the async
+        database stack. It returns how many were written. '''
+        written = 0
+        async with self._write_lock_async:
+            while True:
+                taken, users = self._take(username)
+                if not taken:
+                    return written
+                try:
+                    async with AsyncSession(db.async_engine) as session:
+                        may_ids = await votes.apply_queued_async(
+                            session, taken
+                            )
+                        await session.commit()
+                except Exception:
+                    self._done(taken, users, written=False)
+                    raise
+                self._done(taken, users, written=True)
+                self._changed(taken, users, may_ids)
+                written += len(taken)
+
+    async def flush(self) -> int:
+        ''' Writes every queued vote, off the event loop with the sync
+        database stack '''
+        if db.async_engine is not None:
+            return await self.write_async()
+        return await asyncio.to_thread(self.write)
+
+    async def run(self):
+        ''' Writes the queue every interval, or as soon as it's full, until
+        it's stopped, then stop writes what's left. A failed write is retried
+        on the next one. '''
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            if self._stopping:
+                return
+            try:
+                await self.flush()
+            except Exception as exc:  # pylint: disable=broad-except
+                print(f"WARNING: the queued votes weren't written: {exc}")
+
+    def start(self) -> asyncio.Task:
+        ''' Starts the task writing the queue, on the running event loop '''
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._stopping = False
+        self._task = asyncio.create_task(self.run())
+        return self._task
+
+    async def stop(self) -> int:
+        ''' Stops the task and writes what's left of the queue. It returns
+        how many votes were written. '''
+        if self._task is not None:
+            self._stopping = True
+            self._wake.set()
+            await self._task
+            self._task = None
+        self._loop = None
+        return await self.flush()
+
+
+# Queue of the votes of the process
+buffer = VoteBuffer(
+    env.vote_buffer_size, env.vote_buffer_interval, env.vote_buffer_limit
+    )
+
+
+def settle(request: Request):
+    ''' Writes the queued votes of the user of a request before its route
+    runs, so the user reads them back. Only the signature of the token is
+    checked yet, at worst it writes the votes of a disabled user early. '''
+    if not env.vote_buffer:
+        return
+    if (username := db.request_user(request)) and buffer.has_queued(username):
+        buffer.write(username)
+
+
+async def settle_async(request: Request):
+    ''' Writes the queued votes of the user of a request before its route
+    runs, with the async database stack '''
+    if not env.vote_buffer:
+        return
+    if (username := db.request_user(request)) and buffer.has_queued(username):
+        await buffer.write_async(username)
+
+
+def queue(
+    session: Session, user: User, may_id: int, vote_type: int
+) -> Optional[tuple]:
+    ''' Queues a vote, checked against the queued vote of the user or else
+    the one in the database. It returns the May and the old type of the vote,
+    or None if the vote is unchanged, and raises NoResultFound if there's no
+    such May, or 503 if the queue is full. '''
+    may = session.exec(votes.may_rel(may_id)).one()
+    old_type = buffer.queued(user.id, may_id)
+    if old_type is MISSING:
+        old_type = session.exec(votes.old_vote(user.id, may_id)).first()
+    if old_type == vote_type:
+        return None
+    buffer.put(user, may_id, vote_type)
+    return may, old_type
+
+
+async def queue_async(
+    session: AsyncSession, user: User, may_id: int, vote_type: int
+) -> Optional[tuple]:
+    ''' Queues a vote, with the async database stack. It returns the May and
+    the old type of the vote, or None if the vote is unchanged, and raises
+    NoResultFound if there's no such May. '''
+    may = (await session.exec(votes.may_rel(may_id))).one()
+    old_type = buffer.queued(user.id, may_id)
+    if old_type is MISSING:
+        old_type = (await session.exec(
+            votes.old_vote(user.id, may_id)
+            )).first()
+    if old_type == vote_type:
+        return None
+    buffer.put(user, may_id, vote_type)
+    return may, old_type
+
+
+def unqueue(session: Session, user: User, may_id: int) -> bool:
+    ''' Queues the removal of the vote of a user on a May. It returns False
+    if there's no vote, queued or in the database. '''
+    old_type = buffer.queued(user.id, may_id)
+    if old_type is MISSING:
+        old_type = session.exec(votes.old_vote(user.id, may_id)).first()
+    if old_type is None:
+        return False
+    buffer.put(user, may_id, None)
+    return True
+
+
+async def unqueue_async(
+    session: AsyncSession, user: User, may_id: int
+) -> bool:
+    ''' Queues the removal of the vote of a user on a May, with the async
+    database stack. It returns False if there's no vote. '''
+    old_type = buffer.queued(user.id, may_id)
+    if old_type is MISSING:
+        old_type = (await session.exec(
+            votes.old_vote(user.id, may_id)
+            )).first()
+    if old_type is None:
+        return False
+    buffer.put(user, may_id, None)
+    return True
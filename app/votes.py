@@ -0,0 +1,374 @@
+''' Responsible for writing the votes. A vote is upserted, so creating it or
+changing its type is a single atomic statement, and two clients voting at
+once can't collide on the primary key. A batch of votes is written the same
+way, with one upsert for all of them, and so are the votes queued by the
+vote buffer. The Mayz voted are locked before their votes are read, so the
+counters are changed from the latest vote even when the same user votes
+twice at once. '''
+
+from typing import Optional
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlmodel import (
+    Session, select, update, delete, col, case, and_, tuple_
+    )
+from sqlmodel.ext.asyncio.session import AsyncSession
+from app.models import May, User, Vote, VoteBatchItem
+from app import scores
+
+# Outcomes of the votes of a batch
+CREATED = 'created'
+UPDATED = 'updated'
+UNCHANGED = 'unchanged'
+NOT_FOUND = 'not found'
+
+
+def old_vote(user_id: int, may_id: int):
+    ''' Returns the statement selecting the type of a vote '''
+    return select(Vote.vote_type).where(
+        col(Vote.user_id) == user_id, col(Vote.may_id) == may_id
+        )
+
+
+def lock_mayz(dialect: str, may_ids):
+    ''' Returns the statement locking the rows of the Mayz until the end of
+    the transaction, in the order of their ids so concurrent writers don't
+    deadlock. It returns the ids of the Mayz that exist. '''
+    if dialect == 'postgresql':
+        return select(May.id).where(col(May.id).in_(may_ids)).order_by(
+            col(May.id)
+            ).with_for_update()
+    # SQLite ignores FOR UPDATE, but a write takes the lock of the database,
+    # so the Mayz are updated without changing them
+    return update(May).where(col(May.id).in_(may_ids)).values(
+        updated_at=col(May.updated_at)
+        ).returning(col(May.id)).execution_options(synchronize_session=False)
+
+
+def vote_upsert(dialect: str, user_id: int, may_id: int, vote_type: int):
+    ''' Returns the statement inserting a vote, or changing its type if the
+    user already voted the May. It returns no row if the vote is unchanged,
+    and a missing May is caught by the foreign key. '''
+    insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+    statement = insert(Vote).values(
+        user_id=user_id, may_id=may_id, vote_type=vote_type
+        )
+    return statement.on_conflict_do_update(
+        index_elements=[col(Vote.user_id), col(Vote.may_id)],
+        set_={'vote_type': statement.excluded.vote_type},
+        where=col(Vote.vote_type) != statement.excluded.vote_type
+        ).returning(col(Vote.vote_type))
+
+
+def is_type(vote_type, value: int):
+    ''' Returns 1 if the vote is of the given type, 0 otherwise, even if it
+    doesn't exist '''
+    return case((vote_type == value, 1), else_=0)
+
+
+def postgres_vote(user_id: int, may_id: int, vote_type: int):
+    ''' Returns a single statement that upserts a vote and updates the
+    counters of its May. It returns the May and the old and new types of the
+    vote, or no row if the vote is unchanged. '''
+    # Every part of the statement sees the same snapshot, so the old vote is
+    # read before it's changed by the upsert. It runs after the May is locked,
+    # and with READ COMMITTED every statement takes a new snapshot, so it
+    # reads the vote committed by the last writer that held the lock.
+    old = old_vote(user_id, may_id).cte('old_vote')
+    upsert = vote_upsert(
+        'postgresql', user_id, may_id, vote_type
+        ).cte('upsert')
+    old_type = select(old.c.vote_type).scalar_subquery()
+    upvotes = is_type(upsert.c.vote_type, 1) - is_type(old_type, 1)
+    downvotes = is_type(upsert.c.vote_type, -1) - is_type(old_type, -1)
+    return update(May).where(col(May.id) == may_id).values(
+        upvotes=col(May.upvotes) + upvotes,
+        downvotes=col(May.downvotes) + downvotes,
+        score=col(May.score) + upvotes - downvotes
+        ).returning(
+            col(May.id), col(May.title), col(May.content),
+            old_type.label('old_type'), upsert.c.vote_type
+            )
+
+
+def may_rel(may_id: int):
+    ''' Returns the statement selecting the data of a May for VoteRead '''
+    return select(May.id, May.title, May.content).where(
+        col(May.id) == may_id
+        )
+
+
+def upsert_vote(
+    session: Session, user_id: int, may_id: int, vote_type: int
+) -> Optional[tuple]:
+    ''' Upserts a vote and updates the counters of its May. It returns the
+    May and the old type of the vote, or None if the vote is unchanged. '''
+    dialect = session.get_bind().dialect.name
+    # A missing May raises NoResultFound
+    session.exec(lock_mayz(dialect, [may_id])).one()
+    if dialect == 'postgresql':
+        if row := session.exec(
+            postgres_vote(user_id, may_id, vote_type)
+        ).first():
+            return row, row.old_type
+        return None
+    # SQLite can't upsert in a CTE, so the old vote is read first, once the
+    # database is locked. The round trips don't leave the process.
+    old_type = session.exec(old_vote(user_id, may_id)).first()
+    if session.exec(
+        vote_upsert(dialect, user_id, may_id, vote_type)
+    ).first() is None:
+        return None
+    scores.apply_vote(session, may_id, old_type, vote_type)
+    return session.exec(may_rel(may_id)).one(), old_type
+
+
+async def upsert_vote_async(
+    session: AsyncSession, user_id: int, may_id: int, vote_type: int
+) -> Optional[tuple]:
+    ''' Upserts a vote and updates the counters of its May, with the async
+    database stack. It returns the May and the old type of the vote, or None
+    if the vote is unchanged. '''
+    dialect = session.get_bind().dialect.name
+    # A missing May raises NoResultFound
+    (await session.exec(lock_mayz(dialect, [may_id]))).one()
+    if dialect == 'postgresql':
+        if row := (await session.exec(
+            postgres_vote(user_id, may_id, vote_type)
+        )).first():
+            return row, row.old_type
+        return None
+    # SQLite can't upsert in a CTE, so the old vote is read first, once the
+    # database is locked. The round trips don't leave the process.
+    old_type = (await session.exec(old_vote(user_id, may_id))).first()
+    if (await session.exec(
+        vote_upsert(dialect, user_id, may_id, vote_type)
+    )).first() is None:
+        return None
+    counters = scores.vote_update(may_id, old_type, vote_type)
+    if counters is not None:
+        await session.exec(counters)
+    return (await session.exec(may_rel(may_id))).one(), old_type
+
+
+def remove_vote(session: Session, user_id: int, may_id: int) -> bool:
+    ''' Deletes a vote and updates the counters of its May. It returns False
+    if there's no such vote. '''
+    session.exec(lock_mayz(session.get_bind().dialect.name, [may_id])).all()
+    old_type = session.exec(old_vote(user_id, may_id)).first()
+    if old_type is None:
+        return False
+    session.exec(delete(Vote).where(
+        col(Vote.user_id) == user_id, col(Vote.may_id) == may_id
+        ))
+    scores.apply_vote(session, may_id, old_type, None)
+    return True
+
+
+async def remove_vote_async(
+    session: AsyncSession, user_id: int, may_id: int
+) -> bool:
+    ''' Deletes a vote and updates the counters of its May, with the async
+    database stack. It returns False if there's no such vote. '''
+    (await session.exec(
+        lock_mayz(session.get_bind().dialect.name, [may_id])
+        )).all()
+    old_type = (await session.exec(old_vote(user_id, may_id))).first()
+    if old_type is None:
+        return False
+    await session.exec(delete(Vote).where(
+        col(Vote.user_id) == user_id, col(Vote.may_id) == may_id
+        ))
+    await session.exec(scores.vote_update(may_id, old_type, None))
+    return True
+
+
+def batch_state(user_id: int, may_ids):
+    ''' Returns the statement selecting which of the Mayz exist, along with
+    the type of the vote of the user on each, None if there is no vote '''
+    return select(May.id, Vote.vote_type).outerjoin(
+        Vote,
+        and_(col(Vote.may_id) == col(May.id), col(Vote.user_id) == user_id)
+        ).where(col(May.id).in_(may_ids))
+
+
+def upsert_many(dialect: str, rows: list[dict]):
+    ''' Returns the statement inserting many votes, or changing their types
+    if they exist '''
+    insert = postgresql.insert if dialect == 'postgresql' else sqlite.insert
+    statement = insert(Vote).values(rows)
+    return statement.on_conflict_do_update(
+        index_elements=[col(Vote.user_id), col(Vote.may_id)],
+        set_={'vote_type': statement.excluded.vote_type}
+        )
+
+
+def batch_upsert(dialect: str, user_id: int, new_votes: dict[int, int]):
+    ''' Returns the statement inserting the votes of a batch, or changing
+    their types if the user already voted the Mayz '''
+    return upsert_many(dialect, [
+        {'user_id': user_id, 'may_id': may_id, 'vote_type': vote_type}
+        for may_id, vote_type in new_votes.items()
+        ])
+
+
+def plan_batch(
+    dialect: str,
+    user_id: int,
+    items: list[VoteBatchItem],
+    state: dict[int, Optional[int]]
+) -> tuple[list[dict], list]:
+    ''' Returns the outcome of each vote of a batch, given the Mayz that
+    exist and the old types of the votes, and the statements writing the votes
+    that change '''
+    results, changes = [], []
+    for item in items:
+        if item.may_id not in state:
+            outcome = NOT_FOUND
+        elif (old_type := state[item.may_id]) == item.vote_type:
+            outcome = UNCHANGED
+        else:
+            outcome = CREATED if old_type is None else UPDATED
+            changes.append((item.may_id, old_type, item.vote_type))
+        results.append({
+            'may_id': item.may_id, 'vote_type': item.vote_type,
+            'status': outcome
+            })
+    if not changes:
+        return results, []
+    statements = [batch_upsert(dialect, user_id, {
+        may_id: vote_type for may_id, _, vote_type in changes
+        })]
+    counters = scores.votes_update(scores.vote_deltas(changes))
+    if counters is not None:
+        statements.append(counters)
+    return results, statements
+
+
+def apply_batch(
+    session: Session, user_id: int, items: list[VoteBatchItem]
+) -> list[dict]:
+    ''' Writes a batch of votes of a user and updates the counters of their
+    Mayz, within the transaction of the session. It returns the outcome of
+    each vote. '''
+    dialect = session.get_bind().dialect.name
+    # The Mayz are locked before the votes are read, so a concurrent batch
+    # of the user can't change them in between
+    may_ids = sorted(item.may_id for item in items)
+    session.exec(lock_mayz(dialect, may_ids)).all()
+    state = dict(session.exec(batch_state(user_id, may_ids)).all())
+    results, statements = plan_batch(dialect, user_id, items, state)
+    for statement in statements:
+        session.exec(statement)
+    return results
+
+
+async def apply_batch_async(
+    session: AsyncSession, user_id: int, items: list[VoteBatchItem]
+) -> list[dict]:
+    ''' Writes a batch of votes of a user and updates the counters of their
+    Mayz, with the async database stack. It returns the outcome of each
+    vote. '''
+    dialect = session.get_bind().dialect.name
+    may_ids = sorted(item.may_id for item in items)
+    (await session.exec(lock_mayz(dialect, may_ids))).all()
+    state = dict((await session.exec(batch_state(user_id, may_ids))).all())
+    results, statements = plan_batch(dialect, user_id, items, state)
+    for statement in statements:
+        await session.exec(statement)
+    return results
+
+
+def queued_state(keys: list[tuple[int, int]]) -> list:
+    ''' Returns the statements selecting the types of the votes with the
+    (user_id, may_id) keys, and which of their users and Mayz exist '''
+    return [
+        select(Vote.user_id, Vote.may_id, Vote.vote_type).where(
+            tuple_(col(Vote.user_id), col(Vote.may_id)).in_(keys)
+            ),
+        select(User.id).where(col(User.id).in_({key[0] for key in keys})),
+        select(May.id).where(col(May.id).in_({key[1] for key in keys})),
+        ]
+
+
+def plan_queued(
+    dialect: str,
+    queued: dict[tuple[int, int], Optional[int]],
+    state: dict[tuple[int, int], int],
+    user_ids: set[int],
+    may_ids: set[int]
+) -> tuple[list, set[int]]:
+    ''' Returns the statements writing the queued votes, None meaning the
+    vote is deleted, given the old types of the votes and the users and Mayz
+    that exist, and the Mayz whose counters change. The votes of users or on
+    Mayz that are gone are dropped, and the rows are written in the order of
+    their keys, so concurrent writers lock them in the same order. '''
+    changes = [
+        (key, state.get(key), vote_type)
+        for key, vote_type in sorted(queued.items())
+        if state.get(key) != vote_type and key[0] in user_ids
+        and key[1] in may_ids
+        ]
+    deleted = [key for key, _, vote_type in changes if vote_type is None]
+    rows = [
+        {'user_id': user_id, 'may_id': may_id, 'vote_type': vote_type}
+        for (user_id, may_id), _, vote_type in changes
+        if vote_type is not None
+        ]
+    deltas = scores.vote_deltas(
+        (may_id, old_type, vote_type)
+        for (_, may_id), old_type, vote_type in changes
+        )
+    statements = []
+    if rows:
+        statements.append(upsert_many(dialect, rows))
+    if deleted:
+        statements.append(delete(Vote).where(
+            tuple_(col(Vote.user_id), col(Vote.may_id)).in_(deleted)
+            ))
+    if (counters := scores.votes_update(deltas)) is not None:
+        statements.append(counters)
+    return statements, set(deltas)
+
+
+def apply_queued(
+    session: Session, queued: dict[tuple[int, int], Optional[int]]
+) -> set[int]:
+    ''' Writes the queued votes and updates the counters of their Mayz,
+    within the transaction of the session. It returns the Mayz whose counters
+    changed. '''
+    dialect = session.get_bind().dialect.name
+    # The Mayz are locked before the votes are read, since the buffers of
+    # other processes write votes on them too
+    session.exec(lock_mayz(dialect, sorted({key[1] for key in queued}))).all()
+    votes_state, users, mayz = queued_state(list(queued))
+    statements, may_ids = plan_queued(
+        dialect, queued,
+        {(user_id, may_id): vote_type for user_id, may_id, vote_type
+         in session.exec(votes_state).all()},
+        set(session.exec(users).all()), set(session.exec(mayz).all())
+        )
+    for statement in statements:
+        session.exec(statement)
+    return may_ids
+
+
+async def apply_queued_async(
+    session: AsyncSession, queued: dict[tuple[int, int], Optional[int]]
+) -> set[int]:
+    ''' Writes the queued votes and updates the counters of their Mayz, with
+    the async database stack. It returns the Mayz whose counters changed. '''
+    dialect = session.get_bind().dialect.name
+    (await session.exec(
+        lock_mayz(dialect, sorted({key[1] for key in queued}))
+        )).all()
+    votes_state, users, mayz = queued_state(list(queued))
+    statements, may_ids = plan_queued(
+        dialect, queued,
+        {(user_id, may_id): vote_type for user_id, may_id, vote_type
+         in (await session.exec(votes_state)).all()},
+        set((await session.exec(users)).all()),
+        set((await session.exec(mayz)).all())
+        )
+    for statement in statements:
+        await session.exec(statement)
+    return may_ids
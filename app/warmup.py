@@ -0,0 +1,88 @@
+''' Responsible for warming the application up on startup, so the first
+requests after a deploy don't pay for it: the connections of the pool are
+opened, the processes hashing the passwords are started, the hot statements
+are compiled into the cache of the engine by running them once, and the
+adapters of the response models are built. The time of every phase is
+printed once the application is ready, and /ready/ answers 503 until then,
+and again once it's shutting down. '''
+
+import time
+from contextlib import contextmanager
+from sqlmodel import Session, col, select
+from app.models import May, User
+from app.routers.may import may_read_options, may_read_votes_options
+from app.routers.user import user_read_options
+from app import conditional, pagination, timeline, votes
+
+
+class Readiness:
+    ''' Whether the application is ready, and how long its startup took '''
+
+    def __init__(self):
+        self.ready = False
+        self.started = time.perf_counter()
+        # Seconds spent in every phase of the startup
+        self.phases: dict[str, float] = {}
+        self.startup = 0.0
+
+    @contextmanager
+    def phase(self, name: str):
+        ''' Times a phase of the startup '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - start
+
+    def finish(self):
+        ''' Marks the application ready, and prints how long it took '''
+        self.startup = time.perf_counter() - self.started
+        self.ready = True
+        phases = ', '.join(
+            f'{name} {seconds * 1e3:.0f} ms'
+            for name, seconds in self.phases.items()
+            )
+        print(f"Ready in {self.startup * 1e3:.0f} ms ({phases})")
+
+    def stats(self) -> dict:
+        ''' Returns the readiness and the startup times, in seconds '''
+        return {
+            'ready': self.ready,
+            'startup_seconds': self.startup,
+            'phases': self.phases,
+            }
+
+
+# Readiness of the application, the startup starts on import
+state = Readiness()
+
+
+def compile_statements(session: Session) -> int:
+    ''' Runs the statements of the hot routes once, so they're compiled and
+    cached by the engine. They only read, and the newest May is used so the
+    statements of its relationships run too. It returns how many ran. '''
+    statements = [
+        # The authenticated user
+        select(User).where(col(User.username) == ''),
+        # A page of the Mayz, and of the home timeline
+        pagination.paginate(
+            select(May).options(*may_read_options),
+            col(May.created_at), col(May.id), '', 1
+            ),
+        timeline.home(0, '', 1).options(*may_read_options),
+        ]
+    for statement in statements:
+        session.exec(statement).all()
+    newest = session.exec(statements[1]).first()
+    may_id = newest.id if newest else 0
+    user_id = newest.user_id if newest else 0
+    # A May, its version, and a vote on it
+    for statement in (
+        conditional.may_version(may_id), votes.old_vote(user_id, may_id),
+        votes.may_rel(may_id)
+    ):
+        session.exec(statement).all()
+    session.get(May, may_id, options=may_read_votes_options)
+    session.get(User, user_id, options=user_read_options)
+    session.rollback()
+    return len(statements) + 5
@@ -0,0 +1,399 @@
+''' Load test of the routes, served in process through an ASGI client. It
+seeds a database with users, Mayz, follows and votes, runs every route at
+each concurrency level, and reports the throughput and the p50/p95/p99
+latency of each. The results are saved as JSON, along with the commit and the
+settings, so runs can be compared between commits.
+Run `python -m benchmarks.load [--users N] [--mayz N] [--votes N]
+[--requests N] [--concurrency 1,8,32] [--only PREFIX] [--async-db]
+[--use-env] [--output FILE] [--compare FILE]`.
+
+By default the database is a new SQLite file. With --use-env it's the one of
+the environment settings, e.g. a local Postgres, and its tables are dropped
+and created again. bcrypt runs with 4 rounds unless BCRYPT_ROUNDS is set, so
+signing up and logging in measure the routes rather than the hashing. '''
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+from collections import Counter
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Optional
+
+# Words of the contents of the Mayz, and of the searches
+WORDS = (
+    'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod '
+    'tempor incididunt ut labore et dolore magna aliqua enim ad minim veniam'
+    ).split()
+
+
+@dataclass
+class Scenario:
+    ''' A route to load, and how to build each of its requests '''
+    name: str
+    method: str
+    path: Callable[[random.Random], str]
+    body: Optional[Callable[[random.Random], dict]] = None
+    form: Optional[Callable[[random.Random], dict]] = None
+    # Whether the request is sent without a token
+    anonymous: bool = False
+
+
+def parse_args() -> argparse.Namespace:
+    ''' Returns the arguments of the command line '''
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+        )
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--mayz', type=int, default=2000)
+    parser.add_argument('--votes', type=int, default=10000)
+    parser.add_argument('--follows', type=int, default=20,
+                        help='users followed by each user')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per route and concurrency level')
+    parser.add_argument('--concurrency', default='1,8,32')
+    parser.add_argument(
+        '--only', default='',
+        help='only the routes starting with it, e.g. "GET /may"'
+        )
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--async-db', action='store_true')
+    parser.add_argument('--use-env', action='store_true')
+    parser.add_argument('--output', default='benchmarks/results.json')
+    parser.add_argument('--compare', default='',
+                        help='results of a previous run to compare against')
+    return parser.parse_args()
+
+
+def configure(args: argparse.Namespace):
+    ''' Sets the environment settings, before the application is imported '''
+    if not args.use_env:
+        os.environ['DBMS'] = 'sqlite'
+        os.environ['DATABASE'] = os.path.join(tempfile.mkdtemp(), 'load.db')
+    if args.async_db:
+        os.environ['ASYNC_DB'] = '1'
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ.setdefault('ALGORITHM', 'HS256')
+    os.environ.setdefault('EXPIRE_MINUTES', '60')
+    os.environ.setdefault('BCRYPT_ROUNDS', '4')
+    # The load comes from a single client, which the rate limits would reject
+    os.environ.setdefault('RATE_LIMIT', 'False')
+
+
+def rows(args: argparse.Namespace, rng: random.Random) -> dict:
+    ''' Returns the users, Mayz, follows and votes to insert, by model '''
+    # pylint: disable=import-outside-toplevel
+    from app.models import Follow, May, User, Vote
+    from app import utils
+    password = utils.passwords.hash('benchmark')
+    now = datetime.now(timezone.utc)
+    follows = {
+        (follower, followee)
+        for follower in range(1, args.users + 1)
+        for followee in rng.sample(
+            range(1, args.users + 1), min(args.follows, args.users)
+            )
+        if follower != followee
+        }
+    votes = set()
+    while len(votes) < min(args.votes, args.users * args.mayz):
+        votes.add((rng.randint(1, args.users), rng.randint(1, args.mayz)))
+    return {
+        User: [
+            {'id': i, 'nickname': f'user {i}', 'username': f'user{i}',
+             'email': f'user{i}@example.com', 'password': password}
+            for i in range(1, args.users + 1)
+            ],
+        May: [
+            {'id': i, 'title': f'May {i}',
+             'content': ' '.join(rng.choices(WORDS, k=12)),
+             'user_id': rng.randint(1, args.users), 'fanned_out': True,
+             'created_at': now - timedelta(seconds=30 * (args.mayz - i))}
+            for i in range(1, args.mayz + 1)
+            ],
+        Follow: [
+            {'follower_id': follower, 'followee_id': followee}
+            for follower, followee in sorted(follows)
+            ],
+        Vote: [
+            {'user_id': user_id, 'may_id': may_id,
+             'vote_type': rng.choice((1, 1, -1))}
+            for user_id, may_id in sorted(votes)
+            ],
+        }
+
+
+def fill(connection):
+    ''' Fills the timelines and the followers of the users from the rows
+    inserted '''
+    # pylint: disable=import-outside-toplevel
+    from sqlmodel import insert, select, update, func
+    from app.models import Follow, May, Timeline, User
+    from app import importer, timeline
+    # The timelines are filled like the Mayz had been posted one by one
+    columns = ['user_id', 'may_id', 'created_at']
+    connection.execute(insert(Timeline).from_select(
+        columns, select(May.user_id, May.id, May.created_at)
+        ))
+    connection.execute(insert(Timeline).from_select(
+        columns, select(Follow.follower_id, May.id, May.created_at).join(
+            May, May.user_id == Follow.followee_id
+            )
+        ))
+    connection.execute(timeline.trim(select(User.id)))
+    connection.execute(update(User).values(followers=select(
+        func.count()
+        ).where(Follow.followee_id == User.id).scalar_subquery()))
+    # The ids were given, so the sequences of Postgres are moved past them
+    importer.move_sequences(connection)
+
+
+def seed(args: argparse.Namespace, rng: random.Random):
+    ''' Creates the tables again and fills them with the Core, in bulk '''
+    # pylint: disable=import-outside-toplevel
+    from sqlmodel import Session, SQLModel, insert
+    from app import database as db, migrations, scores
+    SQLModel.metadata.drop_all(db.engine)
+    migrations.version_table.drop(db.engine, checkfirst=True)
+    migrations.upgrade(db.engine)
+    with db.engine.begin() as connection:
+        for model, values in rows(args, rng).items():
+            connection.execute(insert(model), values)
+        fill(connection)
+    with Session(db.engine) as session:
+        scores.rebuild(session)
+
+
+def scenarios(args: argparse.Namespace) -> list[Scenario]:
+    ''' Returns the routes to load. The writes are spread over random rows,
+    so they don't all contend for the same one. '''
+    signups = iter(range(10 ** 9))
+
+    def user_id(rng: random.Random) -> int:
+        return rng.randint(1, args.users)
+
+    def may_id(rng: random.Random) -> int:
+        return rng.randint(1, args.mayz)
+
+    def signup(_: random.Random) -> dict:
+        number = next(signups)
+        return {'nickname': f'new {number}', 'username': f'new{number}',
+                'email': f'new{number}@example.com', 'password': 'benchmark'}
+
+    return [
+        Scenario('POST /login/', 'POST', lambda _: '/login/',
+                 form=lambda rng: {
+                     'username': f'user{user_id(rng)}', 'password': 'benchmark'
+                     }, anonymous=True),
+        Scenario('GET /login/me/', 'GET', lambda _: '/login/me/'),
+        Scenario('POST /user/', 'POST', lambda _: '/user/', body=signup,
+                 anonymous=True),
+        Scenario('GET /user/', 'GET', lambda _: '/user/'),
+        Scenario('GET /user/latest/', 'GET', lambda _: '/user/latest/?n=10'),
+        Scenario('GET /user/{id}/', 'GET',
+                 lambda rng: f'/user/{user_id(rng)}/'),
+        Scenario('POST /may/', 'POST', lambda _: '/may/', body=lambda rng: {
+            'title': 'Benchmark', 'content': ' '.join(rng.choices(WORDS, k=12))
+            }),
+        Scenario('GET /may/all/', 'GET', lambda _: '/may/all/?limit=50'),
+        Scenario('GET /may/me/', 'GET', lambda _: '/may/me/'),
+        Scenario('GET /may/search/', 'GET',
+                 lambda rng: f'/may/search/?q={rng.choice(WORDS)}&limit=50'),
+        Scenario('GET /may/timeline/', 'GET',
+                 lambda _: '/may/timeline/?limit=50'),
+        Scenario('GET /may/trending/', 'GET',
+                 lambda _: '/may/trending/?limit=10'),
+        Scenario('GET /may/latest/', 'GET', lambda _: '/may/latest/?n=10'),
+        Scenario('GET /may/{id}/', 'GET', lambda rng: f'/may/{may_id(rng)}/'),
+        Scenario('POST /vote/{may_id}', 'POST',
+                 lambda rng: f'/vote/{may_id(rng)}',
+                 body=lambda rng: {'vote_type': rng.choice((1, -1))}),
+        Scenario('POST /vote/batch', 'POST', lambda _: '/vote/batch',
+                 body=lambda rng: [
+                     {'may_id': may, 'vote_type': rng.choice((1, -1))}
+                     for may in rng.sample(range(1, args.mayz + 1), 10)
+                     ]),
+        Scenario('GET /vote/all', 'GET', lambda _: '/vote/all'),
+        ]
+
+
+def percentile(latencies: list[float], percent: int) -> float:
+    ''' Returns the given percentile of the latencies, in milliseconds '''
+    if len(latencies) < 2:
+        return latencies[0] * 1e3
+    cuts = statistics.quantiles(latencies, n=100, method='inclusive')
+    return cuts[percent - 1] * 1e3
+
+
+@dataclass
+class Load:
+    ''' The client sending the requests, the tokens of the users they're
+    sent as, and how many are sent per route and concurrency level '''
+    client: Any
+    tokens: list[str]
+    rng: random.Random
+    requests: int
+
+    async def send(self, scenario: Scenario) -> tuple[float, str]:
+        ''' Sends a request of a route, and returns its latency and its
+        status, or the exception it failed with '''
+        headers = {} if scenario.anonymous else {
+            'Authorization': f'Bearer {self.rng.choice(self.tokens)}'
+            }
+        kwargs = {'headers': headers}
+        if scenario.body:
+            kwargs['json'] = scenario.body(self.rng)
+        if scenario.form:
+            kwargs['data'] = scenario.form(self.rng)
+        start = time.perf_counter()
+        try:
+            response = await self.client.request(
+                scenario.method, scenario.path(self.rng), **kwargs
+                )
+            outcome = str(response.status_code)
+        except Exception as exc:  # pylint: disable=broad-except
+            outcome = type(exc).__name__
+        return time.perf_counter() - start, outcome
+
+    async def measure(self, scenario: Scenario, concurrency: int) -> dict:
+        ''' Sends the requests of a route from concurrent workers, and
+        returns its throughput and latencies '''
+        latencies, statuses = [], Counter()
+        remaining = iter(range(self.requests))
+
+        async def worker():
+            for _ in remaining:
+                latency, outcome = await self.send(scenario)
+                latencies.append(latency)
+                statuses[outcome] += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        seconds = time.perf_counter() - start
+        return {
+            'route': scenario.name,
+            'concurrency': concurrency,
+            'requests': self.requests,
+            'seconds': seconds,
+            'throughput': self.requests / seconds,
+            'mean_ms': statistics.fmean(latencies) * 1e3,
+            'p50_ms': percentile(latencies, 50),
+            'p95_ms': percentile(latencies, 95),
+            'p99_ms': percentile(latencies, 99),
+            'max_ms': max(latencies) * 1e3,
+            'statuses': dict(statuses),
+            }
+
+
+async def run(args: argparse.Namespace, rng: random.Random) -> list[dict]:
+    ''' Starts the application and loads every route at every concurrency
+    level '''
+    # pylint: disable=import-outside-toplevel
+    import httpx
+    from app.main import app
+    from app import oauth2, database as db
+    tokens = [
+        oauth2.create_access_token(data={
+            'username': f'user{i}', 'email': f'user{i}@example.com'
+            })
+        for i in range(1, args.users + 1)
+        ]
+    levels = [int(level) for level in args.concurrency.split(',')]
+    results = []
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url='http://benchmark'
+        ) as client:
+            load = Load(client, tokens, rng, args.requests)
+            for scenario in scenarios(args):
+                if not scenario.name.startswith(args.only):
+                    continue
+                for concurrency in levels:
+                    result = await load.measure(scenario, concurrency)
+                    results.append(result)
+                    report(result)
+    # The connections of the async driver are closed, or their threads keep
+    # the process alive
+    if db.async_engine is not None:
+        await db.async_engine.dispose()
+    return results
+
+
+def report(result: dict, previous: Optional[dict] = None):
+    ''' Prints the throughput and latencies of a route, and how they changed
+    since the previous run '''
+    line = (
+        f"{result['route']:<22} c={result['concurrency']:<3} "
+        f"{result['throughput']:8.1f} req/s  p50 {result['p50_ms']:8.2f}  "
+        f"p95 {result['p95_ms']:8.2f}  p99 {result['p99_ms']:8.2f} ms  "
+        f"{result['statuses']}"
+        )
+    if previous:
+        throughput = result['throughput'] / previous['throughput']
+        p95 = result['p95_ms'] / previous['p95_ms']
+        line += f"  throughput {throughput:.2f}x  p95 {p95:.2f}x"
+    print(line)
+
+
+def compare(results: list[dict], path: str):
+    ''' Prints the results against the ones of a previous run '''
+    with open(path, encoding='utf-8') as file:
+        before = json.load(file)
+    print(f"Compared with {before['meta'].get('commit') or path}")
+    previous = {
+        (result['route'], result['concurrency']): result
+        for result in before['results']
+        }
+    for result in results:
+        report(result, previous.get((result['route'], result['concurrency'])))
+
+
+def commit() -> Optional[str]:
+    ''' Returns the current commit, if it's run from a git checkout '''
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, check=True
+            ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    ''' Seeds the database, loads the routes and saves the results '''
+    args = parse_args()
+    configure(args)
+    rng = random.Random(args.seed)
+    seed(args, rng)
+    # pylint: disable=import-outside-toplevel
+    from app import database as db
+    results = asyncio.run(run(args, rng))
+    meta = {
+        'commit': commit(),
+        'date': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'dialect': db.engine.dialect.name,
+        'async_db': args.async_db,
+        'bcrypt_rounds': int(os.environ['BCRYPT_ROUNDS']),
+        **{name: getattr(args, name) for name in (
+            'users', 'mayz', 'votes', 'follows', 'requests', 'concurrency',
+            'seed'
+            )},
+        }
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump({'meta': meta, 'results': results}, file, indent=2)
+    print(f'Saved to {args.output}')
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
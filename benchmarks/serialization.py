@@ -0,0 +1,80 @@
+''' Compares how long it takes to turn a list of Mayz into a JSON response,
+with the path FastAPI takes on its own and with app.serialization.
+Run `python -m benchmarks.serialization [--rows N] [--repeat N]`. '''
+
+import argparse
+import json
+import timeit
+from datetime import datetime
+import orjson
+from fastapi.responses import JSONResponse
+from pydantic import TypeAdapter
+from app.models import May, MayRead, User
+from app import serialization
+
+
+def fastapi_path(adapter: TypeAdapter, mayz: list) -> bytes:
+    ''' Validates, dumps to Python objects and encodes with the json module,
+    as FastAPI does with a response model '''
+    value = adapter.validate_python(mayz, from_attributes=True)
+    return JSONResponse(content=None).render(
+        adapter.dump_python(value, mode='json')
+        )
+
+
+def orjson_path(adapter: TypeAdapter, mayz: list) -> bytes:
+    ''' Validates, dumps to Python objects and encodes with orjson '''
+    value = adapter.validate_python(mayz, from_attributes=True)
+    return orjson.dumps(adapter.dump_python(value, mode='json'))
+
+
+def adapter_path(_: TypeAdapter, mayz: list) -> bytes:
+    ''' Validates and encodes straight to JSON bytes, as app.serialization
+    does '''
+    return serialization.dump(list[MayRead], mayz)
+
+
+def build_mayz(rows: int) -> list[May]:
+    ''' Returns ORM Mayz, with their users, as a route would load them '''
+    users = [
+        User(id=i, nickname=f'user {i}', username=f'user{i}',
+             email=f'user{i}@example.com', password='', enabled=True)
+        for i in range(max(rows // 10, 1))
+        ]
+    return [
+        May(id=i, title=f'May {i}', content='Lorem ipsum dolor sit amet ' * 8,
+            created_at=datetime.now(), upvotes=i % 7, downvotes=i % 3,
+            score=i % 7 - i % 3, user=users[i % len(users)])
+        for i in range(rows)
+        ]
+
+
+def main():
+    ''' Runs every path over the same Mayz and prints the time per list '''
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+    mayz = build_mayz(args.rows)
+    adapter = TypeAdapter(list[MayRead])
+    # Every path must give the same document
+    expected = json.loads(fastapi_path(adapter, mayz))
+    results = {}
+    for name, path in (
+        ('fastapi', fastapi_path),
+        ('orjson', orjson_path),
+        ('adapter', adapter_path),
+    ):
+        assert json.loads(path(adapter, mayz)) == expected, name
+        seconds = min(timeit.repeat(
+            lambda path=path: path(adapter, mayz), number=args.repeat, repeat=3
+            )) / args.repeat
+        results[name] = seconds
+    print(f'{args.rows} Mayz per list, best of 3 x {args.repeat}')
+    for name, seconds in results.items():
+        speedup = results['fastapi'] / seconds
+        print(f'{name:>8}: {seconds * 1e3:8.3f} ms  {speedup:5.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+''' Settings and fixtures of the tests. They run on a new SQLite database,
+or with TEST_USE_ENV=1 on the database of the environment settings, e.g. a
+local Postgres, whose tables are dropped and created again. bcrypt runs with
+4 rounds and in the request, the rate limits are off unless a test turns
+them on, and the stats routes are served. '''
+
+import itertools
+import os
+import tempfile
+
+if not os.environ.get('TEST_USE_ENV'):
+    os.environ['DBMS'] = 'sqlite'
+    os.environ['DATABASE'] = os.path.join(tempfile.mkdtemp(), 'test.db')
+os.environ.setdefault('SECRET_KEY', 'test')
+os.environ.setdefault('ALGORITHM', 'HS256')
+os.environ.setdefault('EXPIRE_MINUTES', '30')
+os.environ.setdefault('BCRYPT_ROUNDS', '4')
+os.environ.setdefault('PASSWORD_WORKERS', '0')
+os.environ.setdefault('RATE_LIMIT', 'False')
+os.environ.setdefault('STATS_ROUTES', 'True')
+
+# The settings are read when the application is imported
+# pylint: disable=wrong-import-position
+import pytest
+from fastapi.testclient import TestClient
+from sqlmodel import SQLModel
+from app import database as db, migrations
+from app.main import app
+
+# Numbers of the users signed up, so every test has its own
+_users = itertools.count()
+
+
+@pytest.fixture(name='database', scope='session', autouse=True)
+def fixture_database():
+    ''' Creates the tables of the database, once for every test '''
+    SQLModel.metadata.drop_all(db.get_engine())
+    migrations.version_table.drop(db.get_engine(), checkfirst=True)
+    migrations.upgrade(db.get_engine())
+
+
+@pytest.fixture(name='client', scope='session')
+def fixture_client():
+    ''' Returns a client of the application, started once for every test, so
+    the connections of the async pool stay on the loop of the client '''
+    with TestClient(app) as test_client:
+        yield test_client
+
+
+@pytest.fixture(name='signup')
+def fixture_signup(client):
+    ''' Returns a function signing a new user up and logging it in. It
+    returns the id and the username of the user, and the headers of its
+    requests. '''
+    def new_user() -> tuple[int, str, dict]:
+        username = f'user{next(_users)}'
+        response = client.post('/user/', json={
+            'nickname': username, 'username': username,
+            'email': f'{username}@example.com', 'password': 'password'
+            })
+        assert response.status_code == 201, response.text
+        user_id = response.json()['id']
+        response = client.post('/login/', data={
+            'username': username, 'password': 'password'
+            })
+        assert response.status_code == 202, response.text
+        token = response.json()['access_token']
+        return user_id, username, {'Authorization': f'Bearer {token}'}
+    return new_user
+
+
+@pytest.fixture(name='post_may')
+def fixture_post_may(client):
+    ''' Returns a function posting a new May, which returns its id '''
+    def new_may(
+        headers: dict, title: str = 'A May', content: str = 'Its content'
+    ) -> int:
+        response = client.post(
+            '/may/', json={'title': title, 'content': content},
+            headers=headers
+            )
+        assert response.status_code == 201, response.text
+        return response.json()['id']
+    return new_may
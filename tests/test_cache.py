@@ -0,0 +1,48 @@
+''' Tests of the cache of the authenticated users, through the hit and miss
+counters of /cache/ '''
+
+
+def counters(client) -> tuple[int, int]:
+    ''' Returns the hits and the misses of the cache '''
+    stats = client.get('/cache/').json()
+    return stats['hits'], stats['misses']
+
+
+def test_put_user_invalidates_cache(client, signup):
+    ''' Editing a user drops it from the cache, so its old username is no
+    longer authenticated '''
+    user_id, username, headers = signup()
+    hits, misses = counters(client)
+    for _ in range(2):
+        assert client.get('/login/me/', headers=headers).status_code == 200
+    assert counters(client) == (hits + 1, misses + 1)
+    response = client.put(f'/user/{user_id}/', json={
+        'nickname': 'renamed', 'username': f'{username}r', 'enabled': True,
+        'email': f'{username}r@example.com', 'password': 'password'
+        }, headers=headers)
+    assert response.status_code == 202, response.text
+    # The edit was authenticated from the cache, the next request misses it
+    assert counters(client) == (hits + 2, misses + 1)
+    assert client.get('/login/me/', headers=headers).status_code == 401
+    assert counters(client) == (hits + 2, misses + 2)
+    response = client.post('/login/', data={
+        'username': f'{username}r', 'password': 'password'
+        })
+    token = response.json()['access_token']
+    response = client.get(
+        '/login/me/', headers={'Authorization': f'Bearer {token}'}
+        )
+    assert response.json()['nickname'] == 'renamed'
+
+
+def test_delete_user_invalidates_cache(client, signup):
+    ''' Deleting a user drops it from the cache, so it's no longer
+    authenticated '''
+    user_id, _, headers = signup()
+    assert client.get('/login/me/', headers=headers).status_code == 200
+    hits, misses = counters(client)
+    assert client.delete(
+        f'/user/{user_id}/', headers=headers
+        ).status_code == 204
+    assert client.get('/login/me/', headers=headers).status_code == 401
+    assert counters(client) == (hits + 1, misses + 1)
@@ -0,0 +1,27 @@
+''' Tests of the conditional GETs of the Mayz '''
+
+
+def test_unchanged_may_is_not_modified(client, signup, post_may):
+    ''' A client sending the ETag of the current version gets a 304 with no
+    body, and the May again once a vote changed it '''
+    _, _, headers = signup()
+    _, _, voter = signup()
+    may_id = post_may(headers)
+    response = client.get(f'/may/{may_id}/', headers=headers)
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    response = client.get(
+        f'/may/{may_id}/', headers={**headers, 'If-None-Match': etag}
+        )
+    assert response.status_code == 304
+    assert response.content == b''
+    assert response.headers['ETag'] == etag
+    assert client.post(
+        f'/vote/{may_id}', json={'vote_type': 1}, headers=voter
+        ).status_code == 201
+    response = client.get(
+        f'/may/{may_id}/', headers={**headers, 'If-None-Match': etag}
+        )
+    assert response.status_code == 200
+    assert response.json()['upvotes'] == 1
+    assert response.headers['ETag'] != etag
@@ -0,0 +1,147 @@
+''' Tests of the routing of the sessions between the primary and the read
+replicas, with a second SQLite database as the replica '''
+
+import asyncio
+import os
+import tempfile
+import pytest
+from jose import jwt
+from sqlalchemy.exc import OperationalError
+from starlette.requests import Request
+from sqlmodel import select
+from app.cache import TTLCache
+from app.config import env
+from app.models import User, UserRead
+from app import migrations, oauth2, streaming, database as db
+
+# The replicas are reset between the tests
+# pylint: disable=protected-access
+
+# The sessions are opened with the sync stack
+pytestmark = pytest.mark.skipif(
+    env.async_db, reason='the routing is tested on the sync stack'
+    )
+
+
+def make_request(method: str, username: str, secret: str = '') -> Request:
+    ''' Returns a request of a user, with a token signed by the application,
+    or else with the given secret '''
+    token = jwt.encode(
+        {'username': username}, secret, env.algorithm
+        ) if secret else oauth2.create_access_token({'username': username})
+    return Request({
+        'type': 'http', 'method': method, 'path': '/', 'query_string': b'',
+        'headers': [(b'authorization', f'Bearer {token}'.encode())],
+        })
+
+
+def usernames(request: Request) -> set[str]:
+    ''' Returns the usernames read by the session of a request '''
+    sessions = db.get_session(request)
+    session = next(sessions)
+    try:
+        return set(session.exec(select(User.username)).all())
+    finally:
+        sessions.close()
+
+
+def rename(request: Request, username: str):
+    ''' Changes the nickname of a user with the session of a request '''
+    sessions = db.get_session(request)
+    session = next(sessions)
+    try:
+        user = session.exec(
+            select(User).where(User.username == username)
+            ).one()
+        user.nickname = 'renamed'
+        session.add(user)
+        session.commit()
+    finally:
+        sessions.close()
+
+
+@pytest.fixture(name='use_replica')
+def fixture_use_replica(monkeypatch):
+    ''' Returns a function setting the SQLite database of a path as the only
+    replica, which returns it. The replicas are reset after the test. '''
+    monkeypatch.setattr(db, 'pins', TTLCache(100, 60))
+    monkeypatch.setattr(env, 'replica_retry', 60)
+
+    def replica_at(path: str) -> db.Replica:
+        monkeypatch.setattr(env, 'database_replicas', f'sqlite:///{path}')
+        db._engines.pop('replicas', None)
+        return db.get_replicas()[0]
+    yield replica_at
+    for replica in db._engines.pop('replicas', []):
+        replica.bind.dispose()
+
+
+@pytest.fixture(name='replica')
+def fixture_replica(use_replica):
+    ''' Sets a migrated SQLite database, with a single user, as the replica.
+    The users signed up by the tests are only in the primary. '''
+    replica = use_replica(os.path.join(tempfile.mkdtemp(), 'replica.db'))
+    migrations.upgrade(replica.bind)
+    with replica.bind.begin() as connection:
+        connection.execute(User.__table__.insert().values(
+            nickname='replica', username='replica',
+            email='replica@example.com', password=''
+            ))
+    return replica
+
+
+def test_get_reads_from_replica(signup, replica):
+    ''' GET requests read from the replica, the others from the primary '''
+    _, username, _ = signup()
+    assert usernames(make_request('GET', username)) == {'replica'}
+    assert username in usernames(make_request('POST', username))
+    assert replica.healthy()
+
+
+@pytest.mark.usefixtures('replica')
+def test_stream_reads_from_replica(signup):
+    ''' A stream opens a session of its own, routed like the one of its
+    request '''
+    _, username, _ = signup()
+    response = streaming.stream_rows(
+        make_request('GET', username), select(User), UserRead, 'ndjson'
+        )
+
+    async def body() -> bytes:
+        return b''.join([chunk async for chunk in response.body_iterator])
+    lines = asyncio.run(body()).splitlines()
+    assert [UserRead.model_validate_json(line).username
+            for line in lines] == ['replica']
+
+
+@pytest.mark.usefixtures('replica')
+def test_write_pins_to_primary(signup):
+    ''' After writing, a user reads its writes from the primary, while the
+    other users still read from the replica '''
+    _, username, _ = signup()
+    _, other, _ = signup()
+    rename(make_request('POST', username), username)
+    assert username in usernames(make_request('GET', username))
+    assert usernames(make_request('GET', other)) == {'replica'}
+
+
+@pytest.mark.usefixtures('replica')
+def test_forged_token_isnt_pinned(signup):
+    ''' A token that isn't signed by the application has no user, so its
+    writes don't pin the user it names to the primary '''
+    _, username, _ = signup()
+    request = make_request('POST', username, secret='forged')
+    assert db.request_user(request) is None
+    rename(request, username)
+    assert usernames(make_request('GET', username)) == {'replica'}
+
+
+def test_unhealthy_replica_falls_back(signup, use_replica):
+    ''' A replica that fails to connect is skipped until it's retried, and
+    the reads go to the primary meanwhile '''
+    _, username, _ = signup()
+    replica = use_replica(os.path.join(tempfile.mkdtemp(), 'missing', 'db'))
+    with pytest.raises(OperationalError):
+        usernames(make_request('GET', username))
+    assert not replica.healthy()
+    assert username in usernames(make_request('GET', username))
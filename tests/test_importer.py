@@ -0,0 +1,33 @@
+''' Tests of the bulk import '''
+
+import json
+import sys
+from sqlmodel import Session, select
+from app.models import User
+from app import importer, database as db
+
+
+def test_import_users(monkeypatch, tmp_path):
+    ''' The valid users are inserted with their passwords hashed in a pool of
+    processes, and the others are written to the rejects file '''
+    users = tmp_path / 'users.csv'
+    users.write_text(
+        'nickname,username,email,password\n'
+        'imported,imported,imported@example.com,password\n'
+        'invalid,invalid,not an email,password\n',
+        encoding='utf-8'
+        )
+    rejects = tmp_path / 'rejects.ndjson'
+    monkeypatch.setattr(sys, 'argv', [
+        'importer', 'users', str(users), '--workers', '1',
+        '--rejects', str(rejects)
+        ])
+    importer.main()
+    with Session(db.get_engine()) as session:
+        user = session.exec(
+            select(User).where(User.username == 'imported')
+            ).one()
+    assert user.password.startswith('$2')
+    rejected = [json.loads(line)
+                for line in rejects.read_text(encoding='utf-8').splitlines()]
+    assert [row['row']['username'] for row in rejected] == ['invalid']
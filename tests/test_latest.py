@@ -0,0 +1,24 @@
+''' Tests of the latest Mayz, served from memory '''
+
+
+def latest_ids(client, n: int, headers: dict) -> list[int]:
+    ''' Returns the ids of the latest n Mayz '''
+    response = client.get('/may/latest/', params={'n': n}, headers=headers)
+    assert response.status_code == 200, response.text
+    return [may['id'] for may in response.json()]
+
+
+def test_latest_follows_posts_and_deletes(client, signup, post_may):
+    ''' A new May is the latest one right away, and a deleted one is gone
+    from the latest Mayz '''
+    _, _, headers = signup()
+    first, second = post_may(headers), post_may(headers)
+    assert latest_ids(client, 2, headers) == [second, first]
+    response = client.get('/may/latest/', headers=headers)
+    assert response.json()['id'] == second
+    assert client.delete(
+        f'/may/{second}/', headers=headers
+        ).status_code == 204
+    latest = latest_ids(client, 2, headers)
+    assert latest[0] == first
+    assert second not in latest
@@ -0,0 +1,90 @@
+''' Tests of the migrations, on a SQLite database of their own that starts at
+the first version with rows in it '''
+
+import os
+import tempfile
+import pytest
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.exc import IntegrityError
+from app import migrations, database as db
+
+
+@pytest.fixture(name='engine')
+def fixture_engine():
+    ''' Returns the engine of a database at the first version, with two
+    users, a May of each and their votes on the first one '''
+    engine = create_engine(
+        f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'migrations.db')}"
+        )
+    event.listen(engine, 'connect', db.enforce_foreign_keys)
+    assert migrations.upgrade(engine, 1) == [1]
+    with engine.begin() as connection:
+        connection.execute(text(
+            "INSERT INTO user (id, nickname, username, email, password, "
+            "created_at) VALUES "
+            "(1, 'first', 'first', 'first@example.com', '', '2024-01-01'), "
+            "(2, 'second', 'second', 'second@example.com', '', '2024-01-02')"
+            ))
+        connection.execute(text(
+            "INSERT INTO may (id, title, content, user_id, created_at) VALUES "
+            "(1, 'First', 'content', 1, '2024-01-03'), "
+            "(2, 'Second', 'content', 2, '2024-01-04')"
+            ))
+        connection.execute(text(
+            'INSERT INTO vote (user_id, may_id, vote_type) VALUES '
+            '(1, 1, 1), (2, 1, -1), (2, 2, 1)'
+            ))
+    yield engine
+    engine.dispose()
+
+
+def rows(engine, query: str) -> list[tuple]:
+    ''' Returns the rows of a query '''
+    with engine.connect() as connection:
+        return [tuple(row) for row in connection.execute(text(query)).all()]
+
+
+def test_upgrade_backfills(engine):
+    ''' Upgrading a database with rows counts the votes, starts the versions
+    at the creation and writes the Mayz to the timelines of their authors '''
+    assert migrations.upgrade(engine) == list(range(2, migrations.HEAD + 1))
+    assert rows(
+        engine, 'SELECT id, upvotes, downvotes, score FROM may ORDER BY id'
+        ) == [(1, 1, 1, 0), (2, 1, 0, 1)]
+    for table_name in ('user', 'may'):
+        assert rows(
+            engine, f'SELECT count(*) FROM "{table_name}" '
+            'WHERE updated_at != created_at'
+            ) == [(0,)]
+    assert rows(
+        engine, 'SELECT user_id, may_id FROM timeline ORDER BY user_id'
+        ) == [(1, 1), (2, 2)]
+
+
+def test_upgrade_keeps_foreign_keys(engine):
+    ''' The tables rebuilt on SQLite keep their rows and foreign keys '''
+    migrations.upgrade(engine)
+    referred = {
+        key['referred_table']
+        for key in inspect(engine).get_foreign_keys('vote')
+        }
+    assert referred == {'user', 'may'}
+    assert rows(engine, 'PRAGMA foreign_key_check') == []
+    with pytest.raises(IntegrityError), engine.begin() as connection:
+        connection.execute(text(
+            'INSERT INTO vote (user_id, may_id, vote_type) VALUES (1, 3, 1)'
+            ))
+
+
+def test_downgrade_and_upgrade_again(engine):
+    ''' Every version is reverted down to an empty database, and upgrading
+    again creates the schema from the start '''
+    migrations.upgrade(engine)
+    assert migrations.downgrade(engine, 0) \
+        == list(range(migrations.HEAD, 0, -1))
+    assert set(inspect(engine).get_table_names()) <= {
+        migrations.version_table.name
+        }
+    assert migrations.upgrade(engine) == list(range(1, migrations.HEAD + 1))
+    with engine.connect() as connection:
+        assert migrations.current(connection) == migrations.HEAD
@@ -0,0 +1,55 @@
+''' Tests of the keyset pagination of the Mayz '''
+
+from app import pagination
+
+
+def pages(client, path: str, headers: dict) -> list[list[int]]:
+    ''' Returns the ids of the Mayz of every page of a route, following the
+    cursor of the next page until there's none '''
+    ids, cursor = [], ''
+    while True:
+        response = client.get(
+            path, params={'cursor': cursor} if cursor else {}, headers=headers
+            )
+        assert response.status_code == 200, response.text
+        ids.append([may['id'] for may in response.json()])
+        if not (cursor := response.headers.get(
+            pagination.NEXT_CURSOR_HEADER
+        )):
+            return ids
+
+
+def test_cursor_follows_pages(client, signup, post_may):
+    ''' The pages of /may/all/ start right after the previous one, newest
+    first '''
+    _, _, headers = signup()
+    may_ids = [post_may(headers) for _ in range(5)]
+    first = client.get('/may/all/?limit=2', headers=headers)
+    assert [may['id'] for may in first.json()] == may_ids[:2:-1]
+    cursor = first.headers[pagination.NEXT_CURSOR_HEADER]
+    second = client.get(
+        '/may/all/', params={'limit': 2, 'cursor': cursor}, headers=headers
+        )
+    assert [may['id'] for may in second.json()] == may_ids[2:0:-1]
+
+
+def test_cursor_follows_search(client, signup, post_may):
+    ''' The pages of a search hold every match once, and the last one has no
+    cursor '''
+    _, _, headers = signup()
+    may_ids = [
+        post_may(headers, content='paginated search') for _ in range(5)
+        ]
+    post_may(headers, content='unrelated')
+    assert pages(
+        client, '/may/all/?limit=2&search=paginated', headers
+        ) == [may_ids[:2:-1], may_ids[2:0:-1], may_ids[:1]]
+
+
+def test_invalid_cursor(client, signup):
+    ''' A cursor that wasn't returned by the API is rejected '''
+    _, _, headers = signup()
+    for path in ('/may/all/', '/may/timeline/'):
+        response = client.get(path, params={'cursor': 'nope'}, headers=headers)
+        assert response.status_code == 400
+        assert response.json()['detail'] == 'Invalid cursor'
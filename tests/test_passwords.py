@@ -0,0 +1,33 @@
+''' Tests of the hashing of the passwords, in the process pool or without
+it '''
+
+import asyncio
+import threading
+from app import utils
+
+
+def test_no_workers_hash_off_the_loop(monkeypatch):
+    ''' Without a pool, the async routes hash in a thread rather than on the
+    event loop '''
+    threads, hash_password = [], utils.get_password_hash
+
+    def record(password: str) -> str:
+        threads.append(threading.get_ident())
+        return hash_password(password)
+    monkeypatch.setattr(utils, 'get_password_hash', record)
+    passwords = utils.PasswordService(0)
+    assert passwords.warm() == 0
+    hashed = asyncio.run(passwords.hash_async('password'))
+    assert threads and threads[0] != threading.get_ident()
+    assert passwords.verify('password', hashed)
+
+
+def test_pool_is_warmed_up():
+    ''' The processes of the pool start on warm up and hash the passwords '''
+    passwords = utils.PasswordService(1)
+    try:
+        assert passwords.warm() == 1
+        hashed = passwords.hash('password')
+        assert asyncio.run(passwords.verify_async('password', hashed))
+    finally:
+        passwords.shutdown()
@@ -0,0 +1,88 @@
+''' Tests of the rate limits of the routes that hash or verify a password '''
+
+import math
+import pytest
+from app.config import env
+from app import ratelimit
+
+
+class FakeStore(ratelimit.BucketStore):
+    ''' Store whose buckets are always empty, recording the keys taken '''
+
+    def __init__(self):
+        self.keys = []
+
+    def take(self, key: str, capacity: int, period: float) -> float:
+        ''' Records the key, and returns the wait of an empty bucket '''
+        self.keys.append(key)
+        return period / capacity
+
+    def clear(self):
+        ''' Forgets the keys taken '''
+        self.keys.clear()
+
+
+@pytest.fixture(name='fake_store')
+def fixture_fake_store(monkeypatch):
+    ''' Turns the rate limits on, with the store set by RATE_LIMIT_STORE '''
+    monkeypatch.setattr(env, 'rate_limit', True)
+    monkeypatch.setattr(env, 'rate_limit_store', f'{__name__}:FakeStore')
+    monkeypatch.setattr(ratelimit, 'store', ratelimit.get_store())
+
+
+def test_store_is_abstract():
+    ''' A store must implement take and clear '''
+    with pytest.raises(TypeError):
+        ratelimit.BucketStore()  # pylint: disable=abstract-class-instantiated
+
+
+@pytest.mark.usefixtures('fake_store')
+def test_login_is_limited(client):
+    ''' A login over the limit is rejected before the password is checked '''
+    response = client.post('/login/', data={
+        'username': 'Someone', 'password': 'password'
+        })
+    assert response.status_code == 429
+    capacity, period = ratelimit.LIMITS['login']['ip']
+    assert response.headers['Retry-After'] == str(math.ceil(period / capacity))
+    # It's rejected by the bucket of the client IP, the first one taken
+    assert [key.split(':')[:2] for key in ratelimit.store.keys] \
+        == [['login', 'ip']]
+
+
+@pytest.mark.usefixtures('fake_store')
+def test_signup_is_limited(client):
+    ''' A signup over the limit is rejected before the user is created '''
+    response = client.post('/user/', json={
+        'nickname': 'limited', 'username': 'limited',
+        'email': 'limited@example.com', 'password': 'password'
+        })
+    assert response.status_code == 429
+    capacity, period = ratelimit.LIMITS['signup']['ip']
+    assert response.headers['Retry-After'] == str(math.ceil(period / capacity))
+    # It's rejected by the bucket of the client IP, the first one taken
+    assert [key.split(':')[:2] for key in ratelimit.store.keys] \
+        == [['signup', 'ip']]
+
+
+def test_memory_store_refills(monkeypatch):
+    ''' A bucket holds up to its capacity and refills evenly '''
+    now = [0.0]
+    monkeypatch.setattr(ratelimit.time, 'monotonic', lambda: now[0])
+    store = ratelimit.MemoryStore()
+    assert [store.take('key', 2, 10) for _ in range(3)] == [0, 0, 5]
+    now[0] = 5
+    assert store.take('key', 2, 10) == 0
+    assert store.take('key', 2, 10) == 5
+
+
+def test_memory_store_drops_least_recently_used():
+    ''' Past max_keys, the bucket used the longest ago is dropped '''
+    store = ratelimit.MemoryStore(max_keys=2)
+    store.take('first', 1, 60)
+    store.take('second', 1, 60)
+    assert store.take('first', 1, 60) > 0
+    store.take('third', 1, 60)
+    # The second bucket was dropped, so it's full again
+    assert store.take('second', 1, 60) == 0
+    assert store.take('third', 1, 60) > 0
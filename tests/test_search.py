@@ -0,0 +1,51 @@
+''' Tests of the full-text search of the Mayz, with the in-memory index '''
+
+import pytest
+from app import search
+
+
+@pytest.fixture(name='memory_search')
+def fixture_memory_search(monkeypatch):
+    ''' Searches an empty in-memory index, filled by the Mayz posted in the
+    test '''
+    monkeypatch.setattr(search, 'backend', search.MemorySearch())
+
+
+def found(client, query: str, headers: dict) -> list[int]:
+    ''' Returns the ids of the Mayz found by a search, best ranked first '''
+    response = client.get('/may/search/', params={'q': query}, headers=headers)
+    if response.status_code == 204:
+        return []
+    assert response.status_code == 200, response.text
+    return [may['id'] for may in response.json()]
+
+
+@pytest.mark.usefixtures('memory_search')
+def test_search_ranks_matches(client, signup, post_may):
+    ''' The Mayz holding every word are found, the ones where the words occur
+    more often first and the newest ones on a tie '''
+    _, _, headers = signup()
+    once = post_may(headers, 'Fruit', 'apple and banana')
+    twice = post_may(headers, 'Apple', 'apple and banana')
+    cherry = post_may(headers, 'Fruit', 'cherry and banana')
+    assert found(client, 'apple', headers) == [twice, once]
+    assert found(client, 'Banana APPLE', headers) == [twice, once]
+    assert found(client, 'banana', headers) == [cherry, twice, once]
+    assert found(client, 'apple cherry', headers) == []
+
+
+@pytest.mark.usefixtures('memory_search')
+def test_search_follows_changes(client, signup, post_may):
+    ''' Edited and deleted Mayz are searched as they are now '''
+    _, _, headers = signup()
+    may_id = post_may(headers, 'Fruit', 'durian')
+    assert found(client, 'durian', headers) == [may_id]
+    assert client.put(f'/may/{may_id}/', json={
+        'title': 'Fruit', 'content': 'mango'
+        }, headers=headers).status_code == 202
+    assert found(client, 'durian', headers) == []
+    assert found(client, 'mango', headers) == [may_id]
+    assert client.delete(
+        f'/may/{may_id}/', headers=headers
+        ).status_code == 204
+    assert found(client, 'mango', headers) == []
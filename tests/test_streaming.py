@@ -0,0 +1,24 @@
+''' Tests of the streamed lists '''
+
+import json
+import pytest
+from app.config import env
+
+
+@pytest.mark.parametrize('url', ['/user/', '/vote/all', '/may/all/'])
+def test_streams_match_lists(monkeypatch, client, signup, post_may, url):
+    ''' The rows streamed as NDJSON or as a JSON array, in batches, are the
+    ones of the list '''
+    monkeypatch.setattr(env, 'stream_batch_size', 2)
+    _, _, headers = signup()
+    for _ in range(3):
+        may_id = post_may(headers)
+    client.post(f'/vote/{may_id}', json={'vote_type': 1}, headers=headers)
+    rows = client.get(url, headers=headers).json()
+    response = client.get(url, params={'stream': 'ndjson'}, headers=headers)
+    assert response.headers['content-type'] == 'application/x-ndjson'
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    response = client.get(url, params={'stream': 'json'}, headers=headers)
+    assert response.headers['content-type'] == 'application/json'
+    assert response.json() == lines
+    assert sorted(map(json.dumps, lines)) == sorted(map(json.dumps, rows))
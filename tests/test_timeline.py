@@ -0,0 +1,52 @@
+''' Tests of the home timelines '''
+
+from sqlmodel import Session, func, select
+from app.config import env
+from app.models import Timeline
+from app import timeline, database as db
+
+
+def timeline_length(user_id: int) -> int:
+    ''' Returns how many Mayz are in the timeline of a user '''
+    with Session(db.get_engine()) as session:
+        return session.exec(select(func.count()).where(
+            Timeline.user_id == user_id
+            )).one()
+
+
+def test_timelines_are_trimmed_later(monkeypatch, client, signup, post_may):
+    ''' Posting writes the May to the timelines of the author and of the
+    followers without trimming them, and the trim keeps their newest Mayz '''
+    monkeypatch.setattr(env, 'timeline_size', 2)
+    author_id, _, author = signup()
+    follower_id, _, follower = signup()
+    assert client.post(
+        f'/user/{author_id}/follow/', headers=follower
+        ).status_code == 204
+    may_ids = [post_may(author) for _ in range(4)]
+    assert timeline_length(author_id) == timeline_length(follower_id) == 4
+    timeline.trim_sync()
+    assert timeline_length(author_id) == timeline_length(follower_id) == 2
+    response = client.get('/may/timeline/', headers=follower)
+    assert [may['id'] for may in response.json()] == may_ids[:1:-1]
+
+
+def test_follow_is_trimmed_later(monkeypatch, client, signup, post_may):
+    ''' Following writes the Mayz of the followed user to the timeline of
+    the follower, which is trimmed with the others written to '''
+    monkeypatch.setattr(env, 'timeline_size', 2)
+    author_id, _, author = signup()
+    follower_id, _, follower = signup()
+    for _ in range(3):
+        post_may(author)
+    timeline.trim_sync()
+    monkeypatch.setattr(env, 'timeline_size', 3)
+    assert client.post(
+        f'/user/{author_id}/follow/', headers=follower
+        ).status_code == 204
+    assert timeline_length(follower_id) == 3
+    monkeypatch.setattr(env, 'timeline_size', 1)
+    timeline.trim_sync()
+    assert timeline_length(follower_id) == 1
+    # The timeline of the author wasn't written to since the last trim
+    assert timeline_length(author_id) == 2
@@ -0,0 +1,28 @@
+''' Tests of the trending Mayz '''
+
+from app.config import env
+from app import trending
+
+
+def test_trending_ranks_by_score(client, signup, post_may):
+    ''' After a refresh, the recent Mayz are ranked by their score '''
+    _, _, headers = signup()
+    voters = [signup()[2] for _ in range(2)]
+    disliked, liked, loved = (post_may(headers) for _ in range(3))
+    for may_id, vote_type, users in (
+        (loved, 1, voters), (liked, 1, voters[:1]), (disliked, -1, voters)
+    ):
+        for voter in users:
+            assert client.post(
+                f'/vote/{may_id}', json={'vote_type': vote_type},
+                headers=voter
+                ).status_code == 201
+    client.portal.call(trending.refresh)
+    response = client.get(
+        '/may/trending/', params={'limit': env.trending_size},
+        headers=headers
+        )
+    assert response.status_code == 200
+    ranking = [may['id'] for may in response.json()]
+    assert ranking.index(loved) < ranking.index(liked) \
+        < ranking.index(disliked)
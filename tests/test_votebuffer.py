@@ -0,0 +1,87 @@
+''' Tests of the write-behind buffer of the votes '''
+
+import pytest
+from sqlmodel import Session, func, select
+from app.config import env
+from app.models import May, Vote
+from app import votebuffer, database as db
+
+
+def stored(may_id: int) -> tuple[int, int, int]:
+    ''' Returns the votes of a May in the database, and its upvotes and
+    downvotes '''
+    with Session(db.get_engine()) as session:
+        may = session.get(May, may_id)
+        votes = session.exec(select(func.count()).where(
+            Vote.may_id == may_id
+            )).one()
+        return votes, may.upvotes, may.downvotes
+
+
+@pytest.fixture(name='vote_buffer')
+def fixture_vote_buffer(monkeypatch, client):
+    ''' Queues the votes, without the task writing them in the background,
+    and writes what's left after the test '''
+    monkeypatch.setattr(env, 'vote_buffer', True)
+    yield votebuffer.buffer
+    client.portal.call(votebuffer.buffer.stop)
+
+
+@pytest.mark.usefixtures('vote_buffer')
+def test_queued_vote_is_read_back(client, signup, post_may):
+    ''' A user reads its queued vote back before it's written in the
+    background '''
+    _, _, headers = signup()
+    may_id = post_may(headers)
+    assert client.post(
+        f'/vote/{may_id}', json={'vote_type': 1}, headers=headers
+        ).status_code == 201
+    assert stored(may_id) == (0, 0, 0)
+    # The same vote is checked against the queued one
+    assert client.post(
+        f'/vote/{may_id}', json={'vote_type': 1}, headers=headers
+        ).status_code == 400
+    # The queued votes of the user are written before it reads the May
+    response = client.get(f'/may/{may_id}/', headers=headers)
+    assert response.json()['upvotes'] == 1
+    assert stored(may_id) == (1, 1, 0)
+
+
+def test_stop_drains_the_queue(client, signup, post_may, vote_buffer):
+    ''' Stopping the buffer writes every queued vote and its counters '''
+    _, _, headers = signup()
+    _, _, other = signup()
+    may_id = post_may(headers)
+    for vote_type, user in ((1, headers), (-1, other)):
+        assert client.post(
+            f'/vote/{may_id}', json={'vote_type': vote_type}, headers=user
+            ).status_code == 201
+    assert client.delete(f'/vote/{may_id}', headers=headers).status_code \
+        == 204
+    assert stored(may_id) == (0, 0, 0)
+    assert client.portal.call(vote_buffer.stop) == 2
+    assert stored(may_id) == (1, 0, 1)
+
+
+def test_full_queue_rejects_new_votes(
+    monkeypatch, client, signup, post_may, vote_buffer
+):
+    ''' Past the limit of the queue, a new vote gets 503, while a queued one
+    can still change '''
+    monkeypatch.setattr(vote_buffer, 'limit', 1)
+    _, _, headers = signup()
+    first, second = post_may(headers), post_may(headers)
+    assert client.post(
+        f'/vote/{first}', json={'vote_type': 1}, headers=headers
+        ).status_code == 201
+    response = client.post(
+        f'/vote/{second}', json={'vote_type': 1}, headers=headers
+        )
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    assert client.post(
+        f'/vote/{first}', json={'vote_type': -1}, headers=headers
+        ).status_code == 201
+    assert client.portal.call(vote_buffer.stop) == 1
+    assert stored(first) == (1, 0, 1)
+    assert stored(second) == (0, 0, 0)
@@ -0,0 +1,117 @@
+''' Tests of the votes and of the counters of the Mayz '''
+
+import threading
+from functools import partial
+from sqlmodel import Session, func, select
+from app.models import May, Vote, VoteBatchItem
+from app import votes, database as db
+
+
+def counters(may_id: int) -> tuple[tuple, tuple]:
+    ''' Returns the counters of a May, and the ones its votes add up to '''
+    with Session(db.get_engine()) as session:
+        may = session.get(May, may_id)
+        upvotes, downvotes = (
+            session.exec(select(func.count()).where(
+                Vote.may_id == may_id, Vote.vote_type == vote_type
+                )).one()
+            for vote_type in (1, -1)
+            )
+        return (
+            (may.upvotes, may.downvotes, may.score),
+            (upvotes, downvotes, upvotes - downvotes)
+            )
+
+
+def run_at_once(*functions):
+    ''' Runs the functions in threads, each one in a session of its own
+    which it commits, starting them at the same time '''
+    barrier = threading.Barrier(len(functions))
+    errors = []
+
+    def run(function):
+        try:
+            with Session(db.get_engine()) as session:
+                barrier.wait()
+                function(session)
+                session.commit()
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            errors.append(exc)
+
+    threads = [threading.Thread(target=run, args=(function,))
+               for function in functions]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors, errors
+
+
+def test_vote_updates_the_counters(client, signup, post_may):
+    ''' Voting, changing the vote and deleting it keep the counters '''
+    _, _, headers = signup()
+    may_id = post_may(headers)
+    assert client.post(
+        f'/vote/{may_id}', json={'vote_type': 1}, headers=headers
+        ).status_code == 201
+    assert counters(may_id) == ((1, 0, 1), (1, 0, 1))
+    assert client.post(
+        f'/vote/{may_id}', json={'vote_type': 1}, headers=headers
+        ).status_code == 400
+    assert client.post(
+        f'/vote/{may_id}', json={'vote_type': -1}, headers=headers
+        ).status_code == 201
+    assert counters(may_id) == ((0, 1, -1), (0, 1, -1))
+    assert client.delete(f'/vote/{may_id}', headers=headers).status_code \
+        == 204
+    assert counters(may_id) == ((0, 0, 0), (0, 0, 0))
+    assert client.post(
+        '/vote/0', json={'vote_type': 1}, headers=headers
+        ).status_code == 404
+
+
+def test_concurrent_votes_keep_the_counters(signup, post_may):
+    ''' Two votes of a user on a May, run at once, leave the counters as
+    their votes add up to, whichever runs first '''
+    user_id, _, headers = signup()
+    for _ in range(10):
+        may_id = post_may(headers)
+        run_at_once(*(
+            partial(votes.upsert_vote, user_id=user_id, may_id=may_id,
+                    vote_type=vote_type)
+            for vote_type in (1, -1)
+            ))
+        stored, expected = counters(may_id)
+        assert stored == expected
+
+
+def test_concurrent_batches_keep_the_counters(signup, post_may):
+    ''' Two batches of votes of a user on the same Mayz, run at once, leave
+    the counters as their votes add up to '''
+    user_id, _, headers = signup()
+    may_ids = [post_may(headers) for _ in range(3)]
+
+    def batch(vote_type: int):
+        items = [VoteBatchItem(may_id=may_id, vote_type=vote_type)
+                 for may_id in may_ids]
+        return lambda session: votes.apply_batch(session, user_id, items)
+
+    for _ in range(5):
+        run_at_once(batch(1), batch(-1))
+        for may_id in may_ids:
+            stored, expected = counters(may_id)
+            assert stored == expected
+
+
+def test_concurrent_queued_votes_keep_the_counters(signup, post_may):
+    ''' Queued votes of a user on the same May, written at once by the
+    buffers of two processes, leave the counters as their votes add up to '''
+    user_id, _, headers = signup()
+    for _ in range(5):
+        may_id = post_may(headers)
+        run_at_once(*(
+            partial(votes.apply_queued, queued={(user_id, may_id): vote_type})
+            for vote_type in (1, -1)
+            ))
+        stored, expected = counters(may_id)
+        assert stored == expected